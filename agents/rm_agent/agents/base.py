@@ -1,18 +1,43 @@
 import asyncio
 import logging
-from openai import OpenAI
+import time
+from openai import OpenAI, AsyncOpenAI
 import json
 from utils.models import AppState, ConversationModel, ToolCall, ToolFunctionInfo
-from typing import Dict
+from typing import AsyncIterator, Dict, Optional
 from fastmcp import Client
+from utils.tool_call_limiter import ToolCallLimiter
+from utils.tool_result_cache import ToolResultCache
+from utils.context_builder import ContextBuilder
+from utils.llm_usage import LLMUsageStats
+from utils.tracing import span
+from utils.metrics import llm_metrics, tool_metrics, ToolMetrics
 
 logger = logging.getLogger(__name__)
 
 
 class BaseAgent:
-    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=0.7, tools: list = None, max_tokens=4096):
+    # wraps the retrieved context, see __build_messages
+    CONTEXT_PROMPT = "{context}"
+
+    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=0.7, tools: list = None, max_tokens=4096,
+                 async_client: AsyncOpenAI = None, tool_call_limiter: ToolCallLimiter = None,
+                 tool_result_cache: ToolResultCache = None, context_builder: ContextBuilder = None,
+                 usage_stats: LLMUsageStats = None):
         logger.info("RM agent initialized...")
         self.client = client
+        # async client is used by ainvoke_llm so that the LLM round-trip does not block the event loop
+        self.async_client = async_client
+        # bounds concurrent tool calls per mcp server and applies a deadline to each call
+        self.tool_call_limiter = tool_call_limiter
+        # results of read-only tools, shared across threads
+        self.tool_result_cache = tool_result_cache
+        # keeps the prompt within a token budget. the full history is sent when not set
+        self.context_builder = context_builder
+        # token usage and prompt cache hits reported by the provider
+        self.usage_stats = usage_stats
+        # prometheus metrics, bound to the model once
+        self.__llm_metrics = llm_metrics(model)
         self.model = model
         self.toolname_servername_map = toolname_servername_map
         self.temperature = temperature
@@ -44,13 +69,42 @@ class BaseAgent:
 
         return None
 
-    async def __invoke_tool(self, mcp_client: Client, tool: ToolCall, thread_id):
+    def __merge_tool_call_deltas(self, tool_call_deltas: Dict[int, dict], delta_tool_calls):
+        """ merge streamed tool call fragments. id, type and name arrive once, arguments arrive in pieces """
+        for delta in delta_tool_calls:
+            tool_call = tool_call_deltas.setdefault(
+                delta.index, {"id": "", "type": "function", "name": "", "arguments": ""})
+            if delta.id:
+                tool_call["id"] = delta.id
+            if delta.type:
+                tool_call["type"] = delta.type
+            if delta.function:
+                if delta.function.name:
+                    tool_call["name"] += delta.function.name
+                if delta.function.arguments:
+                    tool_call["arguments"] += delta.function.arguments
+
+    def __assemble_tool_calls(self, tool_call_deltas: Dict[int, dict]) -> list[ToolCall] | None:
+        """ convert the merged tool call fragments to ToolCall models, ordered by index """
+        if not tool_call_deltas:
+            return None
+        return [ToolCall(type=tool_call["type"],
+                         id=tool_call["id"],
+                         function=ToolFunctionInfo(
+                             name=tool_call["name"],
+                             arguments=tool_call["arguments"]
+                         )) for _, tool_call in sorted(tool_call_deltas.items())]
+
+    async def __invoke_tool(self, mcp_client: Client, tool: ToolCall, thread_id, progress_handler=None):
         tool_response = await mcp_client.call_tool(tool.function.name, json.loads(tool.function.arguments), meta={
-            "thread_id": thread_id}, progress_handler=self.__tool_call_progress_handler)
+            "thread_id": thread_id}, progress_handler=progress_handler or self.__tool_call_progress_handler)
         logger.debug("tool response: %s", tool_response)
 
         tool_response_content_text = tool_response.content[0].text if tool_response.content else ""
 
+        return self.__tool_response_to_model(tool, thread_id, tool_response_content_text)
+
+    def __tool_response_to_model(self, tool: ToolCall, thread_id, tool_response_content_text: str) -> ConversationModel:
         # add tool response to the messages to be sent back to the LLM for the next iteration of the loop
         # return {"role": "tool", "content": tool_response_content_text, "tool_calls": [tool], "tool_call_id": tool.id}
         return ConversationModel(
@@ -60,11 +114,12 @@ class BaseAgent:
             tool_calls=[tool],
             tool_call_id=tool.id)
 
-    def __convert_llm_response_to_model(self, response) -> ConversationModel:
+    def __convert_llm_response_to_model(self, response, thread_id) -> ConversationModel:
 
         logger.debug("tool calls %s", self.__collect_tool_calls(response))
 
         conv_model = ConversationModel(
+            thread_id=thread_id,
             role="assistant",
             content=response.choices[0].message.content,
             tool_calls=self.__collect_tool_calls(response)
@@ -72,53 +127,270 @@ class BaseAgent:
 
         return conv_model
 
-    def invoke_llm(self, context: str, appstate: AppState) -> AppState:
-        """ call the LLM with the context and the user message """
+    def __build_messages(self, context: str, appstate: AppState) -> list[dict]:
+        """ build the messages to send to the LLM - static system prompt, conversation history, retrieved context and
+        the current user message. the part before the context only grows by appending between calls of a thread,
+        so the provider can serve it from its prompt cache """
+
+        if self.context_builder is not None:
+            context = self.context_builder.fit_context(context)
+        context_message = {"role": "system", "content": self.CONTEXT_PROMPT.format(context=context)} if context else None
 
-        prompt = self.SYSTEM_PROMPT.format(context=context)
+        if self.context_builder is not None:
+            # the context message counts against the budget as well
+            fixed_prompt = self.SYSTEM_PROMPT + (context_message["content"] if context_message else "")
+            history = self.context_builder.fit_messages(fixed_prompt, appstate.messages)
+        else:
+            history = [msg.model_dump(exclude={"thread_id", "summary", "id", "created_at"}) for msg in appstate.messages]
 
         # add system prompt at index 0
-        messages = [
-            {"role": "system", "content": prompt}
-        ] + [msg.model_dump(exclude={"thread_id", "summary", "id", "created_at"}) for msg in appstate.messages]
+        messages = [{"role": "system", "content": self.SYSTEM_PROMPT}] + history
+
+        if context_message:
+            # right before the latest user message, so the tool rounds of the turn share the prefix as well
+            index = next((i for i in range(len(messages) - 1, 0, -1) if messages[i]["role"] == "user"), len(messages))
+            messages.insert(index, context_message)
 
         logger.debug("calling LLM with messages: %s", messages)
+        return messages
+
+    def __record_usage(self, usage, latency: float):
+        if self.usage_stats is not None:
+            self.usage_stats.record(self.model, usage, latency)
+        if usage is not None:
+            self.__llm_metrics.observe(latency, usage.prompt_tokens or 0, usage.completion_tokens or 0,
+                                       LLMUsageStats.cache_hit_tokens(usage))
+
+    def __append_llm_response(self, response, appstate: AppState) -> AppState:
+        """ convert the LLM response to a conversation model and add it to the appstate """
+
+        logger.debug("LLM response received: %s",
+                     response.choices[0].message)
+        # through the constructor, so the thread id is validated to a UUID like on the other messages
+        conv_model = self.__convert_llm_response_to_model(response, appstate.thread_id)
+
+        appstate.messages.append(conv_model)
+        return appstate
+
+    def invoke_llm(self, context: str, appstate: AppState) -> AppState:
+        """ call the LLM with the context and the user message """
+
+        messages = self.__build_messages(context, appstate)
 
         try:
 
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                messages=messages,
-                # stream=True,
-                tools=self.tools,
-            )
+            started_at = time.perf_counter()
+            with span("llm", model=self.model, messages=len(messages)):
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    messages=messages,
+                    # stream=True,
+                    tools=self.tools,
+                )
             # for chunk in response:
             #     yield chunk
-            logger.debug("LLM response received: %s",
-                         response.choices[0].message)
-            conv_model = self.__convert_llm_response_to_model(response)
-            conv_model.thread_id = appstate.thread_id
-
-            appstate.messages.append(conv_model)
-            return appstate
+            self.__record_usage(response.usage, time.perf_counter() - started_at)
+            return self.__append_llm_response(response, appstate)
         except Exception as e:
             print(f"An error occurred: {e}")
             # retry??
             raise
             # return None
 
-    async def execute_tool_calls(self, toolname_servername_map: Dict[str, str], mcp_client_map, appstate: AppState) -> AppState:
-        """ execute the tool calls returned by the LLM concurrently """
+    async def ainvoke_llm(self, context: str, appstate: AppState) -> AppState:
+        """ call the LLM with the context and the user message without blocking the event loop """
+
+        if self.async_client is None:
+            # no async client configured, run the blocking call in a worker thread instead
+            return await asyncio.to_thread(self.invoke_llm, context, appstate)
+
+        messages = self.__build_messages(context, appstate)
+
+        try:
+            started_at = time.perf_counter()
+            with span("llm", model=self.model, messages=len(messages)):
+                response = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    messages=messages,
+                    tools=self.tools,
+                )
+            self.__record_usage(response.usage, time.perf_counter() - started_at)
+            return self.__append_llm_response(response, appstate)
+        except Exception as e:
+            logger.error("An error occurred: %s", e)
+            raise
+
+    async def __cached_tool_response(self, server_name: str, tool: ToolCall) -> Optional[str]:
+        """ the cached result of a cacheable tool call, None on a miss or when the cache is unavailable """
+        if self.tool_result_cache is None:
+            return None
+        try:
+            return await self.tool_result_cache.get(server_name, tool.function.name, tool.function.arguments)
+        except Exception as e:
+            # caching is best effort, the tool is called instead
+            logger.warning("unable to read the cached result of tool %s: %s", tool.function.name, e)
+            return None
+
+    async def __cache_tool_response(self, server_name: str, tool: ToolCall, tool_response: ConversationModel) -> ConversationModel:
+        """ cache the result when the tool is cacheable (read-only) """
+        if self.tool_result_cache is not None:
+            try:
+                await self.tool_result_cache.put(server_name, tool.function.name, tool.function.arguments,
+                                                 tool_response.content or "")
+            except Exception as e:
+                # caching is best effort
+                logger.warning("unable to cache the result of tool %s: %s", tool.function.name, e)
+        return tool_response
+
+    async def astream_llm(self, context: str, appstate: AppState) -> AsyncIterator[dict]:
+        """ stream the LLM response, yielding token events as they arrive.
+        the assembled response (content + tool calls) is appended to the appstate once the stream ends """
+
+        if self.async_client is None:
+            # no async client configured, fall back to a single non-streamed response
+            appstate = await self.ainvoke_llm(context, appstate)
+            if appstate.messages[-1].content:
+                yield {"type": "token", "content": appstate.messages[-1].content}
+            return
+
+        messages = self.__build_messages(context, appstate)
+
+        started_at = time.perf_counter()
+        content_parts: list[str] = []
+        tool_call_deltas: Dict[int, dict] = {}
+
+        # the span is not made current, it stays open across the yields of this generator
+        with span("llm", current=False, model=self.model, messages=len(messages)):
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                messages=messages,
+                stream=True,
+                # usage is sent in a last chunk without choices
+                stream_options={"include_usage": True},
+                tools=self.tools,
+            )
+
+            async for chunk in stream:
+                if chunk.usage:
+                    self.__record_usage(chunk.usage, time.perf_counter() - started_at)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield {"type": "token", "content": delta.content}
+                if delta.tool_calls:
+                    self.__merge_tool_call_deltas(tool_call_deltas, delta.tool_calls)
+
+        conv_model = ConversationModel(
+            thread_id=appstate.thread_id,
+            role="assistant",
+            content="".join(content_parts),
+            tool_calls=self.__assemble_tool_calls(tool_call_deltas)
+        )
+        logger.debug("streamed LLM response assembled: %s", conv_model)
+        appstate.messages.append(conv_model)
+
+    async def astream_tool_calls(self, toolname_servername_map: Dict[str, str], mcp_client_map, appstate: AppState) -> AsyncIterator[dict]:
+        """ execute the tool calls returned by the LLM, yielding tool progress events while they run """
+
+        event_queue: asyncio.Queue = asyncio.Queue()
+
+        async def run_tools():
+            try:
+                await self.execute_tool_calls(toolname_servername_map, mcp_client_map, appstate, event_queue=event_queue)
+            finally:
+                # sentinel - no more events
+                event_queue.put_nowait(None)
+
+        task = asyncio.create_task(run_tools())
+        try:
+            while (event := await event_queue.get()) is not None:
+                yield event
+            # re-raise tool errors, if any
+            await task
+        finally:
+            # consumer went away (e.g. client disconnected) - do not leave the tool calls running
+            if not task.done():
+                task.cancel()
+
+    async def execute_tool_calls(self, toolname_servername_map: Dict[str, str], mcp_client_map, appstate: AppState,
+                                 event_queue: asyncio.Queue = None) -> AppState:
+        """ execute the tool calls returned by the LLM concurrently.
+        when an event queue is given, tool progress is also published to it """
 
         logger.debug("executing tool calls...")
 
+        def progress_handler_for(tool: ToolCall):
+            async def progress_handler(progress: float, total: float | None, message: str | None):
+                await self.__tool_call_progress_handler(progress, total, message)
+                event_queue.put_nowait({"type": "tool_progress", "tool_call_id": tool.id, "tool": tool.function.name,
+                                        "progress": progress, "total": total, "message": message})
+            return progress_handler
+
         async def invoke(tool: ToolCall):
+            server_name = toolname_servername_map.get(tool.function.name) or ""
+            metrics = tool_metrics(server_name, tool.function.name)
+            started_at = time.perf_counter()
+            with span("tool_call", tool=tool.function.name, server=server_name):
+                try:
+                    return await invoke_tool_call(tool, metrics)
+                except Exception:
+                    metrics.error.inc()
+                    raise
+                finally:
+                    metrics.duration.observe(time.perf_counter() - started_at)
+
+        async def invoke_tool_call(tool: ToolCall, metrics: ToolMetrics):
             logger.info("executing tool call: %s", tool)
             server_name = toolname_servername_map.get(tool.function.name)
             mcp_client: Client = mcp_client_map.get(server_name)
-            return await self.__invoke_tool(mcp_client, tool, appstate.thread_id)
+            progress_handler = progress_handler_for(tool) if event_queue is not None else None
+
+            cached = await self.__cached_tool_response(server_name, tool)
+            if cached is not None:
+                metrics.cached.inc()
+                return self.__tool_response_to_model(tool, appstate.thread_id, cached)
+
+            if mcp_client is None:
+                # the server went away after the LLM got the tool list, let the LLM know instead of failing the turn
+                metrics.unavailable.inc()
+                logger.warning("mcp server %s of tool %s is not connected", server_name, tool.function.name)
+                return ConversationModel(
+                    thread_id=appstate.thread_id,
+                    role="tool",
+                    content=f"Tool '{tool.function.name}' is currently unavailable. No result is available.",
+                    tool_calls=[tool],
+                    tool_call_id=tool.id)
+
+            if self.tool_call_limiter is None:
+                tool_response = await self.__invoke_tool(mcp_client, tool, appstate.thread_id, progress_handler=progress_handler)
+                metrics.ok.inc()
+                return await self.__cache_tool_response(server_name, tool, tool_response)
+
+            try:
+                tool_response = await self.tool_call_limiter.run(
+                    server_name, tool.function.name,
+                    lambda: self.__invoke_tool(mcp_client, tool, appstate.thread_id, progress_handler=progress_handler))
+                metrics.ok.inc()
+                return await self.__cache_tool_response(server_name, tool, tool_response)
+            except TimeoutError:
+                metrics.timeout.inc()
+                logger.warning("tool call %s timed out after %s seconds",
+                               tool.function.name, self.tool_call_limiter.timeout)
+                # let the LLM know instead of failing the whole turn
+                return ConversationModel(
+                    thread_id=appstate.thread_id,
+                    role="tool",
+                    content=f"Tool call '{tool.function.name}' timed out after {self.tool_call_limiter.timeout} seconds. No result is available.",
+                    tool_calls=[tool],
+                    tool_call_id=tool.id)
 
         tool_responses = await asyncio.gather(
             *[invoke(tool) for tool in appstate.messages[-1].tool_calls]
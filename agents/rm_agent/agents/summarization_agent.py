@@ -1,15 +1,38 @@
 from agents.base import BaseAgent
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from typing import Optional
+from utils.llm_usage import LLMUsageStats
+from utils.models import AppState, ConversationModel
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class SummarizationAgent(BaseAgent):
-    SYSTEM_PROMPT = """ You are a helpful assistant that summarizes conversation threads. 
-    You will be provided with the conversation history in the form of messages, and your task is to generate a concise summary of the conversation that captures the main points and important information. 
-    The summary should be informative and provide a clear overview of the conversation thread, while omitting any irrelevant details. """
+    SYSTEM_PROMPT = """ You are a helpful assistant that maintains the running summary of a conversation thread. 
+    You will be provided with the current summary (if any) and the messages that follow it, and your task is to return the updated summary that folds the new messages into it. 
+    The summary should be concise and capture the main points and important information (user preferences, recipes discussed, open questions), while omitting any irrelevant details. 
+    Return only the updated summary. """
+    CONTEXT_PROMPT = "Current summary of the conversation:\n{context}"
 
-    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=1.6, max_tokens=4096):
-        super().__init__(client, model, toolname_servername_map, temperature, max_tokens=max_tokens)
+    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=1.6, max_tokens=4096,
+                 async_client: AsyncOpenAI = None, usage_stats: LLMUsageStats = None):
+        super().__init__(client, model, toolname_servername_map, temperature, max_tokens=max_tokens,
+                         async_client=async_client, usage_stats=usage_stats)
         logger.info("Summarization agent initialized...")
+
+    async def afold_summary(self, thread_id: str, previous_summary: Optional[str], messages: list[ConversationModel]) -> str:
+        """ the running summary updated with the messages. the messages are sent as one transcript, so the model
+        summarizes them instead of continuing the conversation """
+        transcript = "\n".join(self.__format_message(message) for message in messages)
+        appstate = AppState(thread_id=thread_id, current_agent_name="summarization_agent", messages=[
+            ConversationModel(role="user", content=f"New messages of the conversation:\n{transcript}")])
+        appstate = await self.ainvoke_llm(context=previous_summary or "", appstate=appstate)
+        return appstate.messages[-1].content
+
+    @staticmethod
+    def __format_message(message: ConversationModel) -> str:
+        if message.tool_calls:
+            calls = ", ".join(f"{call.function.name}({call.function.arguments})" for call in message.tool_calls)
+            return f"{message.role}: [tool calls] {calls}"
+        return f"{message.role}: {message.content or ''}"
@@ -1,4 +1,4 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from sentence_transformers import SentenceTransformer
 import chromadb
 from chromadb.utils import embedding_functions
@@ -6,8 +6,21 @@ from utils.env_settings import EnvSettings
 from utils.models import AppState, ConversationModel
 import traceback
 from chromadb import Search, K, Knn
+import asyncio
 import logging
+import threading
+from typing import AsyncIterator, Optional
+import numpy as np
 from agents.base import BaseAgent
+from utils.retrieval_cache import RetrievalCache
+from utils.response_cache import ResponseCache
+from utils.local_vector_index import LocalVectorIndex, current_version
+from utils.tool_call_limiter import ToolCallLimiter
+from utils.tool_result_cache import ToolResultCache
+from utils.context_builder import ContextBuilder
+from utils.llm_usage import LLMUsageStats
+from utils.tracing import span
+from utils.metrics import LLM_ROUNDS, ROUND_LIMIT_EXHAUSTED
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +30,7 @@ class SupervisorAgent(BaseAgent):
     """ Superisor Agent that coordinates the workflow of the RM Agent """
 
     SEARCH_THRESHOLD = 0.9
+    COLLECTION_NAME = "rm_knowledge_collection_1"
 
     NAME = "main_agent"
     MAX_ORCHESTRATION_ROUNDS = 5
@@ -50,32 +64,149 @@ class SupervisorAgent(BaseAgent):
         - **Directness**: If you can answer without a tool, do so immediately.
         
         Use the provided context when answering questions about food safety, cooking techniques, or measurements.
+        The context is given in a system message right before the latest user message.
+    
+    """
 
+    # retrieved context, sent after the static system prompt and the history so the prompt prefix stays cacheable
+    CONTEXT_PROMPT = """
         # Context
         {context}
-    
     """
 
-    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=0.7, tools: list = None, max_tokens=4096,):
-        super().__init__(client, model, toolname_servername_map, temperature, tools, max_tokens)
-        self.__init_chroma_collection()
+    def __init__(self, client: OpenAI, model, toolname_servername_map, temperature=0.7, tools: list = None, max_tokens=4096,
+                 async_client: AsyncOpenAI = None, tool_call_limiter: ToolCallLimiter = None,
+                 tool_result_cache: ToolResultCache = None, context_builder: ContextBuilder = None,
+                 usage_stats: LLMUsageStats = None):
+        super().__init__(client, model, toolname_servername_map, temperature, tools, max_tokens,
+                         async_client=async_client, tool_call_limiter=tool_call_limiter,
+                         tool_result_cache=tool_result_cache, context_builder=context_builder,
+                         usage_stats=usage_stats)
+        self.__init_knowledge_base()
         logger.info("RM agent initialized...")
 
-    def __init_chroma_collection(self):
-        logger.info("initializing chroma collection...")
-
+    def __init_knowledge_base(self):
         settings = EnvSettings()
 
-        chroma_client = chromadb.CloudClient(tenant=settings.chroma_tenant, database=settings.chroma_database,
-                                             api_key=settings.chroma_cloud_api_key)
+        self.__local_index: LocalVectorIndex = None
+        self.__collection = None
+        if settings.local_index_dir:
+            self.__init_local_index(settings)
+        elif settings.chroma_cloud_api_key:
+            self.__init_chroma_collection(settings)
+        else:
+            # e.g. the load test harness (benchmarks/load_test.py)
+            logger.warning("no knowledge base configured, retrieval is disabled")
+
+        self.__init_retrieval_cache(settings)
+        self.__init_response_cache(settings)
+
+    def __init_local_index(self, settings: EnvSettings):
+        logger.info("loading local vector index...")
+
+        self.__local_index_dir = settings.local_index_dir
+        self.__local_index_lock = threading.Lock()
+        self.__load_local_index()
+
+    def __load_local_index(self):
+        """ load the current version of the index. the new index replaces the old one in a single assignment,
+        searches already running finish on the old one """
+        index = LocalVectorIndex(self.__local_index_dir)
+        # queries must be embedded with the model the index was built with
+        if self.__local_index is not None and self.__local_index.model == index.model:
+            index.embed = self.__local_index.embed
+        else:
+            embedding_model = SentenceTransformer(index.model)
+
+            def embed(texts):
+                return embedding_model.encode(texts, normalize_embeddings=True)
+
+            index.embed = embed
+        self.__local_index = index
+
+    def __refresh_local_index(self):
+        """ reload the index when the ingestion pipeline published a new version """
+        with self.__local_index_lock:
+            version = current_version(self.__local_index_dir)
+            if version is not None and version != self.__local_index.version:
+                logger.info("local vector index version changed from %s to %s, reloading",
+                            self.__local_index.version, version)
+                self.__load_local_index()
+
+    def __init_chroma_collection(self, settings: EnvSettings):
+        logger.info("initializing chroma collection...")
+
+        self.__chroma_client = chromadb.CloudClient(tenant=settings.chroma_tenant, database=settings.chroma_database,
+                                                    api_key=settings.chroma_cloud_api_key)
         # embedding_functions.HuggingFaceEmbeddingFunction(api_key=settings.hf_token, model_name="")
 
-        self.__collection = chroma_client.get_collection(
-            "rm_knowledge_collection_1")
+        self.__collection = self.__chroma_client.get_collection(
+            self.COLLECTION_NAME)
         logger.info(
             "chroma collection initialized...%s", self.__collection.configuration_json)
 
+    def __init_retrieval_cache(self, settings: EnvSettings):
+        """ the knowledge collection only changes on ingestion, cache the search results until the collection version changes """
+
+        embed = None
+        if settings.retrieval_cache_embedding_model:
+            embedding_model = SentenceTransformer(settings.retrieval_cache_embedding_model)
+
+            def embed(text):
+                return embedding_model.encode(text)
+
+        self.retrieval_cache = RetrievalCache(max_size=settings.retrieval_cache_size,
+                                              ttl=settings.retrieval_cache_ttl,
+                                              embed=embed,
+                                              similarity_threshold=settings.retrieval_cache_similarity_threshold,
+                                              version_stamp=self.__knowledge_base_version,
+                                              version_check_interval=settings.retrieval_cache_version_check_interval)
+
+    def __init_response_cache(self, settings: EnvSettings):
+        """ opt-in, answers of tool-free turns are returned without calling the LLM """
+
+        self.response_cache: Optional[ResponseCache] = None
+        if not settings.response_cache_enabled:
+            return
+        embedding_model = SentenceTransformer(settings.response_cache_embedding_model)
+
+        def embed(text):
+            return embedding_model.encode(text)
+
+        self.response_cache = ResponseCache(embed=embed,
+                                            max_size=settings.response_cache_size,
+                                            ttl=settings.response_cache_ttl,
+                                            similarity_threshold=settings.response_cache_similarity_threshold,
+                                            version_stamp=self.__knowledge_base_version,
+                                            version_check_interval=settings.retrieval_cache_version_check_interval)
+
+    def __knowledge_base_version(self):
+        """ version stamp written by the ingestion pipeline, falls back to the number of records.
+        a new version of the local index is loaded here, the caches read the stamp periodically """
+        if self.__local_index is not None:
+            self.__refresh_local_index()
+            return self.__local_index.version
+        if self.__collection is None:
+            return None
+        collection = self.__chroma_client.get_collection(self.COLLECTION_NAME)
+        return (collection.metadata or {}).get("version"), collection.count()
+
     def __get_context_from_database(self, message):
+        found, context = self.retrieval_cache.get(message)
+        if found:
+            logger.debug("retrieval cache hit for: %s", message)
+            return context
+
+        context = self.__search_collection(message)
+        if context is not None:
+            self.retrieval_cache.put(message, context)
+        return context
+
+    def __search_collection(self, message):
+        if self.__local_index is not None:
+            return self.__search_local_index(message)
+        if self.__collection is None:
+            return ""
         try:
             logger.debug("querying chroma db with: %s", message)
 
@@ -105,14 +236,59 @@ class SupervisorAgent(BaseAgent):
             traceback.print_exc()
             return None
 
-    async def orchestrate(self, appstate: AppState, mcp_client_map: dict) -> AppState:
-        """ Orchestrate LLM calls, tools calls """
+    def __search_local_index(self, message):
         try:
+            logger.debug("querying local vector index with: %s", message)
+
+            results = self.__local_index.search_texts([message], limit=5)[0]
+
+            return "\n".join(doc for _, doc, score in results if score <= self.SEARCH_THRESHOLD)
+
+        except Exception as e:
+            logger.error("An error occurred: %s", e)
+            traceback.print_exc()
+            return None
+
+    async def aget_context(self, message: str) -> str:
+        """ retrieve the context for the message without blocking the event loop.
+        the search runs in a worker thread, so it can be started before the state is loaded and awaited later """
+        with span("retrieval"):
+            return await asyncio.to_thread(self.__get_context_from_database, message) or ""
+
+    async def __lookup_response(self, appstate: AppState) -> tuple[Optional[str], Optional[np.ndarray]]:
+        """ (cached answer, embedding of the user message), the embedding runs in a worker thread.
+        the cache is keyed by the message alone, it is only used for the first turn of a thread """
+        if self.response_cache is None or appstate.messages_count > 0:
+            return None, None
+        with span("response_cache"):
+            return await asyncio.to_thread(self.response_cache.lookup, appstate.user_message)
+
+    def __cache_response(self, appstate: AppState, embedding: Optional[np.ndarray], loop_count: int, graceful_exit: bool):
+        """ cache the answer of a turn answered in one round without tool calls """
+        answer = appstate.messages[-1].content
+        if embedding is None or not graceful_exit or loop_count != 1 or not answer:
+            return
+        self.response_cache.put(appstate.user_message, embedding, answer)
+
+    async def orchestrate(self, appstate: AppState, mcp_client_map: dict, context_task: asyncio.Task = None) -> AppState:
+        """ Orchestrate LLM calls, tools calls.
+        context_task - retrieval already started by the caller (see aget_context), retrieved here when not given """
+        try:
+
+            # step 0 - answer of a similar tool-free question, the retrieval started by the caller is not needed
+            cached_answer, embedding = await self.__lookup_response(appstate)
+            if cached_answer is not None:
+                if context_task is not None:
+                    context_task.cancel()
+                appstate.messages.append(ConversationModel(thread_id=appstate.thread_id,
+                                                           role="assistant",
+                                                           content=cached_answer))
+                logger.info("returning the cached response...")
+                return appstate
 
             # step 1 - Retrieve data from Chroma DB (vector store) - provide context
             # print("executing step 1...")
-            context = self.__get_context_from_database(
-                appstate.user_message) or ""
+            context = await (context_task or self.aget_context(appstate.user_message))
 
             loop_count = 0
             graceful_exit = False
@@ -123,7 +299,7 @@ class SupervisorAgent(BaseAgent):
 
                 # step 2 - call LLM
                 # pass the context and the user query to the LLM and get a response
-                appstate = self.invoke_llm(context, appstate)
+                appstate = await self.ainvoke_llm(context, appstate)
                 logger.debug("llm response: %s", appstate.messages[-1])
                 logger.debug("appstate %s", appstate)
 
@@ -138,8 +314,11 @@ class SupervisorAgent(BaseAgent):
                     graceful_exit = True
                     break
 
+            LLM_ROUNDS.observe(loop_count)
+            self.__cache_response(appstate, embedding, loop_count, graceful_exit)
             # max tool calls reached, returning response with a warning about max tool calls
             if not graceful_exit:
+                ROUND_LIMIT_EXHAUSTED.inc()
                 appstate.messages.append(ConversationModel(thread_id=appstate.thread_id,
                                                            role="assistant",
                                                            content="Max tool calls reached. Returning response without executing further tool calls."))
@@ -149,3 +328,51 @@ class SupervisorAgent(BaseAgent):
             logger.error(f"An error occurred: {e}")
             traceback.print_exc()
             return None
+
+    async def orchestrate_stream(self, appstate: AppState, mcp_client_map: dict, context_task: asyncio.Task = None) -> AsyncIterator[dict]:
+        """ streaming variant of orchestrate. yields token and tool events as they arrive, the appstate is updated in place """
+
+        cached_answer, embedding = await self.__lookup_response(appstate)
+        if cached_answer is not None:
+            if context_task is not None:
+                context_task.cancel()
+            appstate.messages.append(ConversationModel(thread_id=appstate.thread_id,
+                                                       role="assistant",
+                                                       content=cached_answer))
+            yield {"type": "token", "content": cached_answer}
+            logger.info("streamed the cached response...")
+            return
+
+        context = await (context_task or self.aget_context(appstate.user_message))
+
+        loop_count = 0
+        graceful_exit = False
+
+        while loop_count < self.MAX_ORCHESTRATION_ROUNDS:
+
+            loop_count += 1
+
+            async for event in self.astream_llm(context, appstate):
+                yield event
+
+            tool_calls = appstate.messages[-1].tool_calls
+            if tool_calls:
+                yield {"type": "tool_calls", "tools": [{"id": tool.id, "name": tool.function.name} for tool in tool_calls]}
+                async for event in self.astream_tool_calls(self.toolname_servername_map, mcp_client_map, appstate):
+                    yield event
+            else:
+                logger.debug(
+                    "no tool calls detected, returning response...")
+                graceful_exit = True
+                break
+
+        LLM_ROUNDS.observe(loop_count)
+        self.__cache_response(appstate, embedding, loop_count, graceful_exit)
+        if not graceful_exit:
+            ROUND_LIMIT_EXHAUSTED.inc()
+            content = "Max tool calls reached. Returning response without executing further tool calls."
+            appstate.messages.append(ConversationModel(thread_id=appstate.thread_id,
+                                                       role="assistant",
+                                                       content=content))
+            yield {"type": "token", "content": content}
+        logger.info("streamed the LLM response...")
@@ -0,0 +1,69 @@
+""" load benchmark for BaseAgent.invoke_llm (blocking) vs BaseAgent.ainvoke_llm (async) against a local stub LLM server.
+
+uv run python -m benchmarks.llm_load --latency 0.2
+"""
+
+import argparse
+import asyncio
+import time
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from agents.base import BaseAgent
+from utils.models import AppState, ConversationModel
+from benchmarks.stub_llm import StubLLMServer
+
+CONCURRENCY_LEVELS = [1, 10, 100]
+
+
+class BenchmarkAgent(BaseAgent):
+    SYSTEM_PROMPT = "You are a benchmark agent. {context}"
+
+
+def new_appstate(thread_id: str) -> AppState:
+    return AppState(thread_id=thread_id, messages=[ConversationModel(role="user", content="hello")])
+
+
+async def run_level(agent: BaseAgent, concurrency: int, requests_per_thread: int, use_async: bool) -> float:
+    """ drive `concurrency` threads concurrently, each sending `requests_per_thread` turns. returns requests/second """
+
+    async def thread_worker(index: int):
+        for _ in range(requests_per_thread):
+            appstate = new_appstate(f"thread-{index}")
+            if use_async:
+                await agent.ainvoke_llm("", appstate)
+            else:
+                # mimics the old request path: blocking call made directly from a coroutine
+                agent.invoke_llm("", appstate)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[thread_worker(i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return (concurrency * requests_per_thread) / elapsed
+
+
+async def main(latency: float, requests_per_thread: int, port: int):
+    with StubLLMServer(port=port, latency=latency) as server:
+        limits = httpx.Limits(max_connections=max(CONCURRENCY_LEVELS))
+        sync_client = OpenAI(base_url=server.base_url, api_key="stub")
+        async_client = AsyncOpenAI(base_url=server.base_url, api_key="stub",
+                                   http_client=httpx.AsyncClient(limits=limits))
+        agent = BenchmarkAgent(client=sync_client, model="stub-model", toolname_servername_map={},
+                               async_client=async_client)
+
+        print(f"stub llm latency {latency * 1000:.0f} ms, {requests_per_thread} requests per thread")
+        print(f"{'threads':>8} {'sync req/s':>12} {'async req/s':>12}")
+        for concurrency in CONCURRENCY_LEVELS:
+            sync_rps = await run_level(agent, concurrency, requests_per_thread, use_async=False)
+            async_rps = await run_level(agent, concurrency, requests_per_thread, use_async=True)
+            print(f"{concurrency:>8} {sync_rps:>12.1f} {async_rps:>12.1f}")
+
+        await async_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RM agent LLM load benchmark")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub LLM latency in seconds")
+    parser.add_argument("--requests", type=int, default=3, help="requests per thread")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.requests, args.port))
@@ -0,0 +1,165 @@
+""" end-to-end load test of main.app, without any external service. the app is booted against the stub LLM server
+(configurable latency and tool-call script), an in-process stub MCP server, fakeredis and SQLite (aiosqlite).
+N threads send their turns concurrently, the report has the throughput, the p50/p95/p99 latency and the per-stage
+timings taken from the Server-Timing header (lock_and_load, retrieval, llm, tool_call, save_state, ...).
+with --stream the turns go to the server-sent events endpoint and the stub LLM streams its replies.
+
+uv run --group dev python -m benchmarks.load_test --threads 50 --turns 4 --llm-latency 0.2 --tool-script recipes_search
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from unittest import mock
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from benchmarks.stub_llm import StubLLMServer
+from benchmarks.stub_mcp import StubMCPServer
+from datastore.schema import SQLITE_SCHEMA
+
+
+@dataclass
+class LoadTestResult:
+    latencies: list[float] = field(default_factory=list)
+    # stage name -> durations in seconds, one per request that ran the stage
+    stages: dict[str, list[float]] = field(default_factory=dict)
+    statuses: dict[int, int] = field(default_factory=dict)
+    # error events of streamed turns, sent with status 200
+    stream_errors: int = 0
+    elapsed: float = 0.0
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    """ stage durations in seconds of a Server-Timing header, see utils.tracing.format_server_timing """
+    stages = {}
+    for metric in filter(None, (part.strip() for part in header.split(","))):
+        name, *params = metric.split(";")
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur":
+                stages[name] = float(value) / 1000
+    return stages
+
+
+def percentiles(values: list[float]) -> tuple[float, float, float]:
+    """ p50, p95 and p99 """
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def configure_environment(llm_url: str, mcp_url: str, database_url: str):
+    """ settings of main.py, they are read when main is imported """
+    os.environ.update({
+        "LLM_BASE_URL": llm_url,
+        "DEEPSEEK_API_KEY": "stub",
+        "MCP_SERVERS": json.dumps({"rm_mcp_server": mcp_url}),
+        "MCP_SERVER_API_KEY": "stub",
+        "AGENTS": json.dumps({"supervisor_agent": "stub-model", "summarization_agent": "stub-model"}),
+        "DATABASE_URL": database_url,
+        "JOB_QUEUE_BACKEND": "local",
+    })
+
+
+async def create_sqlite_schema(database_url: str):
+    engine = create_async_engine(database_url)
+    async with engine.begin() as conn:
+        await conn.execute(text(SQLITE_SCHEMA))
+    await engine.dispose()
+
+
+def setup_fake_redis_client(self, *args, **kwargs):
+    """ replaces ResourceRegistry.setup_redis_client, fakeredis with the json and lua extras supports the RedisJSON
+    commands of the app state and the lease scripts of the thread queue """
+    import fakeredis
+
+    self.redis_client = fakeredis.FakeAsyncRedis()
+    self._stack.push_async_callback(self.redis_client.aclose)
+
+
+async def drive(client: httpx.AsyncClient, threads: int, turns: int, stream: bool = False) -> LoadTestResult:
+    """ every thread sends its turns one after the other, the threads run concurrently.
+    a streamed turn is timed until its last event """
+    result = LoadTestResult()
+
+    async def thread_worker(index: int):
+        thread_id = str(uuid.uuid4())
+        for turn in range(turns):
+            started_at = time.perf_counter()
+            response = await client.post(f"/chat/{thread_id}/stream" if stream else f"/chat/{thread_id}",
+                                         json={"message": f"thread {index} turn {turn}: recipes with paneer?"})
+            result.latencies.append(time.perf_counter() - started_at)
+            if stream:
+                result.stream_errors += response.text.count("event: error\n")
+            result.statuses[response.status_code] = result.statuses.get(response.status_code, 0) + 1
+            for stage, seconds in parse_server_timing(response.headers.get("server-timing", "")).items():
+                result.stages.setdefault(stage, []).append(seconds)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[thread_worker(i) for i in range(threads)])
+    result.elapsed = time.perf_counter() - started_at
+    return result
+
+
+def report(args, result: LoadTestResult):
+    requests = len(result.latencies)
+    errors = sum(count for status, count in result.statuses.items() if status >= 400)
+    print(f"{args.threads} threads x {args.turns} turns, llm latency {args.llm_latency * 1000:.0f} ms, "
+          f"tool latency {args.tool_latency * 1000:.0f} ms, tool script {args.tool_script or '-'}"
+          f"{', streamed' if args.stream else ''}")
+    print(f"requests {requests} (errors {errors}, status {dict(sorted(result.statuses.items()))}"
+          f"{f', stream errors {result.stream_errors}' if args.stream else ''})")
+    print(f"throughput {requests / result.elapsed:.1f} req/s over {result.elapsed:.1f} s")
+    print(f"{'stage':<16} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    # client_total is measured by the client, the server's own "request" stage comes from Server-Timing
+    rows = [("client_total", result.latencies)] + sorted(result.stages.items())
+    for name, values in rows:
+        p50, p95, p99 = percentiles(values)
+        print(f"{name:<16} {len(values):>6} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f}")
+
+
+async def main(args):
+    with (StubLLMServer(port=args.llm_port, latency=args.llm_latency, tool_script=args.tool_script) as llm_server,
+          StubMCPServer(port=args.mcp_port, latency=args.tool_latency) as mcp_server,
+          tempfile.TemporaryDirectory() as tmp_dir):
+        database_url = f"sqlite+aiosqlite:///{tmp_dir}/load_test.db"
+        configure_environment(llm_server.base_url, mcp_server.url, database_url)
+        await create_sqlite_schema(database_url)
+
+        from utils.resource_registry import ResourceRegistry
+        with mock.patch.object(ResourceRegistry, "setup_redis_client", setup_fake_redis_client):
+            # imported here, the settings are read at import
+            import main as agent_server
+
+            app = agent_server.app
+            # runs the lifespan (mcp clients, agents, job queue), the ASGI transport does not
+            async with app.router.lifespan_context(app):
+                async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://rm-agent",
+                                             timeout=args.timeout) as client:
+                    result = await drive(client, args.threads, args.turns, stream=args.stream)
+
+    report(args, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RM agent end-to-end load test")
+    parser.add_argument("--threads", type=int, default=20, help="concurrent conversation threads")
+    parser.add_argument("--turns", type=int, default=3, help="turns per thread")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="stub LLM latency in seconds")
+    parser.add_argument("--tool-latency", type=float, default=0.05, help="stub MCP tool latency in seconds")
+    parser.add_argument("--tool-script", nargs="*", default=[],
+                        help="tools the stub LLM calls in the rounds of every turn, e.g. recipes_search")
+    parser.add_argument("--stream", action="store_true", help="send the turns to /chat/{thread_id}/stream")
+    parser.add_argument("--timeout", type=float, default=120, help="request timeout in seconds")
+    parser.add_argument("--llm-port", type=int, default=9100)
+    parser.add_argument("--mcp-port", type=int, default=9200)
+    asyncio.run(main(parser.parse_args()))
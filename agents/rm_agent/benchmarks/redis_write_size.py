@@ -0,0 +1,62 @@
+""" per-turn redis write size of the full JSON.SET rewrite vs the incremental JSON.ARRAPPEND update.
+
+commands are only queued on a pipeline and measured, no redis server is needed.
+
+uv run python -m benchmarks.redis_write_size
+"""
+
+from redis.asyncio import Redis
+from datastore.database import queue_appstate_update
+from utils.models import AppState, ConversationModel, ToolCall, ToolFunctionInfo
+
+THREAD_LENGTHS = [10, 100, 1000]
+THREAD_ID = "8c6149d2-eed5-4f58-9258-262ca0f53314"
+
+
+def new_turn() -> list[ConversationModel]:
+    """ a typical turn - user message, tool call, tool response and the final assistant reply """
+    tool_call = ToolCall(id="call_1", type="function",
+                         function=ToolFunctionInfo(name="recipes_search", arguments='{"query": "avocado toast"}'))
+    return [
+        ConversationModel(thread_id=THREAD_ID, role="user", content="Are there any avocado toast recipes?"),
+        ConversationModel(thread_id=THREAD_ID, role="assistant", content="", tool_calls=[tool_call]),
+        ConversationModel(thread_id=THREAD_ID, role="tool", content="[{\"id\": 1, \"title\": \"Avocado Toast\"}]" * 5,
+                          tool_calls=[tool_call], tool_call_id="call_1"),
+        ConversationModel(thread_id=THREAD_ID, role="assistant", content="I found an avocado toast recipe. " * 10),
+    ]
+
+
+def new_appstate(history_length: int) -> AppState:
+    history = [message for _ in range(history_length // 4 + 1) for message in new_turn()][:history_length]
+    return AppState(thread_id=THREAD_ID, messages=history + new_turn(), messages_count=history_length,
+                    current_agent_name="supervisor_agent")
+
+
+def pipeline_bytes(pipe) -> int:
+    """ payload bytes of all commands queued on the pipeline """
+    total = 0
+    for args, _ in pipe.command_stack:
+        total += sum(len(arg if isinstance(arg, bytes) else str(arg).encode()) for arg in args)
+    pipe.reset()
+    return total
+
+
+def main():
+    r = Redis()
+    pipe = r.pipeline(transaction=True)
+
+    print(f"{'messages':>9} {'full JSON.SET bytes':>20} {'incremental bytes':>18}")
+    for history_length in THREAD_LENGTHS:
+        appstate = new_appstate(history_length)
+
+        pipe.json().set(THREAD_ID, "$", appstate.model_dump(mode="json"))
+        full_bytes = pipeline_bytes(pipe)
+
+        queue_appstate_update(pipe, THREAD_ID, appstate)
+        incremental_bytes = pipeline_bytes(pipe)
+
+        print(f"{history_length:>9} {full_bytes:>20} {incremental_bytes:>18}")
+
+
+if __name__ == "__main__":
+    main()
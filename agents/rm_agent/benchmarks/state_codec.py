@@ -0,0 +1,50 @@
+""" encode/decode time and size of the app state - the JSON path (model_dump(mode="json") + json.dumps as sent to
+RedisJSON, json.loads + AppState.model_validate on load) vs the msgpack codec (utils/state_codec.py).
+
+no redis server is needed.
+
+uv run python -m benchmarks.state_codec
+"""
+
+import argparse
+import json
+import timeit
+from benchmarks.redis_write_size import new_appstate
+from utils.models import AppState
+from utils.state_codec import decode_appstate, encode_appstate
+
+THREAD_LENGTHS = [10, 100, 1000]
+
+
+def json_encode(appstate: AppState) -> bytes:
+    return json.dumps(appstate.model_dump(mode="json")).encode()
+
+
+def json_decode(data: bytes) -> AppState:
+    return AppState.model_validate(json.loads(data))
+
+
+def time_per_call(func, arg, repeat: int) -> float:
+    """ best of 3 runs, microseconds per call """
+    return min(timeit.repeat(lambda: func(arg), number=repeat, repeat=3)) / repeat * 1_000_000
+
+
+def main(repeat: int):
+    print(f"{'messages':>9} {'codec':>8} {'bytes':>9} {'encode us':>11} {'decode us':>11}")
+    for history_length in THREAD_LENGTHS:
+        appstate = new_appstate(history_length)
+        appstate.messages_count = len(appstate.messages)
+        # fewer repetitions for the long threads
+        number = max(1, repeat * 10 // history_length)
+        for codec, encode, decode in (("json", json_encode, json_decode),
+                                      ("msgpack", encode_appstate, decode_appstate)):
+            data = encode(appstate)
+            assert decode(data).messages[-1].content == appstate.messages[-1].content
+            print(f"{history_length:>9} {codec:>8} {len(data):>9} {time_per_call(encode, appstate, number):>11.1f} "
+                  f"{time_per_call(decode, data, number):>11.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="app state codec benchmark")
+    parser.add_argument("--repeat", type=int, default=100, help="calls per measurement at 10 messages")
+    main(parser.parse_args().repeat)
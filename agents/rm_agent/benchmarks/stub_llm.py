@@ -0,0 +1,132 @@
+""" local OpenAI-compatible stub LLM server used by the benchmarks. answers every chat completion after a fixed latency,
+optionally with a script of tool calls before the final reply. requests with "stream": true get server-sent
+chat.completion.chunk events, like the streaming API """
+
+import asyncio
+import json
+import threading
+import time
+import uuid
+from typing import Optional, Sequence
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import uvicorn
+
+
+def __estimate_tokens(messages: list[dict]) -> int:
+    return sum(len(message.get("content") or "") for message in messages) // 4
+
+
+def __stream_chunks(completion: dict, include_usage: bool):
+    """ the completion as chat.completion.chunk events - the role, the reply word by word or the tool call with its
+    arguments in two fragments, the finish reason and, when requested, the usage in a last chunk without choices """
+    message = completion["choices"][0]["message"]
+    deltas = [{"role": "assistant", "content": ""}]
+    for index, tool_call in enumerate(message.get("tool_calls") or []):
+        arguments = tool_call["function"]["arguments"]
+        middle = len(arguments) // 2
+        deltas.append({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function",
+                                       "function": {"name": tool_call["function"]["name"],
+                                                    "arguments": arguments[:middle]}}]})
+        deltas.append({"tool_calls": [{"index": index, "function": {"arguments": arguments[middle:]}}]})
+    if message.get("content"):
+        words = message["content"].split(" ")
+        deltas.extend({"content": word if i == 0 else f" {word}"} for i, word in enumerate(words))
+
+    chunk = {key: completion[key] for key in ("id", "created", "model")}
+    chunk["object"] = "chat.completion.chunk"
+    for delta in deltas:
+        yield {**chunk, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+    yield {**chunk, "choices": [{"index": 0, "delta": {},
+                                 "finish_reason": completion["choices"][0]["finish_reason"]}]}
+    if include_usage:
+        yield {**chunk, "choices": [], "usage": completion["usage"]}
+
+
+def create_stub_llm_app(latency: float = 0.2, reply: str = "stub reply",
+                        tool_script: Optional[Sequence[str]] = None) -> FastAPI:
+    """ create a FastAPI app that mimics the /v1/chat/completions endpoint.
+    tool_script is the list of tools called in the rounds of a turn, one tool call per round, before the reply.
+    it is only followed when the request offers tools, so summarization calls get the plain reply """
+
+    app = FastAPI(title="Stub LLM Server")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        # simulate the LLM round-trip without holding the event loop
+        await asyncio.sleep(latency)
+
+        # the round of the turn is the number of assistant messages after the latest user message
+        last_user = max((i for i, message in enumerate(messages) if message["role"] == "user"), default=-1)
+        round_index = sum(1 for message in messages[last_user + 1:] if message["role"] == "assistant")
+        if body.get("tools") and tool_script and round_index < len(tool_script):
+            query = messages[last_user]["content"] if last_user >= 0 else ""
+            finish_reason = "tool_calls"
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": tool_script[round_index], "arguments": json.dumps({"query": query})},
+            }]}
+        else:
+            finish_reason = "stop"
+            message = {"role": "assistant", "content": reply}
+
+        prompt_tokens = __estimate_tokens(messages)
+        completion_tokens = len(reply) // 4
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub-model"),
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+        if not body.get("stream"):
+            return completion
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        async def events():
+            for chunk in __stream_chunks(completion, include_usage):
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class BackgroundServer:
+    """ run an ASGI app with uvicorn in a background thread, usable as a context manager """
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 9100):
+        self.host = host
+        self.port = port
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", backlog=2048)
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join()
+
+
+class StubLLMServer(BackgroundServer):
+    """ run the stub LLM app in a background thread, usable as a context manager """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100, latency: float = 0.2,
+                 tool_script: Optional[Sequence[str]] = None):
+        super().__init__(create_stub_llm_app(latency=latency, tool_script=tool_script), host=host, port=port)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
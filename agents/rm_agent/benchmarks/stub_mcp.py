@@ -0,0 +1,40 @@
+""" in-process stub MCP server used by the benchmarks. serves a recipes_search tool like the RM MCP server,
+answering after a fixed latency """
+
+import asyncio
+from fastmcp import FastMCP, Context
+from mcp.types import ToolAnnotations
+from benchmarks.stub_llm import BackgroundServer
+
+STUB_RECIPES = [
+    {"id": 10966, "title": "Avocado Toast"},
+    {"id": 10973, "title": "Butter Chicken"},
+    {"id": 11005, "title": "French Toast"},
+]
+
+
+def create_stub_mcp_server(latency: float = 0.05) -> FastMCP:
+    """ create a FastMCP server with the tools of the RM MCP server that the stub LLM calls """
+
+    mcp = FastMCP(name="Stub MCP Server")
+
+    @mcp.tool(name="recipes_search", annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
+    async def recipes_search(query: str, context: Context) -> list[dict]:
+        """ Search for recipes by title or ingredients. Returns the top matching IDs and Titles. """
+        await context.report_progress(50, 100, "Searching recipes...")
+        # simulate the lookup without holding the event loop
+        await asyncio.sleep(latency)
+        return STUB_RECIPES
+
+    return mcp
+
+
+class StubMCPServer(BackgroundServer):
+    """ run the stub MCP server over SSE in a background thread, usable as a context manager """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9200, latency: float = 0.05):
+        super().__init__(create_stub_mcp_server(latency=latency).http_app(transport="sse"), host=host, port=port)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/sse"
@@ -0,0 +1,61 @@
+""" per-turn allocations of the working state - the deep copy of the loaded AppState vs AppState.start_turn, which
+shares the loaded messages and copies only the list. measured with tracemalloc, no redis server is needed.
+
+uv run python -m benchmarks.working_state
+"""
+
+import time
+import tracemalloc
+from benchmarks.redis_write_size import THREAD_ID, new_turn
+from utils.models import AppState, ConversationModel
+
+THREAD_LENGTHS = [10, 100, 1000]
+
+
+def loaded_state(history_length: int) -> AppState:
+    history = [message for _ in range(history_length // 4 + 1) for message in new_turn()][:history_length]
+    return AppState(thread_id=THREAD_ID, messages=history)
+
+
+def deep_copy_turn(appstate: AppState) -> AppState:
+    """ the previous request path - copy the history to add the user message, then deep-copy the state """
+    user_message = ConversationModel(thread_id=THREAD_ID, role="user", content="Any paneer recipes?")
+    appstate.messages_count = len(appstate.messages)
+    appstate.messages = appstate.messages + [user_message]
+    working_state = appstate.model_copy(deep=True)
+    working_state.messages.extend(new_turn()[1:])
+    return working_state
+
+
+def start_turn(appstate: AppState) -> AppState:
+    user_message = ConversationModel(thread_id=THREAD_ID, role="user", content="Any paneer recipes?")
+    appstate.messages_count = len(appstate.messages)
+    appstate.messages.append(user_message)
+    working_state = appstate.start_turn()
+    working_state.messages.extend(new_turn()[1:])
+    return working_state
+
+
+def measure(turn, history_length: int) -> tuple[int, int, float]:
+    """ (bytes still allocated by the working state, peak bytes, milliseconds) of one turn """
+    appstate = loaded_state(history_length)
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    working_state = turn(appstate)
+    elapsed = time.perf_counter() - started_at
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(working_state.new_messages) == 4
+    return current, peak, elapsed * 1000
+
+
+def main():
+    print(f"{'messages':>9} {'path':>12} {'retained KiB':>13} {'peak KiB':>9} {'ms':>8}")
+    for history_length in THREAD_LENGTHS:
+        for name, turn in (("deep copy", deep_copy_turn), ("start_turn", start_turn)):
+            current, peak, elapsed = measure(turn, history_length)
+            print(f"{history_length:>9} {name:>12} {current / 1024:>13.1f} {peak / 1024:>9.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
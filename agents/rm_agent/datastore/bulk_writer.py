@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from datastore.database import Conversation
+from utils.models import ConversationModel
+
+logger = logging.getLogger(__name__)
+
+# columns written by the bulk writer, in record order. id and created_at defaults are not used
+COPY_COLUMNS = ["thread_id", "user_role", "message", "summary", "tool_calls", "tool_call_id", "created_at"]
+
+
+class ConversationBulkWriter:
+    """ accumulates conversation rows from many threads and writes them with COPY (asyncpg copy_records_to_table).
+
+    a flush happens when max_rows are buffered or flush_interval seconds after the first buffered row.
+    add() returns once the rows are written, so callers (e.g. the background job handler) keep their durability guarantee.
+    engines other than asyncpg (e.g. aiosqlite) fall back to a multi-row INSERT.
+    """
+
+    def __init__(self, engine: AsyncEngine, max_rows: int = 5000, flush_interval: float = 0.2):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.__records: list[tuple] = []
+        self.__waiters: list[asyncio.Future] = []
+        self.__flush_handle: asyncio.TimerHandle = None
+        self.__lock = asyncio.Lock()
+        # keep a reference to the running flushes so they are not garbage collected
+        self.__flush_tasks: set[asyncio.Task] = set()
+        self.rows_written = 0
+        self.flushes = 0
+
+    async def add(self, messages: list[ConversationModel]):
+        """ buffer the messages and wait until they are written """
+        if not messages:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.__records.extend(self.__to_record(message) for message in messages)
+        self.__waiters.append(future)
+
+        if len(self.__records) >= self.max_rows:
+            self.__start_flush()
+        elif self.__flush_handle is None:
+            self.__flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.__start_flush)
+        await future
+
+    async def flush(self):
+        """ write everything that is buffered """
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        records, waiters = self.__records, self.__waiters
+        self.__records, self.__waiters = [], []
+        if not records:
+            return
+
+        try:
+            # one COPY at a time per writer
+            async with self.__lock:
+                await self.__write(records)
+            self.rows_written += len(records)
+            self.flushes += 1
+            logger.debug("%d messages written to database", len(records))
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+        except Exception as e:
+            logger.error("unable to write %d messages to database: %s", len(records), e)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+
+    async def close(self):
+        await self.flush()
+        if self.__flush_tasks:
+            await asyncio.gather(*self.__flush_tasks, return_exceptions=True)
+
+    def __start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.__flush_tasks.add(task)
+        task.add_done_callback(self.__flush_tasks.discard)
+
+    async def __write(self, records: list[tuple]):
+        async with self.engine.connect() as conn:
+            if self.engine.dialect.driver == "asyncpg":
+                raw_connection = await conn.get_raw_connection()
+                await raw_connection.driver_connection.copy_records_to_table(
+                    Conversation.__tablename__, records=records, columns=COPY_COLUMNS)
+            else:
+                await conn.execute(insert(Conversation.__table__), [dict(zip(COPY_COLUMNS, record)) for record in records])
+                await conn.commit()
+
+    def __to_record(self, message: ConversationModel) -> tuple:
+        tool_calls = [tool_call.model_dump(mode="json") for tool_call in message.tool_calls] if message.tool_calls else None
+        return (
+            message.thread_id,
+            message.role,
+            message.content,
+            message.summary,
+            # asyncpg expects json columns as text
+            json.dumps(tool_calls) if tool_calls is not None and self.engine.dialect.driver == "asyncpg" else tool_calls,
+            message.tool_call_id,
+            message.created_at,
+        )
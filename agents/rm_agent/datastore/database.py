@@ -1,17 +1,30 @@
 from typing import Optional
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession, AsyncAttrs
-from sqlalchemy import Integer, String, TEXT, TIMESTAMP,  JSON, func
+from sqlalchemy import Integer, String, TEXT, TIMESTAMP,  JSON, Index, func, select, tuple_
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from typing import Optional
+from datetime import datetime
 from uuid import UUID
-import redis
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
 import logging
 from utils.models import ConversationModel, AppState
+from utils.state_codec import decode_appstate, encode_appstate
 
 
 logger = logging.getLogger(__name__)
 
 
+class StaleLeaseError(Exception):
+    """ the thread lock is no longer held with the given fencing token, the write was rejected """
+
+
+# how the app state of a thread is stored in redis - "json" (RedisJSON document under the thread id, updated in place)
+# or "msgpack" (versioned msgpack blob in a plain string under appstate:<thread id>, see utils/state_codec.py)
+STATE_CODECS = ("json", "msgpack")
+# a msgpack state save is retried when a summary changed the state between the read and the write
+MAX_STATE_SAVE_ATTEMPTS = 5
+
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -20,11 +33,18 @@ metadata = Base.metadata
 
 
 # create a table to store conversation messages
+# the table is range partitioned by created_at on postgres (monthly partitions, see datastore/schema.py),
+# the partition key has to be part of the primary key
 class Conversation(Base):
     __tablename__ = "rm_conversation"
+    __table_args__ = (
+        # thread history reads (load_thread_history)
+        Index("ix_rm_conversation_thread_id_created_at", "thread_id", "created_at"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
     id = mapped_column(Integer, primary_key=True,
-                       nullable=False, autoincrement="auto")
+                       nullable=False, autoincrement=True)
     thread_id: Mapped[UUID] = mapped_column(nullable=False)
     # role can be user, assistant or system
     role: Mapped[str] = mapped_column(
@@ -37,7 +57,7 @@ class Conversation(Base):
     tool_call_id: Mapped[Optional[str]] = mapped_column(String(50))
     # created_at = mapped_column(TIMESTAMP,
     #                            default=func.current_timestamp())
-    created_at = mapped_column(TIMESTAMP(timezone=True),
+    created_at = mapped_column(TIMESTAMP(timezone=True), primary_key=True,
                                server_default=func.now())
 
 
@@ -55,17 +75,256 @@ async def save_messages_to_pg(async_sessionmaker: async_sessionmaker[AsyncSessio
     logger.debug("messages saved to database for thread_id: %s", thread_id)
 
 
-def save_appstate_to_redis(r, thread_id: str, appstate: AppState):
-    """ save messages to redis """
-    result = r.json().set(thread_id, "$", appstate.model_dump(mode="json"))
-    logger.debug("result of storing message in redis: %s", result)
-    return result
+async def save_messages_batch_to_pg(async_sessionmaker: async_sessionmaker[AsyncSession], messages: list[ConversationModel]):
+    """ save the messages of many threads to database in one transaction """
+
+    entities = [Conversation(**message.model_dump(exclude_none=True))
+                for message in messages]
+
+    async with async_sessionmaker() as session:
+        async with session.begin():
+            session.add_all(entities)
+    logger.debug("%d messages saved to database", len(entities))
+
 
+async def load_thread_history(async_sessionmaker: async_sessionmaker[AsyncSession], thread_id: str, limit: int = 50,
+                              before: Optional[tuple[datetime, int]] = None) -> list[ConversationModel]:
+    """ load a page of the thread history, newest page first, messages in chronological order.
+    keyset pagination - pass (created_at, id) of the oldest message of a page as before to load the previous page """
 
-def load_appstate_from_redis(r: redis.Redis, thread_id) -> AppState:
-    """ load app state by thread_id """
-    saved_state = r.json().get(thread_id, "$")
+    query = select(Conversation).where(Conversation.thread_id == UUID(str(thread_id)))
+    if before:
+        query = query.where(tuple_(Conversation.created_at, Conversation.id) < tuple_(*before))
+    query = query.order_by(Conversation.created_at.desc(), Conversation.id.desc()).limit(limit)
+
+    async with async_sessionmaker() as session:
+        rows = (await session.scalars(query)).all()
+    return [ConversationModel.model_validate(row) for row in reversed(rows)]
+
+
+async def load_appstate_from_pg(async_sessionmaker: async_sessionmaker[AsyncSession], thread_id: str,
+                                tail_size: int = 20) -> Optional[AppState]:
+    """ rebuild the app state of a thread from the database - the latest summary followed by the last tail_size messages
+    after it. the tail starts at a user message, so it never begins with a tool response whose tool call was cut off """
+
+    # the Uuid column binds UUID objects only (e.g. aiosqlite), the thread id comes in as a str
+    thread_uuid = UUID(str(thread_id))
+    async with async_sessionmaker() as session:
+        summary = (await session.scalars(
+            select(Conversation)
+            .where(Conversation.thread_id == thread_uuid, Conversation.summary.is_not(None))
+            .order_by(Conversation.created_at.desc(), Conversation.id.desc())
+            .limit(1))).first()
+        query = select(Conversation).where(Conversation.thread_id == thread_uuid, Conversation.summary.is_(None))
+        if summary:
+            # a summary row is dated at the last message it covers (SummaryWindow.summary_message), the turns
+            # kept unsummarized were created after it
+            query = query.where(Conversation.created_at > summary.created_at)
+        tail = (await session.scalars(
+            query.order_by(Conversation.created_at.desc(), Conversation.id.desc()).limit(tail_size))).all()
+
+    messages = [ConversationModel.model_validate(row) for row in reversed(tail)]
+    while messages and messages[0].role != "user":
+        messages.pop(0)
+    if summary:
+        messages.insert(0, ConversationModel.model_validate(summary))
+    if not messages:
+        return None
+
+    logger.info("rehydrated %d messages for thread %s from database", len(messages), thread_id)
+    return AppState(thread_id=thread_id, messages=messages, messages_count=len(messages))
+
+
+async def load_appstate_from_redis(r: Redis, thread_id, async_sessionmaker: async_sessionmaker[AsyncSession] = None,
+                                   tail_size: int = 20, codec: str = "json") -> AppState:
+    """ load app state by thread_id. when redis does not have the thread and a sessionmaker is given,
+    the state is rehydrated from the database """
+    if codec == "msgpack":
+        saved_state = await r.get(msgpack_state_key(thread_id))
+    else:
+        saved_state = await r.json().get(thread_id, "$")
     logger.debug("saved_state %s", saved_state)
+    if not saved_state and async_sessionmaker:
+        return await __rehydrate_appstate(r, thread_id, async_sessionmaker, tail_size, codec)
+    return __to_appstate(thread_id, saved_state)
+
+
+async def acquire_lock_and_load_appstate(r: Redis, lock_key: str, thread_id: str, ex: int = 60,
+                                         async_sessionmaker: async_sessionmaker[AsyncSession] = None,
+                                         tail_size: int = 20, lock_value="processing",
+                                         codec: str = "json") -> tuple[bool, AppState]:
+    """ try to acquire the lock and load the app state in a single round-trip.
+    the loaded state must be ignored when the lock is not acquired.
+    on a redis miss the state is rehydrated from the database (only when the lock is acquired).
+    lock_value is the fencing token of the turn, see ThreadTurnQueue """
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.set(lock_key, lock_value, ex=ex, nx=True)
+        if codec == "msgpack":
+            pipe.get(msgpack_state_key(thread_id))
+        else:
+            pipe.json().get(thread_id, "$")
+        lock_acquired, saved_state = await pipe.execute()
+    logger.debug("lock acquired %s, saved_state %s", lock_acquired, saved_state)
+    if lock_acquired and not saved_state and async_sessionmaker:
+        return True, await __rehydrate_appstate(r, thread_id, async_sessionmaker, tail_size, codec)
+    return bool(lock_acquired), __to_appstate(thread_id, saved_state)
+
+
+def msgpack_state_key(thread_id: str) -> str:
+    return f"appstate:{thread_id}"
+
+
+def queue_appstate_update(pipe, thread_id: str, appstate: AppState):
+    """ queue an incremental update of the saved app state on a redis pipeline.
+    only the new messages (messages[messages_count:]) are appended and the scalar fields are updated in place,
+    so the write cost does not grow with the length of the thread. a new thread is written in full """
+
+    messages_count = len(appstate.messages)
+
+    if appstate.messages_count == 0:
+        # nothing saved for this thread yet
+        state = appstate.model_dump(mode="json")
+        state["messages_count"] = messages_count
+        pipe.json().set(thread_id, "$", state)
+        return
+
+    new_messages = [message.model_dump(mode="json") for message in appstate.new_messages]
+    if new_messages:
+        pipe.json().arrappend(thread_id, "$.messages", *new_messages)
+    pipe.json().set(thread_id, "$.messages_count", messages_count)
+    pipe.json().set(thread_id, "$.user_message", appstate.user_message)
+    pipe.json().set(thread_id, "$.current_agent_name", appstate.current_agent_name)
+
+
+async def save_appstate_and_release_lock(r: Redis, lock_key: str, thread_id: str, appstate: AppState, lock_value=None,
+                                         codec: str = "json"):
+    """ save the new messages of the app state and release the lock atomically in a single round-trip.
+    with a lock_value (fencing token) the lock is WATCHed and the write is only applied while the lock still holds
+    the token, otherwise StaleLeaseError is raised - a turn that lost its lease can not overwrite a newer turn """
+    if codec == "msgpack":
+        return await __save_msgpack_appstate_and_release_lock(r, lock_key, thread_id, appstate, lock_value)
+
+    async with r.pipeline(transaction=True) as pipe:
+        if lock_value is not None:
+            await __watch_lease(pipe, lock_key, lock_value)
+            pipe.multi()
+        queue_appstate_update(pipe, thread_id, appstate)
+        pipe.delete(lock_key)
+        try:
+            result = await pipe.execute()
+        except WatchError:
+            raise StaleLeaseError(f"lock {lock_key} changed while saving the state")
+    logger.debug("result of storing appstate and releasing lock in redis: %s", result)
+    return result
+
+
+async def save_summary_and_release_lock(r: Redis, lock_key: str, thread_id: str, summary: ConversationModel, summary_count: int,
+                                        codec: str = "json"):
+    """ replace the first summary_count messages of the saved thread with the summary and release the lock atomically.
+    the array is trimmed in place, so messages appended by concurrent turns are kept """
+    if codec == "msgpack":
+        return await __save_msgpack_summary_and_release_lock(r, lock_key, thread_id, summary, summary_count)
+
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.json().arrtrim(thread_id, "$.messages", summary_count, -1)
+        pipe.json().arrinsert(thread_id, "$.messages", 0, summary.model_dump(mode="json"))
+        pipe.json().numincrby(thread_id, "$.messages_count", 1 - summary_count)
+        pipe.delete(lock_key)
+        result = await pipe.execute()
+    logger.debug("result of storing summary and releasing lock in redis: %s", result)
+    return result
+
+
+async def __watch_lease(pipe, lock_key: str, lock_value, *keys: str):
+    """ WATCH the lock (and keys) and check that the lock still holds the fencing token """
+    await pipe.watch(lock_key, *keys)
+    holder = await pipe.get(lock_key)
+    if holder is None or (holder.decode() if isinstance(holder, bytes) else holder) != str(lock_value):
+        raise StaleLeaseError(f"lock {lock_key} is not held with token {lock_value}")
+
+
+async def __save_msgpack_appstate_and_release_lock(r: Redis, lock_key: str, thread_id: str, appstate: AppState,
+                                                   lock_value):
+    """ the msgpack state is rewritten as a whole. the new messages are appended to the saved state (not to the state
+    the turn loaded), so a summary written during the turn is kept - the same result as the JSON.ARRAPPEND update """
+    key = msgpack_state_key(thread_id)
+    async with r.pipeline(transaction=True) as pipe:
+        for _ in range(MAX_STATE_SAVE_ATTEMPTS):
+            if lock_value is not None:
+                await __watch_lease(pipe, lock_key, lock_value, key)
+            else:
+                await pipe.watch(key)
+            saved_state = await pipe.get(key)
+            state = __append_new_messages(saved_state, appstate)
+            pipe.multi()
+            pipe.set(key, encode_appstate(state))
+            pipe.delete(lock_key)
+            try:
+                result = await pipe.execute()
+            except WatchError:
+                # the lease is checked again on the next attempt
+                logger.info("state of thread %s changed while saving, retrying", thread_id)
+                continue
+            logger.debug("result of storing appstate and releasing lock in redis: %s", result)
+            return result
+    raise StaleLeaseError(f"state of thread {thread_id} kept changing while saving")
+
+
+async def __save_msgpack_summary_and_release_lock(r: Redis, lock_key: str, thread_id: str, summary: ConversationModel,
+                                                  summary_count: int):
+    key = msgpack_state_key(thread_id)
+    async with r.pipeline(transaction=True) as pipe:
+        for _ in range(MAX_STATE_SAVE_ATTEMPTS):
+            # a turn saved while the summary was written, read the state again
+            await pipe.watch(key)
+            saved_state = await pipe.get(key)
+            if saved_state is None:
+                await pipe.reset()
+                await r.delete(lock_key)
+                return None
+            state = decode_appstate(saved_state)
+            state.messages = [summary] + state.messages[summary_count:]
+            state.messages_count += 1 - summary_count
+            pipe.multi()
+            pipe.set(key, encode_appstate(state))
+            pipe.delete(lock_key)
+            try:
+                result = await pipe.execute()
+            except WatchError:
+                continue
+            logger.debug("result of storing summary and releasing lock in redis: %s", result)
+            return result
+    raise WatchError(f"state of thread {thread_id} kept changing while saving the summary")
+
+
+def __append_new_messages(saved_state: Optional[bytes], appstate: AppState) -> AppState:
+    if saved_state is None or appstate.messages_count == 0:
+        # nothing saved for this thread yet
+        messages = appstate.messages
+    else:
+        messages = decode_appstate(saved_state).messages + appstate.new_messages
+    return AppState.model_construct(thread_id=appstate.thread_id, user_message=appstate.user_message,
+                                    current_agent_name=appstate.current_agent_name, messages=messages,
+                                    messages_count=len(messages))
+
+
+async def __rehydrate_appstate(r: Redis, thread_id: str, async_sessionmaker: async_sessionmaker[AsyncSession],
+                               tail_size: int, codec: str = "json") -> AppState:
+    """ load the thread from the database and write it back to redis, so the incremental updates
+    (queue_appstate_update) apply to it. NX keeps a state written concurrently by another request """
+    appstate = await load_appstate_from_pg(async_sessionmaker, thread_id, tail_size)
+    if not appstate:
+        return AppState(thread_id=thread_id)
+    if codec == "msgpack":
+        await r.set(msgpack_state_key(thread_id), encode_appstate(appstate), nx=True)
+    else:
+        await r.json().set(thread_id, "$", appstate.model_dump(mode="json"), nx=True)
+    return appstate
+
+
+def __to_appstate(thread_id, saved_state) -> AppState:
     if not saved_state:
         return AppState(thread_id=thread_id)
+    if isinstance(saved_state, bytes):
+        return decode_appstate(saved_state)
     return AppState.model_validate(saved_state[0])
@@ -0,0 +1,106 @@
+# create the rm_conversation table and its monthly partitions
+# uv run python -m datastore.schema
+
+from dotenv import load_dotenv
+from datetime import date
+import asyncio
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from datastore.database import Conversation, metadata
+from utils.env_settings import EnvSettings
+
+logger = logging.getLogger(__name__)
+
+# rm_conversation for SQLite. the model's composite primary key (id, created_at) is meant for the partitioned
+# postgres table, SQLite only generates ids for a single INTEGER PRIMARY KEY column
+SQLITE_SCHEMA = """
+CREATE TABLE rm_conversation (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id CHAR(32) NOT NULL,
+    user_role VARCHAR(20) NOT NULL,
+    message TEXT,
+    summary TEXT,
+    tool_calls JSON,
+    tool_call_id VARCHAR(50),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+def __month_start(year: int, month: int) -> date:
+    # normalize month overflow, e.g. month 13 -> january of the next year
+    return date(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+async def create_schema(engine: AsyncEngine, months_ahead: int = 3):
+    """ create the tables and the partitions from the current month to months_ahead months ahead """
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    await ensure_partitions(engine, months_ahead)
+
+
+async def ensure_partitions(engine: AsyncEngine, months_ahead: int = 3):
+    """ create the monthly partitions of rm_conversation that do not exist yet, and a default partition
+    for rows outside of them. a no-op on databases other than postgres. runs daily in the worker
+    (maintain_partitions) - a month whose rows already landed in the default partition gets its partition by
+    moving the rows out of the default partition """
+    if engine.dialect.name != "postgresql":
+        return
+
+    table = Conversation.__tablename__
+    today = date.today()
+    async with engine.begin() as conn:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    for offset in range(months_ahead + 1):
+        start = __month_start(today.year, today.month + offset)
+        end = __month_start(today.year, today.month + offset + 1)
+        partition = f"{table}_y{start.year}m{start.month:02d}"
+        bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES {bounds}"))
+        except IntegrityError:
+            # the default partition has rows of the month
+            logger.warning("rows of %s are in %s_default, moving them to the new partition", partition, table)
+            await __attach_partition_from_default(engine, table, partition, start, end)
+    logger.info("partitions of %s created up to %d months ahead", table, months_ahead)
+
+
+async def __attach_partition_from_default(engine: AsyncEngine, table: str, partition: str, start: date, end: date):
+    """ create the partition standalone, move the rows of its range out of the default partition and attach it,
+    in one transaction """
+    in_range = f"created_at >= '{start.isoformat()}' AND created_at < '{end.isoformat()}'"
+    async with engine.begin() as conn:
+        await conn.execute(text(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        await conn.execute(text(f"INSERT INTO {partition} SELECT * FROM {table}_default WHERE {in_range}"))
+        await conn.execute(text(f"DELETE FROM {table}_default WHERE {in_range}"))
+        await conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {partition} "
+                                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"))
+
+
+async def maintain_partitions(engine: AsyncEngine, months_ahead: int = 3, interval: float = 86400):
+    """ roll the partitions forward every interval seconds, for long running processes. errors are logged and
+    retried on the next run """
+    while True:
+        try:
+            await ensure_partitions(engine, months_ahead)
+        except Exception as e:
+            logger.error("unable to create the partitions of %s: %s", Conversation.__tablename__, e)
+        await asyncio.sleep(interval)
+
+
+async def main():
+    settings = EnvSettings()
+    engine = create_async_engine(settings.database_url)
+    try:
+        await create_schema(engine)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
+from fastapi.responses import StreamingResponse
 import uvicorn
 import datetime
 from utils.models import ChatRequest, AppState, ConversationModel
@@ -7,11 +8,20 @@ from utils.resource_registry import ResourceRegistry
 import os
 from utils.env_settings import EnvSettings
 from agents.supervisor import SupervisorAgent
-from datastore.database import load_appstate_from_redis
-from redis import Redis
+from datastore.database import acquire_lock_and_load_appstate, save_appstate_and_release_lock, StaleLeaseError
+from redis.asyncio import Redis
 import logging
-from utils.background_task import run_background_tasks
+from utils.background_task import run_background_tasks, process_background_jobs, summarize_thread
+from utils.tracing import setup_tracing, span, server_timing, format_server_timing
+from utils.metrics import (render_metrics, CHAT_DURATION_CHAT, CHAT_DURATION_STREAM, THREAD_LOCK_CONFLICTS_CHAT,
+                           THREAD_LOCK_CONFLICTS_STREAM)
+from fastapi.responses import Response
+from utils.thread_turns import ThreadTurnQueue, ThreadLease, QueueFullError
+import time
+from functools import partial
 import traceback
+import json
+import asyncio
 
 load_dotenv()
 
@@ -28,6 +38,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# spans of the request pipeline (lock, retrieval, llm rounds, tool calls, persistence)
+setup_tracing(settings.tracing_exporter)
+
 
 async def lifespan(app: FastAPI):
     """ initialize singleton resources (mcp clients, ai clients, etc.) """
@@ -45,33 +58,80 @@ async def lifespan(app: FastAPI):
     try:
         logger.info("trying to connect to mcp server(s)...")
 
-        # setup mcp clients and load tools
-        for name, url in settings.mcp_servers.items():
-            logger.info("connecting to mcp server %s at %s...", name, url)
-            await resource_registry.setup_mcp_client(name, url, settings.mcp_server_api_key)
+        # setup mcp clients (concurrently) and load tools, the tool catalog is refreshed in the background
+        await resource_registry.setup_mcp_servers(
+            settings.mcp_servers, settings.mcp_server_api_key, connect_timeout=settings.mcp_connect_timeout,
+            refresh_ttl=settings.mcp_tools_refresh_ttl)
+
+        # limit concurrent tool calls per mcp server
+        resource_registry.setup_tool_call_limiter(
+            max_concurrent_calls_per_server=settings.mcp_max_concurrent_calls_per_server,
+            timeout=settings.mcp_tool_call_timeout)
 
         # setup openai client
         resource_registry.setup_openai_client(
-            url="https://api.deepseek.com", api_key=DEEPSEEK_API_KEY)
-
-        all_tools = []
-        # make all tools available to the main agent (for now)
-        for mcp_server_name, tools in resource_registry.tools_map.items():
-            all_tools.extend(tools)
+            url=settings.llm_base_url, api_key=DEEPSEEK_API_KEY)
 
-        # setup ai clients
+        # setup redis client
+        resource_registry.setup_redis_client(
+            host=settings.redis_host, port=settings.redis_port, db=settings.redis_db,
+            max_connections=settings.redis_max_connections, pool_timeout=settings.redis_pool_timeout,
+            state_codec=settings.state_codec)
+
+        # cache results of read-only tools in redis
+        resource_registry.setup_tool_result_cache(
+            default_ttl=settings.tool_cache_default_ttl, ttl_overrides=settings.tool_cache_ttls)
+
+        # keep the prompt of every LLM call within the token budget
+        resource_registry.setup_context_builder(
+            max_prompt_tokens=settings.context_max_prompt_tokens,
+            max_context_tokens=settings.context_max_retrieval_tokens,
+            max_tool_output_tokens=settings.context_max_tool_output_tokens,
+            tokenizer=settings.context_tokenizer)
+
+        # fold old turns of a thread into its running summary
+        resource_registry.setup_rolling_summary(
+            trigger_tokens=settings.summary_trigger_tokens, keep_recent_tokens=settings.summary_keep_recent_tokens,
+            max_window_tokens=settings.summary_max_window_tokens, tokenizer=settings.context_tokenizer)
+
+        # summarization can run on a cheaper (local) model than the supervisor
+        resource_registry.setup_summarization_backend(
+            settings.summarization_base_url, settings.summarization_api_key, settings.summarization_temperature)
+
+        # setup ai clients. all tools are available to the main agent (for now), sorted by name - the tool schemas
+        # are part of the cached prompt prefix, their order is stable across restarts and workers
         for name, model in settings.agents.items():
             logger.debug(
                 "setting up ai agent %s with model %s...", name, model)
             resource_registry.setup_ai_client(
-                name, resource_registry.openai_client, model, tools=all_tools)
+                name, resource_registry.openai_client, model, tools=resource_registry.tool_catalog.tools,
+                async_client=resource_registry.async_openai_client)
 
         # setup database engine
-        resource_registry.create_database_engine(settings.database_url)
-
-        # setup redis client
-        resource_registry.setup_redis_client(
-            host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+        resource_registry.create_database_engine(
+            settings.database_url, pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout, pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=settings.db_pool_pre_ping, statement_cache_size=settings.db_statement_cache_size)
+        resource_registry.setup_bulk_writer(
+            max_rows=settings.pg_bulk_writer_max_rows, flush_interval=settings.pg_bulk_writer_flush_interval)
+
+        # serialize the turns of a thread across requests and workers
+        resource_registry.setup_thread_turn_queue(
+            lease_ttl=settings.thread_lease_ttl, renew_interval=settings.thread_lease_renew_interval,
+            max_queue_depth=settings.thread_queue_max_depth, acquire_timeout=settings.thread_queue_timeout,
+            max_turn_duration=settings.thread_max_turn_duration)
+
+        # threads of many job batches are summarized together in scheduled passes
+        resource_registry.setup_summarization_scheduler(
+            partial(summarize_thread, resource_registry), interval=settings.summarization_interval,
+            max_concurrency=settings.summarization_max_concurrency)
+
+        # background jobs (persistence, summarization)
+        resource_registry.setup_job_queue(
+            backend=settings.job_queue_backend, handler=partial(process_background_jobs, resource_registry),
+            stream=settings.job_queue_stream, group=settings.job_queue_group,
+            batch_size=settings.job_queue_batch_size, max_retries=settings.job_queue_max_retries,
+            retry_backoff=settings.job_queue_retry_backoff, max_retry_backoff=settings.job_queue_max_retry_backoff)
 
         app.state.resources = resource_registry
         logger.info("server startup completed...")
@@ -92,76 +152,266 @@ async def lifespan(app: FastAPI):
 app = FastAPI(title="RM AI Agent Server", lifespan=lifespan)
 
 
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    """ trace the request and return the duration of its stages in the Server-Timing header.
+    for streamed responses only the stages before the first byte are included """
+    with server_timing() as timings:
+        with span("request", method=request.method, path=request.url.path):
+            response = await call_next(request)
+        response.headers["Server-Timing"] = format_server_timing(timings)
+    return response
+
+
 @app.get("/health")
 def health():
     logger.info("Server is healthy")
     return f"server is healthy current time is {datetime.datetime.now()}"
 
 
+@app.get("/metrics")
+def metrics():
+    """ prometheus metrics """
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@app.get("/stats/retrieval-cache")
+def retrieval_cache_stats(request: Request):
+    """ hit rate and size of the supervisor agent's retrieval cache """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    client: SupervisorAgent = resource_registry.ai_clients["supervisor_agent"]
+    return client.retrieval_cache.stats()
+
+
+@app.get("/stats/response-cache")
+def response_cache_stats(request: Request):
+    """ hit rate and size of the supervisor agent's semantic response cache, empty when it is disabled """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    client: SupervisorAgent = resource_registry.ai_clients["supervisor_agent"]
+    return client.response_cache.stats() if client.response_cache else {}
+
+
+@app.get("/stats/tool-calls")
+def tool_call_stats(request: Request):
+    """ queue wait and execution time per mcp server and tool """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.tool_call_limiter.stats()
+
+
+@app.get("/stats/tool-cache")
+def tool_cache_stats(request: Request):
+    """ hit rate of the read-only tool result cache """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.tool_result_cache.stats()
+
+
+@app.get("/stats/llm-usage")
+def llm_usage_stats(request: Request):
+    """ token usage, prompt cache hits and latency per model """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.llm_usage_stats.stats()
+
+
+@app.get("/stats/thread-queue")
+def thread_queue_stats(request: Request):
+    """ threads with queued turns in this worker """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.thread_turn_queue.stats()
+
+
+@app.get("/stats/mcp-servers")
+def mcp_server_stats(request: Request):
+    """ connected mcp servers and the state of the tool catalog refresh """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.mcp_server_pool.stats()
+
+
+@app.get("/stats/pools")
+def pool_stats(request: Request):
+    """ checked out connections, waiters and wait time of the database and redis connection pools """
+    resource_registry: ResourceRegistry = request.app.state.resources
+    return resource_registry.pool_stats()
+
+
 @app.post("/chat/{thread_id}", responses={
-    429: {"description": "Another request is being processed for this thread"},
-    500: {"description": "Error processing the request"}
+    409: {"description": "The turn lost the thread lease before its state was saved"},
+    429: {"description": "Too many messages are queued for this thread"},
+    500: {"description": "Error processing the request"},
+    503: {"description": "The turn did not get the thread within the queue timeout"}
 })
 async def chat(thread_id: str, data: ChatRequest, request: Request, background_tasks: BackgroundTasks):
     logger.info("chat function called with thread id: %s", thread_id)
+    started_at = time.perf_counter()
 
     resource_registry: ResourceRegistry = request.app.state.resources
 
-    # lock the thread
+    # always send the request to the main agent
+    client: SupervisorAgent = resource_registry.ai_clients["supervisor_agent"]
+    # start the retrieval right away so that it overlaps with the wait for the thread + state load
+    context_task = asyncio.create_task(client.aget_context(data.message))
+
+    # wait for the turns queued before this one, then lock the thread and load the saved state in one round-trip
     lock_key = f"thread_lock:{thread_id}"
     r: Redis = resource_registry.redis_client
-    # try to acquire lock, if lock is acquired proceed with processing the request, else return an error response indicating that another request is being processed for this thread
-    if r.set(lock_key, "processing", ex=60, nx=True):
+    with span("lock_and_load", thread_id=thread_id):
+        lease, saved_state = await __wait_for_turn(resource_registry, thread_id, lock_key, context_task,
+                                                   THREAD_LOCK_CONFLICTS_CHAT)
 
-        try:
-            logger.info("acquired lock for thread %s", thread_id)
-            # always send the request to the main agent
-            client: SupervisorAgent = resource_registry.ai_clients["supervisor_agent"]
+    try:
+        logger.info("acquired lock for thread %s (token %s)", thread_id, lease.token)
 
-            original_state = __load_appstate(thread_id, r, data)
-            working_state = original_state.model_copy(deep=True)
+        original_state = __load_appstate(saved_state, thread_id, data)
+        working_state = original_state.start_turn()
 
-            working_state = await client.orchestrate(working_state,
-                                                         mcp_client_map=resource_registry.mcp_clients)
+        working_state = await client.orchestrate(working_state,
+                                                 mcp_client_map=resource_registry.mcp_clients,
+                                                 context_task=context_task)
 
-            messages_count = len(working_state.messages)
-            working_state.messages_count = messages_count
+        # messages_count is left at the number of saved messages, the turn's messages are working_state.new_messages
+        messages_count = len(working_state.messages)
+
+        logger.debug("updated appstate %s", working_state)
+
+        logger.debug("old messages count %d, new messages count %d",
+                     original_state.messages_count, messages_count)
+
+        if messages_count <= original_state.messages_count:
+            return {"error": "failed to get response from agent"}
+
+        # append the new messages to the short term memory store (redis) and release the lock in one transaction,
+        # only while the lease still holds this turn's fencing token
+        with span("save_state", thread_id=thread_id):
+            await save_appstate_and_release_lock(r, lock_key, thread_id, working_state, lock_value=lease.token,
+                                                 codec=resource_registry.state_codec)
+        lease.released = True
+        logger.info("saved state and released lock for thread %s", thread_id)
+
+        # summarize the messages
+        # persist messages to the long term memory store (database)
+        background_tasks.add_task(
+            run_background_tasks, resource_registry, working_state)
+
+        return {"message": working_state.messages[-1].content}
+    except StaleLeaseError as e:
+        logger.error("turn of thread %s lost its lease: %s", thread_id, e)
+        raise HTTPException(
+            status_code=409, detail="the turn took too long and lost the thread, please send the message again")
+    except Exception as e:
+        logger.error("error in chat endpoint: %s", e)
+        traceback.print_exc()
+        raise HTTPException(
+            status_code=500, detail=f"error processing the request: {e}")
+    finally:
+        await resource_registry.thread_turn_queue.release(lease)
+        logger.info("released lock for thread %s", thread_id)
+        CHAT_DURATION_CHAT.observe(time.perf_counter() - started_at)
+
+
+@app.post("/chat/{thread_id}/stream", responses={
+    429: {"description": "Too many messages are queued for this thread"},
+    503: {"description": "The turn did not get the thread within the queue timeout"}
+})
+async def chat_stream(thread_id: str, data: ChatRequest, request: Request, background_tasks: BackgroundTasks):
+    """ server-sent events variant of /chat/{thread_id}. streams assistant tokens and tool progress as they arrive """
+    logger.info("chat stream function called with thread id: %s", thread_id)
+    started_at = time.perf_counter()
 
-            logger.debug(f"updated appstate {working_state}")
+    resource_registry: ResourceRegistry = request.app.state.resources
+
+    client: SupervisorAgent = resource_registry.ai_clients["supervisor_agent"]
+    # start the retrieval right away so that it overlaps with the wait for the thread + state load
+    context_task = asyncio.create_task(client.aget_context(data.message))
+
+    # lock the thread. the lock is held until the stream completes
+    lock_key = f"thread_lock:{thread_id}"
+    r: Redis = resource_registry.redis_client
+    with span("lock_and_load", thread_id=thread_id):
+        lease, saved_state = await __wait_for_turn(resource_registry, thread_id, lock_key, context_task,
+                                                   THREAD_LOCK_CONFLICTS_STREAM)
+
+    logger.info("acquired lock for thread %s (token %s)", thread_id, lease.token)
+
+    async def event_stream():
+        try:
+            original_state = __load_appstate(saved_state, thread_id, data)
+            working_state = original_state.start_turn()
+
+            async for event in client.orchestrate_stream(working_state, mcp_client_map=resource_registry.mcp_clients,
+                                                         context_task=context_task):
+                yield __format_sse(event)
 
-            logger.debug("old messages count %d, new messages count %d",
-                         original_state.messages_count, working_state.messages_count)
+            # messages_count is left at the number of saved messages, the turn's messages are working_state.new_messages
+            messages_count = len(working_state.messages)
 
             if messages_count <= original_state.messages_count:
-                return {"error": "failed to get response from agent"}
+                yield __format_sse({"type": "error", "detail": "failed to get response from agent"})
+                return
+
+            with span("save_state", current=False, thread_id=thread_id):
+                await save_appstate_and_release_lock(r, lock_key, thread_id, working_state, lock_value=lease.token,
+                                                     codec=resource_registry.state_codec)
+            lease.released = True
+            logger.info("saved state and released lock for thread %s", thread_id)
 
-            # summarize the messages
-            # persist messages to the long term and short term memory stores (database and redis)
+            # background tasks run once the stream has been fully sent
             background_tasks.add_task(
                 run_background_tasks, resource_registry, working_state)
 
-            return {"message": working_state.messages[-1].content}
+            yield __format_sse({"type": "done", "message": working_state.messages[-1].content})
+        except StaleLeaseError as e:
+            logger.error("turn of thread %s lost its lease: %s", thread_id, e)
+            yield __format_sse({"type": "error",
+                                "detail": "the turn took too long and lost the thread, please send the message again"})
         except Exception as e:
-            logger.error("error in chat endpoint: %s", e)
+            logger.error("error in chat stream endpoint: %s", e)
             traceback.print_exc()
-            raise HTTPException(
-                status_code=500, detail=f"error processing the request: {e}")
+            yield __format_sse({"type": "error", "detail": f"error processing the request: {e}"})
         finally:
-            r.delete(lock_key)
+            await resource_registry.thread_turn_queue.release(lease)
             logger.info("released lock for thread %s", thread_id)
-    else:
-        logger.warning(
-            f"failed to acquire lock for thread {thread_id}, another request is being processed for this thread")
+            CHAT_DURATION_STREAM.observe(time.perf_counter() - started_at)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", background=background_tasks,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def __wait_for_turn(resource_registry: ResourceRegistry, thread_id: str, lock_key: str,
+                          context_task: asyncio.Task, rejected_counter) -> tuple[ThreadLease, AppState]:
+    """ queue the turn behind the turns already running or waiting for the thread, then take the thread lease
+    and load the saved state. the queue depth is bounded, a turn is rejected when the queue is full """
+    turn_queue: ThreadTurnQueue = resource_registry.thread_turn_queue
+    try_acquire = partial(acquire_lock_and_load_appstate, resource_registry.redis_client, lock_key, thread_id,
+                          async_sessionmaker=resource_registry.async_session,
+                          tail_size=settings.history_rehydrate_messages, codec=resource_registry.state_codec)
+    try:
+        return await turn_queue.acquire(thread_id, lock_key, try_acquire)
+    except QueueFullError as e:
+        rejected_counter.inc()
+        context_task.cancel()
+        logger.warning("rejected message for thread %s: %s", thread_id, e)
+        raise HTTPException(
+            status_code=429, detail="too many messages are queued for this thread, please try again later")
+    except TimeoutError:
+        rejected_counter.inc()
+        context_task.cancel()
+        logger.warning("message for thread %s timed out waiting for the thread", thread_id)
         raise HTTPException(
-            status_code=429, detail="another request is being processed for this thread, please try again later")
+            status_code=503, detail="the thread is busy, please try again later")
+    except BaseException:
+        context_task.cancel()
+        raise
+
 
+def __format_sse(event: dict) -> str:
+    """ format an event as a server-sent event """
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
 
-def __load_appstate(thread_id: str, r: Redis, data: ChatRequest) -> AppState:
 
-    app_state = load_appstate_from_redis(r, thread_id)
+def __load_appstate(app_state: AppState, thread_id: str, data: ChatRequest) -> AppState:
+    """ add the user message to the state loaded from redis """
 
-    history = app_state.messages or []
-    messages_count = len(history)
+    messages_count = len(app_state.messages)
 
     logger.debug("length of history: %s", messages_count)
 
@@ -171,11 +421,11 @@ def __load_appstate(thread_id: str, r: Redis, data: ChatRequest) -> AppState:
     app_state.messages_count = messages_count
     app_state.user_message = data.message
 
-    messages = history + [user_message]
-    app_state.messages = messages
+    # the loaded list belongs to this request, append instead of copying the history
+    app_state.messages.append(user_message)
     app_state.current_agent_name = "supervisor_agent"
 
-    logger.debug(f"history {messages}")
+    logger.debug("history %s", app_state.messages)
     return app_state
 
 
@@ -0,0 +1,60 @@
+""" python -m unittest discover tests (from agents/rm_agent), needs aiosqlite """
+
+import unittest
+import uuid
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from datastore.database import load_appstate_from_pg, save_messages_batch_to_pg
+from datastore.schema import SQLITE_SCHEMA
+from utils.models import ConversationModel
+from utils.rolling_summary import SummaryWindow
+
+
+class RehydrateTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://")
+        async with self.engine.begin() as conn:
+            await conn.execute(text(SQLITE_SCHEMA))
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.thread_id = uuid.uuid4()
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    def turns(self, count: int) -> list[ConversationModel]:
+        started_at = datetime.now(timezone.utc)
+        messages = []
+        for turn in range(count):
+            for role, prefix in (("user", "q"), ("assistant", "a")):
+                messages.append(ConversationModel(thread_id=self.thread_id, role=role, content=f"{prefix}{turn}",
+                                                  created_at=started_at + timedelta(seconds=len(messages))))
+        return messages
+
+    async def test_summary_and_kept_tail(self):
+        messages = self.turns(12)
+        # the summary is written after all turns, but covers only the first 18 messages (q0..a8)
+        summary = SummaryWindow(previous_summary=None, replace_count=18, window=messages[:18]) \
+            .summary_message(self.thread_id, "S")
+        await save_messages_batch_to_pg(self.sessionmaker, messages + [summary])
+
+        appstate = await load_appstate_from_pg(self.sessionmaker, str(self.thread_id))
+
+        self.assertEqual([message.content for message in appstate.messages],
+                         ["S", "q9", "a9", "q10", "a10", "q11", "a11"])
+        self.assertEqual(appstate.messages_count, 7)
+
+    async def test_tail_size_starts_at_user_message(self):
+        await save_messages_batch_to_pg(self.sessionmaker, self.turns(3))
+
+        appstate = await load_appstate_from_pg(self.sessionmaker, str(self.thread_id), tail_size=3)
+
+        self.assertEqual([message.content for message in appstate.messages], ["q2", "a2"])
+
+    async def test_unknown_thread(self):
+        self.assertIsNone(await load_appstate_from_pg(self.sessionmaker, str(uuid.uuid4())))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,109 +1,120 @@
-from datastore.database import save_messages_to_pg, save_messages_to_pg, save_appstate_to_redis
+from datastore.database import save_messages_to_pg, save_messages_batch_to_pg, save_summary_and_release_lock, load_appstate_from_redis
 from agents.summarization_agent import SummarizationAgent
 from utils.resource_registry import ResourceRegistry
 from utils.models import AppState, ConversationModel
+from utils.rolling_summary import SummaryWindow
+from utils.tracing import span
+from utils.metrics import SUMMARIZATION_SUMMARIZED, SUMMARIZATION_LOCK_BUSY, SUMMARIZATION_FAILED
 import logging
 import traceback
 
 logger = logging.getLogger(__name__)
 
-SUMMARY_THRESHOLD = 10
-NUMBER_OF_MESSAGES_SUMMARIZE = 5
 AGENT_NAME = "summarization_agent"
 
 
 async def run_background_tasks(resource_registry: ResourceRegistry, appstate: AppState):
-    """ function to run background tasks for summarizing messages and saving messages to database and redis. this function is called in the chat endpoint after getting response from the agent and before returning the response to the user. """
+    """ enqueue the post-turn work (persist the new messages, summarize the thread) to the background job queue.
+    called in the chat endpoint after the state is saved to redis. the jobs are processed by process_background_jobs,
+    in the worker (worker.py) or in-process when the local queue is used """
+
+    job = {
+        "type": "persist_turn",
+        "thread_id": appstate.thread_id,
+        # persist only the new messages. trim the history from the messages list
+        "messages": [message.model_dump(mode="json") for message in appstate.new_messages],
+    }
+    with span("enqueue_job", thread_id=appstate.thread_id):
+        await resource_registry.job_queue.enqueue(job)
+
+
+async def process_background_jobs(resource_registry: ResourceRegistry, jobs: list[dict]):
+    """ process a batch of jobs from many threads. the new messages of all jobs are saved in PG for long term memory
+    with one COPY (or one transaction), then each thread is summarized once. an error saving to PG fails (and retries) the whole batch """
+
+    messages = [ConversationModel.model_validate(message)
+                for job in jobs for message in job["messages"]]
+    if messages:
+        with span("persist", jobs=len(jobs), messages=len(messages)):
+            if resource_registry.bulk_writer:
+                await resource_registry.bulk_writer.add(messages)
+            else:
+                await save_messages_batch_to_pg(resource_registry.async_session, messages)
+
+    thread_ids = list(dict.fromkeys(job["thread_id"] for job in jobs))
+    if resource_registry.summarization_scheduler is not None:
+        # summarized in the next scheduled pass, together with the threads of other batches
+        resource_registry.summarization_scheduler.schedule(thread_ids)
+        return
+
+    # summarization errors are logged, they must not retry the persisted messages
+    for thread_id in thread_ids:
+        try:
+            with span("summarize", thread_id=thread_id):
+                await summarize_thread(resource_registry, thread_id)
+        except Exception as e:
+            logger.error("unable to summarize thread %s: %s", thread_id, e)
+            traceback.print_exc()
 
-    thread_id = appstate.thread_id
-    # persist only the new messages. trim the history from the messages list
-    messages = appstate.messages[appstate.messages_count:]
-    # save messages in PG for long term memory and in Redis for short term memory
-    await save_messages_to_pg(resource_registry.async_session, thread_id, messages)
 
-    save_appstate_to_redis(
-        resource_registry.redis_client, thread_id, appstate)
+async def summarize_thread(resource_registry: ResourceRegistry, thread_id: str):
+    """ fold the oldest turns of the thread into its running summary once it has grown past the token trigger """
 
     lock_key = f"summary_lock:{thread_id}"
+    lock_released = False
     try:
         # lock the thread
-        if resource_registry.redis_client.set(lock_key, "processing", nx=True, ex=60):
-            logger.info("summarize messages...")
-            await __summarize_messages(resource_registry, appstate)
-        else:
+        if not await resource_registry.redis_client.set(lock_key, "processing", nx=True, ex=60):
             logger.warning("summarization is in progress already.. ")
+            # the lock belongs to another worker
+            lock_released = True
+            SUMMARIZATION_LOCK_BUSY.inc()
+            return
+
+        # the state is loaded under the lock - a window chosen before it could be stale once another worker has
+        # folded its summary, and replace_count would then drop messages that were never summarized
+        appstate = await load_appstate_from_redis(resource_registry.redis_client, thread_id,
+                                                  codec=resource_registry.state_codec)
+        if not appstate.messages:
+            logger.info("no messages found in redis for thread_id %s, skipping summarization", thread_id)
+            return
+
+        summary_window = resource_registry.rolling_summary_policy.select(appstate.messages)
+        if summary_window is None:
+            logger.debug("thread %s is below the summary trigger, skipping summarization", thread_id)
+            return
+
+        logger.info("summarize messages...")
+        await __fold_into_summary(resource_registry, thread_id, summary_window, lock_key)
+        lock_released = True
+        SUMMARIZATION_SUMMARIZED.inc()
     except Exception as e:
+        SUMMARIZATION_FAILED.inc()
         logger.error("unable to summarize messages %s", e)
         traceback.print_exc()
     finally:
-        resource_registry.redis_client.delete(lock_key)
-
-def __get_messages_to_summarize(appstate: AppState):
-    """ summarize messages for a given thread id and save the summary to the database and redis.
-    summarize when the total number of messages in the conversation thread exceeds a certain threshold (e.g. 10 messages), 
-    and include the most recent assistant message in the messages to be summarized, as that would likely contain the most relevant information for summarization.
-    """
-    # get messages for the thread id from redis
-    thread_id: str = appstate.thread_id
-    messages: list[ConversationModel] = appstate.messages
-    if not messages:
-        logger.info(
-            "no messages found in redis for thread_id %s, skipping summarization", thread_id)
-        return
-    messages_to_summarize: list[ConversationModel] = []
-    # fetch first 5 message for summarization
-    # make sure include the most recent assistant message in the messages to be summarized, as that would likely contain the most relevant information for summarization
-    if len(messages) >= SUMMARY_THRESHOLD:
-        index = 0
-        while index < len(messages):
-
-            messages_to_summarize.append(messages[index])
-
-            index += 1
-            if len(messages_to_summarize) >= NUMBER_OF_MESSAGES_SUMMARIZE and messages_to_summarize[-1].role == "user":
-                messages_to_summarize.remove(messages_to_summarize[-1])
-                return messages_to_summarize
-    else:
-        logger.debug(
-            "not enough messages to summarize for thread_id %s, skipping summarization", thread_id)
-    return messages_to_summarize
-
-
-async def __summarize_messages(resource_registry: ResourceRegistry, appstate: AppState):
-    # summarize messages if the number of messages in the conversation thread exceeds a certain threshold (e.g. 10 messages)
-    
-    thread_id: str = appstate.thread_id
-    messages_to_summarize: list = __get_messages_to_summarize(appstate)
-
-    logger.debug("message to summarize %s", messages_to_summarize)
-
-    if messages_to_summarize:
-
-        logger.debug("messages to summarize %s", messages_to_summarize)
+        if not lock_released:
+            await resource_registry.redis_client.delete(lock_key)
 
-        agent: SummarizationAgent = resource_registry.ai_clients[AGENT_NAME]
 
-        # call LLM to summarize messages
-        updated_appstate = agent.invoke_llm(context="", appstate=AppState(thread_id=appstate.thread_id,
-                                                                              messages=messages_to_summarize, current_agent_name=AGENT_NAME))
-        llm_summary = updated_appstate.messages[-1]
+async def __fold_into_summary(resource_registry: ResourceRegistry, thread_id: str, summary_window: SummaryWindow,
+                              lock_key: str):
+    """ update the running summary with the evicted window and replace both with the new summary """
 
-        logger.debug("summary %s", llm_summary.content)
+    logger.debug("messages to fold into the summary of thread %s: %s", thread_id, summary_window.window)
 
-        summary_count = len(messages_to_summarize)
+    agent: SummarizationAgent = resource_registry.ai_clients[AGENT_NAME]
+    # only the previous summary and the evicted window are sent, not the summarized history again
+    summary_text = await agent.afold_summary(thread_id, summary_window.previous_summary, summary_window.window)
 
-        summary = ConversationModel(thread_id=appstate.thread_id,
-                                    role="system", content=llm_summary.content, summary=llm_summary.content)
-        # save summary to pg
-        await save_messages_to_pg(resource_registry.async_session,
-                                      thread_id, [summary])
+    logger.debug("summary %s", summary_text)
 
-        # add summary to redis and trim old messages
-        available_messages = appstate.messages
-        updated_messages = available_messages[summary_count:]
+    summary = summary_window.summary_message(thread_id, summary_text)
+    # save summary to pg, the latest summary row of a thread covers everything before it
+    await save_messages_to_pg(resource_registry.async_session, thread_id, [summary])
 
-        updated_messages.insert(0, summary)
-        appstate.messages = updated_messages
-        appstate.messages_count = len(updated_messages)
-        save_appstate_to_redis(
-            resource_registry.redis_client, thread_id, appstate)
+    # replace the running summary and the window in redis with the new summary and release the summary lock
+    # in one round-trip
+    await save_summary_and_release_lock(
+        resource_registry.redis_client, lock_key, thread_id, summary, summary_window.replace_count,
+        codec=resource_registry.state_codec)
@@ -0,0 +1,162 @@
+import json
+import logging
+from collections import OrderedDict
+from typing import Optional
+from utils.models import ConversationModel
+
+logger = logging.getLogger(__name__)
+
+# fields of ConversationModel that are not sent to the LLM
+EXCLUDED_FIELDS = {"thread_id", "summary", "id", "created_at"}
+# role, separators etc. added by the chat template to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# rough estimate used when no tokenizer is configured
+CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    """ counts tokens with a local huggingface tokenizer (tokenizer.json path or hub id).
+    without a tokenizer the count is estimated from the number of characters.
+    counts are cached by the hash of the text, messages are re-sent on every LLM call of a thread """
+
+    def __init__(self, tokenizer: Optional[str] = None, cache_size: int = 10000):
+        self.cache_size = cache_size
+        self.__cache: OrderedDict[int, int] = OrderedDict()
+        self.__tokenizer = self.__load_tokenizer(tokenizer) if tokenizer else None
+
+    def __load_tokenizer(self, tokenizer: str):
+        from tokenizers import Tokenizer
+
+        if tokenizer.endswith(".json"):
+            return Tokenizer.from_file(tokenizer)
+        return Tokenizer.from_pretrained(tokenizer)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = hash(text)
+        if key in self.__cache:
+            self.__cache.move_to_end(key)
+            return self.__cache[key]
+
+        if self.__tokenizer is not None:
+            tokens = len(self.__tokenizer.encode(text, add_special_tokens=False).ids)
+        else:
+            tokens = len(text) // CHARS_PER_TOKEN + 1
+
+        self.__cache[key] = tokens
+        if len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """ keep the beginning of the text, at most max_tokens tokens """
+        if self.count(text) <= max_tokens:
+            return text
+        if self.__tokenizer is not None:
+            encoding = self.__tokenizer.encode(text, add_special_tokens=False)
+            end = encoding.offsets[max_tokens - 1][1] if max_tokens > 0 else 0
+            return text[:end]
+        return text[:max_tokens * CHARS_PER_TOKEN]
+
+
+class ContextBuilder:
+    """ fits the retrieved context and the conversation history into a prompt token budget.
+
+    - the retrieved context is truncated to max_context_tokens
+    - tool outputs are truncated to max_tool_output_tokens
+    - the current turn (from the last user message) is always sent. older turns are added newest first while they fit,
+      a turn that does not fit is compressed to its user message and final assistant answer, older turns are dropped
+    - leading summary (system) messages are kept when they fit
+    """
+
+    def __init__(self, max_prompt_tokens: int = 16000, max_context_tokens: int = 2000, max_tool_output_tokens: int = 2000,
+                 token_counter: TokenCounter = None):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_context_tokens = max_context_tokens
+        self.max_tool_output_tokens = max_tool_output_tokens
+        self.token_counter = token_counter or TokenCounter()
+
+    def fit_context(self, context: str) -> str:
+        """ truncate the retrieved context to its share of the budget """
+        return self.token_counter.truncate(context or "", self.max_context_tokens)
+
+    def fit_messages(self, system_prompt: str, messages: list[ConversationModel]) -> list[dict]:
+        """ select and convert the messages that fit the budget left after the system prompt """
+
+        budget = self.max_prompt_tokens - self.__count_text(system_prompt)
+
+        summaries, turns = self.__split_turns([self.__to_message(message) for message in messages])
+        if not turns:
+            return summaries
+
+        current_turn = turns.pop()
+        budget -= self.__count_messages(current_turn)
+        if budget < 0:
+            logger.warning("current turn exceeds the prompt token budget by %d tokens", -budget)
+
+        history: list[list[dict]] = []
+        for turn in reversed(turns):
+            tokens = self.__count_messages(turn)
+            if tokens > budget:
+                turn = self.__compress_turn(turn)
+                tokens = self.__count_messages(turn)
+                if tokens > budget:
+                    break
+            history.insert(0, turn)
+            budget -= tokens
+
+        dropped = len(turns) - len(history)
+        if dropped:
+            logger.debug("dropped %d old turns to fit the prompt token budget", dropped)
+
+        kept_summaries = []
+        for summary in summaries:
+            tokens = self.__count_message(summary)
+            if tokens <= budget:
+                kept_summaries.append(summary)
+                budget -= tokens
+
+        return kept_summaries + [message for turn in history for message in turn] + current_turn
+
+    def __to_message(self, message: ConversationModel) -> dict:
+        message_dict = message.model_dump(exclude=EXCLUDED_FIELDS)
+        if message.role == "tool" and message.content:
+            content = self.token_counter.truncate(message.content, self.max_tool_output_tokens)
+            if content != message.content:
+                message_dict["content"] = content + "\n... [truncated]"
+        return message_dict
+
+    def __split_turns(self, messages: list[dict]) -> tuple[list[dict], list[list[dict]]]:
+        """ leading system (summary) messages, and the remaining messages grouped into turns starting at a user message """
+        index = 0
+        while index < len(messages) and messages[index]["role"] == "system":
+            index += 1
+
+        turns: list[list[dict]] = []
+        for message in messages[index:]:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return messages[:index], turns
+
+    def __compress_turn(self, turn: list[dict]) -> list[dict]:
+        """ keep the user message and the final assistant answer, without the tool calls and tool outputs """
+        compressed = [message for message in turn[:1] if message["role"] == "user"]
+        answers = [message for message in turn if message["role"] == "assistant" and message.get("content")
+                   and not message.get("tool_calls")]
+        if answers:
+            compressed.append(answers[-1])
+        return compressed
+
+    def __count_messages(self, messages: list[dict]) -> int:
+        return sum(self.__count_message(message) for message in messages)
+
+    def __count_message(self, message: dict) -> int:
+        tokens = MESSAGE_OVERHEAD_TOKENS + self.__count_text(message.get("content"))
+        if message.get("tool_calls"):
+            tokens += self.__count_text(json.dumps(message["tool_calls"], sort_keys=True))
+        return tokens
+
+    def __count_text(self, text: Optional[str]) -> int:
+        return self.token_counter.count(text) if text else 0
@@ -1,17 +1,111 @@
 from pydantic_settings import BaseSettings
-from typing import Dict
+from typing import Dict, Literal, Optional
 
 
 class EnvSettings(BaseSettings):
 
     mcp_servers: Dict[str, str]
     agents: Dict[str, str]
-    chroma_cloud_api_key: str
-    chroma_tenant: str
-    chroma_database: str
-    hf_token: str
+    # openai compatible endpoint of the LLM provider, the api key is read from DEEPSEEK_API_KEY
+    llm_base_url: str = "https://api.deepseek.com"
+    # chroma cloud settings are not needed when the local vector index is used
+    chroma_cloud_api_key: Optional[str] = None
+    chroma_tenant: Optional[str] = None
+    chroma_database: Optional[str] = None
+    hf_token: Optional[str] = None
+    # directory of the local vector index written by the ingestion pipeline. replaces chroma cloud retrieval when set.
+    # retrieval is disabled when neither chroma cloud nor a local index is configured
+    local_index_dir: Optional[str] = None
     database_url: str
     redis_host: str = "localhost"
     redis_port: int = 6379
     redis_db: int = 0
+    # app state encoding in redis - "json" (RedisJSON, incremental updates) or "msgpack" (versioned binary blob)
+    state_codec: Literal["json", "msgpack"] = "json"
+    # redis connection pool - with a timeout, callers wait up to redis_pool_timeout seconds for a free connection
+    # instead of failing when all max connections are in use
+    redis_max_connections: int = 10
+    redis_pool_timeout: Optional[float] = None
+    # database connection pool (postgres). statement cache size 0 is needed behind pgbouncer in transaction mode
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_statement_cache_size: int = 100
     mcp_server_api_key: str
+    # retrieval cache (chroma search results)
+    retrieval_cache_size: int = 256
+    retrieval_cache_ttl: int = 3600
+    # sentence-transformers model used for near duplicate hits. near duplicate lookup is disabled when not set
+    retrieval_cache_embedding_model: Optional[str] = None
+    retrieval_cache_similarity_threshold: float = 0.95
+    retrieval_cache_version_check_interval: int = 60
+    # semantic cache of the answers of tool-free first turns (opt-in). a message gets the cached answer of a question
+    # whose embedding is at least the similarity threshold close. entries expire after the TTL (seconds) and are
+    # invalidated when the knowledge base is re-ingested
+    response_cache_enabled: bool = False
+    response_cache_embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+    response_cache_size: int = 1024
+    response_cache_ttl: int = 86400
+    response_cache_similarity_threshold: float = 0.95
+    # mcp tool calls - max concurrent calls per mcp server and deadline (seconds) per call
+    mcp_max_concurrent_calls_per_server: int = 4
+    mcp_tool_call_timeout: float = 30
+    # mcp servers are connected concurrently at startup, each within this timeout (seconds). servers that are down
+    # are skipped and reconnected by the catalog refresh
+    mcp_connect_timeout: float = 10
+    # the tool catalog is reloaded from all mcp servers every TTL seconds (0 disables) and on tools/list_changed
+    mcp_tools_refresh_ttl: float = 300
+    # tool result cache for read-only mcp tools - default TTL (seconds) and per tool overrides (0 disables a tool)
+    tool_cache_default_ttl: int = 300
+    tool_cache_ttls: Dict[str, int] = {}
+    # prompt token budget of the supervisor agent. the tokenizer is a tokenizer.json path or a huggingface hub id,
+    # token counts are estimated from the text length when not set
+    context_max_prompt_tokens: int = 16000
+    context_max_retrieval_tokens: int = 2000
+    context_max_tool_output_tokens: int = 2000
+    context_tokenizer: Optional[str] = None
+    # tracing exporter - "otlp" (configured with the OTEL_EXPORTER_OTLP_* env vars), "console" or "memory". off when not set
+    tracing_exporter: Optional[str] = None
+    # port of the prometheus /metrics endpoint of worker.py, off when not set
+    worker_metrics_port: Optional[int] = None
+    # turns of a thread are queued (FIFO per worker) instead of rejected. the thread lease expires after
+    # thread_lease_ttl seconds unless renewed, a turn gives up after waiting thread_queue_timeout seconds
+    thread_lease_ttl: int = 30
+    thread_lease_renew_interval: float = 10
+    thread_queue_max_depth: int = 8
+    thread_queue_timeout: float = 120
+    thread_max_turn_duration: float = 600
+    # rolling summary - once the messages after the running summary exceed the trigger (tokens), the oldest turns are
+    # folded into the summary until keep recent tokens are left, at most max window tokens per summarization run
+    summary_trigger_tokens: int = 2000
+    summary_keep_recent_tokens: int = 800
+    summary_max_window_tokens: int = 4000
+    # summarization backend - any OpenAI compatible endpoint, e.g. a local Ollama model (http://localhost:11434/v1 with
+    # AGENTS={..., "summarization_agent": "llama3.2:3b"}). the supervisor's LLM provider is used when not set
+    summarization_base_url: Optional[str] = None
+    summarization_api_key: str = "ollama"
+    # unset keeps the summarization agent's default temperature (1.6), e.g. 0.3 for a small local model
+    summarization_temperature: Optional[float] = None
+    # threads to summarize are collected and summarized in one pass every interval (seconds), max concurrency at a time
+    summarization_interval: float = 5
+    summarization_max_concurrency: int = 4
+    # background jobs (persistence, summarization) - "redis" (redis stream, consumed by worker.py) or "local" (in-process)
+    job_queue_backend: Literal["redis", "local"] = "redis"
+    job_queue_stream: str = "rm_agent:jobs"
+    job_queue_group: str = "rm_agent_workers"
+    job_queue_batch_size: int = 50
+    job_queue_max_retries: int = 3
+    # failed jobs are retried after an exponential backoff - backoff seconds, doubled per attempt up to the max
+    job_queue_retry_backoff: float = 1
+    job_queue_max_retry_backoff: float = 60
+    # seconds the ids of processed jobs are kept, a redelivered job within this time is skipped
+    job_queue_dedup_ttl: int = 86400
+    # bulk COPY writer for conversation history, flushes on whichever threshold is hit first
+    pg_bulk_writer_max_rows: int = 5000
+    pg_bulk_writer_flush_interval: float = 0.2
+    # seconds between the runs of the worker that create the next monthly partitions of the conversation table
+    partition_maintenance_interval: float = 86400
+    # number of recent messages loaded from PG (after the latest summary) when redis does not have the thread
+    history_rehydrate_messages: int = 20
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+from typing import Awaitable, Callable, Optional
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+# processes a batch of jobs. raising an exception retries the whole batch
+JobHandler = Callable[[list[dict]], Awaitable[None]]
+
+# moves the retries that are due from the delayed set to the stream. atomic, so a retry is moved by one worker only
+MOVE_DUE_RETRIES_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, payload in ipairs(due) do
+    redis.call('XADD', KEYS[2], '*', 'payload', payload)
+    redis.call('ZREM', KEYS[1], payload)
+end
+return #due
+"""
+
+
+def retry_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """ exponential backoff - backoff seconds before the first retry, doubled for every further attempt """
+    return min(max_backoff, backoff * 2 ** (attempt - 1))
+
+
+class LocalJobQueue:
+    """ in-process job queue. used when redis streams are not available (or not configured).
+    failed jobs are queued again after an exponential backoff. jobs are lost on restart """
+
+    def __init__(self, handler: JobHandler, batch_size: int = 50, max_retries: int = 3, retry_backoff: float = 1,
+                 max_retry_backoff: float = 60):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__task: asyncio.Task = None
+        # retries waiting for their backoff
+        self.__delayed: set[asyncio.Task] = set()
+
+    async def enqueue(self, job: dict):
+        await self.__queue.put(job)
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        """ process the jobs that are already queued (and their retries), then stop the worker """
+        if self.__task is None:
+            return
+        await self.__queue.join()
+        while self.__delayed:
+            await asyncio.gather(*self.__delayed)
+            await self.__queue.join()
+        self.__task.cancel()
+        self.__task = None
+
+    async def __run(self):
+        while True:
+            # wait for the first job, then take whatever else is already queued (up to the batch size)
+            jobs = [await self.__queue.get()]
+            while len(jobs) < self.batch_size and not self.__queue.empty():
+                jobs.append(self.__queue.get_nowait())
+            try:
+                await self.handler(jobs)
+            except Exception as e:
+                logger.error("error processing %d jobs: %s", len(jobs), e)
+                traceback.print_exc()
+                for job in jobs:
+                    attempt = job.get("attempt", 0) + 1
+                    if attempt <= self.max_retries:
+                        self.__retry_later({**job, "attempt": attempt})
+                    else:
+                        logger.error("dropping job after %d attempts: %s", attempt, job)
+            finally:
+                for _ in jobs:
+                    self.__queue.task_done()
+
+    def __retry_later(self, job: dict):
+        delay = retry_delay(job["attempt"], self.retry_backoff, self.max_retry_backoff)
+
+        async def requeue():
+            await asyncio.sleep(delay)
+            await self.__queue.put(job)
+
+        task = asyncio.create_task(requeue())
+        self.__delayed.add(task)
+        task.add_done_callback(self.__delayed.discard)
+
+
+class RedisStreamJobQueue:
+    """ durable job queue on a redis stream with a consumer group.
+
+    - the api enqueues with XADD, workers (worker.py) consume in batches with XREADGROUP and XACK once processed
+    - failed jobs wait in a sorted set (score: due time) for an exponential backoff and are then moved back to the
+      stream with an incremented attempt, after max_retries they go to the dead letter stream
+    - entries left pending by a crashed worker are claimed (XAUTOCLAIM) once they are idle for claim_idle_ms,
+      checked every claim_idle_ms whether or not the queue is busy
+    - entries without a readable payload (deleted, trimmed or not JSON) are acknowledged and kept in the dead
+      letter stream
+    - delivery is at-least-once. every job gets a job_id, and the ids of processed jobs are remembered for
+      dedup_ttl seconds, so a redelivered entry (e.g. claimed after its worker crashed before the XACK) is
+      skipped. a crash between the handler and the done marker can still repeat a job, handlers must tolerate
+      that - persist_turn may then save a turn twice, summarization works on the current state of the thread
+    - errors of the loop itself (e.g. redis not reachable) are retried with exponential backoff
+    - when XADD fails the job is handed to the local fallback queue, if any
+    """
+
+    def __init__(self, redis_client: Redis, handler: JobHandler, stream: str = "rm_agent:jobs",
+                 group: str = "rm_agent_workers", consumer: str = None, batch_size: int = 50,
+                 block_ms: int = 1000, max_retries: int = 3, claim_idle_ms: int = 60000,
+                 retry_backoff: float = 1, max_retry_backoff: float = 60, dedup_ttl: int = 86400,
+                 fallback: LocalJobQueue = None):
+        self.redis_client = redis_client
+        self.handler = handler
+        self.stream = stream
+        self.dead_letter_stream = f"{stream}:dead"
+        self.delayed_retries = f"{stream}:delayed"
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.max_retries = max_retries
+        self.claim_idle_ms = claim_idle_ms
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.dedup_ttl = dedup_ttl
+        self.fallback = fallback
+        self.__move_due_retries = redis_client.register_script(MOVE_DUE_RETRIES_SCRIPT)
+
+    async def enqueue(self, job: dict):
+        job = {"job_id": uuid.uuid4().hex, **job}
+        try:
+            await self.redis_client.xadd(self.stream, {"payload": json.dumps(job)})
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            logger.warning("unable to enqueue job to redis stream %s, using the local queue: %s", self.stream, e)
+            await self.fallback.enqueue(job)
+
+    async def create_group(self):
+        try:
+            await self.redis_client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            # the group already exists
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def consume_forever(self):
+        """ worker loop """
+        logger.info("consuming jobs from %s as %s/%s", self.stream, self.group, self.consumer)
+        group_created = False
+        # the first iteration picks up the entries left behind by crashed workers
+        claimed_at = 0.0
+        failures = 0
+        while True:
+            try:
+                if not group_created:
+                    await self.create_group()
+                    group_created = True
+                if time.monotonic() - claimed_at >= self.claim_idle_ms / 1000:
+                    await self.__claim_stale_entries()
+                    claimed_at = time.monotonic()
+                await self.__move_due_retries(keys=[self.delayed_retries, self.stream],
+                                              args=[time.time(), self.batch_size])
+                response = await self.redis_client.xreadgroup(self.group, self.consumer, {self.stream: ">"},
+                                                              count=self.batch_size, block=self.block_ms)
+                entries = response[0][1] if response else []
+                if entries:
+                    await self.__process(entries)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = retry_delay(failures, self.retry_backoff, self.max_retry_backoff)
+                logger.error("job queue loop failed (%d in a row), retrying in %.1f s: %r", failures, delay, e)
+                await asyncio.sleep(delay)
+
+    async def __claim_stale_entries(self):
+        start_id = "0-0"
+        while True:
+            result = await self.redis_client.xautoclaim(self.stream, self.group, self.consumer,
+                                                        min_idle_time=self.claim_idle_ms, start_id=start_id,
+                                                        count=self.batch_size)
+            start_id, entries = result[0], result[1]
+            if entries:
+                logger.info("claimed %d stale jobs", len(entries))
+                await self.__process(entries)
+            if not entries or start_id in ("0-0", b"0-0"):
+                return
+
+    async def __process(self, entries: list):
+        entry_ids = [entry_id for entry_id, _ in entries]
+        jobs, unreadable = [], []
+        for entry_id, fields in entries:
+            job = self.__decode(entry_id, fields)
+            if job is None:
+                unreadable.append((entry_id, fields))
+            else:
+                jobs.append(job)
+        jobs = await self.__skip_processed(jobs)
+
+        if jobs:
+            try:
+                await self.handler(jobs)
+            except Exception as e:
+                logger.error("error processing %d jobs: %s", len(jobs), e)
+                traceback.print_exc()
+                await self.__retry(jobs)
+            else:
+                await self.__mark_processed(jobs)
+        # processed, skipped, dead-lettered or re-added for retry, either way these entries are done
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for entry_id, fields in unreadable:
+                pipe.xadd(self.dead_letter_stream, {"entry_id": entry_id, "payload": str(fields)})
+            pipe.xack(self.stream, self.group, *entry_ids)
+            pipe.xdel(self.stream, *entry_ids)
+            await pipe.execute()
+
+    def __decode(self, entry_id, fields: Optional[dict]) -> Optional[dict]:
+        """ the job of a stream entry, None for an entry that was deleted (nil fields) or has no valid payload """
+        try:
+            payload = fields.get(b"payload") or fields.get("payload")
+            job = json.loads(payload)
+            if isinstance(job, dict):
+                return job
+            raise ValueError("the payload is not an object")
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.error("moving unreadable job entry %s to %s: %r", entry_id, self.dead_letter_stream, e)
+            return None
+
+    def __done_key(self, job_id: str) -> str:
+        return f"{self.stream}:done:{job_id}"
+
+    async def __skip_processed(self, jobs: list[dict]) -> list[dict]:
+        """ drop the jobs processed already, e.g. redelivered after a worker crashed before acknowledging them """
+        job_ids = [job["job_id"] for job in jobs if "job_id" in job]
+        if not job_ids:
+            return jobs
+        done = {job_id for job_id, marker in zip(job_ids, await self.redis_client.mget(
+            [self.__done_key(job_id) for job_id in job_ids])) if marker is not None}
+        if done:
+            logger.info("skipping %d jobs that were processed already", len(done))
+        return [job for job in jobs if job.get("job_id") not in done]
+
+    async def __mark_processed(self, jobs: list[dict]):
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for job in jobs:
+                if "job_id" in job:
+                    pipe.set(self.__done_key(job["job_id"]), 1, ex=self.dedup_ttl)
+            await pipe.execute()
+
+    async def __retry(self, jobs: list[dict]):
+        now = time.time()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for job in jobs:
+                attempt = job.get("attempt", 0) + 1
+                if attempt > self.max_retries:
+                    logger.error("moving job to %s after %d attempts", self.dead_letter_stream, attempt)
+                    pipe.xadd(self.dead_letter_stream, {"payload": json.dumps({**job, "attempt": attempt})})
+                    continue
+                not_before = now + retry_delay(attempt, self.retry_backoff, self.max_retry_backoff)
+                # not_before also keeps the members of identical jobs apart in the sorted set
+                pipe.zadd(self.delayed_retries,
+                          {json.dumps({**job, "attempt": attempt, "not_before": not_before}): not_before})
+            await pipe.execute()
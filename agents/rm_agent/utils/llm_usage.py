@@ -0,0 +1,71 @@
+import logging
+from collections import defaultdict
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class LLMUsage:
+    """ token usage and latency of the LLM calls of a single model """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt tokens served from the provider's prompt (prefix) cache
+        self.cache_hit_tokens = 0
+        self.latency_total = 0.0
+        self.latency_total_with_cache_hit = 0.0
+        self.calls_with_cache_hit = 0
+
+    def record(self, prompt_tokens: int, completion_tokens: int, cache_hit_tokens: int, latency: float):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cache_hit_tokens += cache_hit_tokens
+        self.latency_total += latency
+        if cache_hit_tokens:
+            self.calls_with_cache_hit += 1
+            self.latency_total_with_cache_hit += latency
+
+    def to_dict(self) -> dict:
+        calls_without_cache_hit = self.calls - self.calls_with_cache_hit
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_tokens": self.cache_hit_tokens,
+            "cache_hit_ratio": self.cache_hit_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "latency_avg_ms": self.latency_total / self.calls * 1000 if self.calls else 0.0,
+            "latency_avg_ms_with_cache_hit": self.latency_total_with_cache_hit / self.calls_with_cache_hit * 1000
+            if self.calls_with_cache_hit else 0.0,
+            "latency_avg_ms_without_cache_hit": (self.latency_total - self.latency_total_with_cache_hit)
+            / calls_without_cache_hit * 1000 if calls_without_cache_hit else 0.0,
+        }
+
+
+class LLMUsageStats:
+    """ per model token usage reported by the provider, including prompt cache hits. shared by all agents """
+
+    def __init__(self):
+        self.__usage: Dict[str, LLMUsage] = defaultdict(LLMUsage)
+
+    def record(self, model: str, usage, latency: float):
+        """ record the usage of a chat completion response (or the last chunk of a stream) """
+        if usage is None:
+            return
+        cache_hit_tokens = self.cache_hit_tokens(usage)
+        self.__usage[model].record(usage.prompt_tokens or 0, usage.completion_tokens or 0, cache_hit_tokens, latency)
+        logger.debug("llm call %s: prompt tokens %s, cache hit tokens %s, completion tokens %s, latency %.1f ms",
+                     model, usage.prompt_tokens, cache_hit_tokens, usage.completion_tokens, latency * 1000)
+
+    @staticmethod
+    def cache_hit_tokens(usage) -> int:
+        """ deepseek reports prompt_cache_hit_tokens, openai prompt_tokens_details.cached_tokens """
+        cache_hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cache_hit_tokens is None and getattr(usage, "prompt_tokens_details", None) is not None:
+            cache_hit_tokens = usage.prompt_tokens_details.cached_tokens
+        return cache_hit_tokens or 0
+
+    def stats(self) -> dict:
+        return {model: usage.to_dict() for model, usage in self.__usage.items()}
@@ -0,0 +1,82 @@
+import json
+import os
+import logging
+from typing import Callable, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.npy"
+SIDECAR_FILE = "index.json"
+POINTER_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+
+
+def current_version(index_dir: str) -> Optional[str]:
+    """ version published in the CURRENT pointer of the index directory, None for an index without one """
+    try:
+        with open(os.path.join(index_dir, POINTER_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class LocalVectorIndex:
+    """ local, memory-mapped vector index built by the ingestion pipeline (see lg_app_util/rm_agent_util/ingestion/local_index.py).
+
+    embeddings are L2 normalized, so a single matrix product gives the cosine similarity of a batch of queries
+    against every document. scores are returned as cosine distance (1 - similarity) to match Chroma's ranking.
+
+    the version named by the CURRENT pointer is loaded. an instance never changes, reload by creating a new one
+    when current_version(index_dir) differs from version. indexes written before the pointer existed (the two
+    files directly in index_dir) are still loaded.
+    """
+
+    def __init__(self, index_dir: str, embed: Callable[[list[str]], np.ndarray] = None):
+        version = current_version(index_dir)
+        files_dir = os.path.join(index_dir, VERSIONS_DIR, version) if version else index_dir
+        with open(os.path.join(files_dir, SIDECAR_FILE)) as f:
+            sidecar = json.load(f)
+
+        self.version: str = sidecar["version"]
+        self.model: str = sidecar["model"]
+        self.ids: list[str] = sidecar["ids"]
+        self.documents: list[str] = sidecar["documents"]
+        # memory-mapped, pages are loaded on first use and shared between worker processes
+        self.embeddings: np.ndarray = np.load(os.path.join(files_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self.embed = embed
+
+        if self.embeddings.shape[0] != len(self.ids):
+            raise ValueError(
+                f"local index is corrupted: {self.embeddings.shape[0]} embeddings for {len(self.ids)} documents")
+
+        logger.info("local vector index loaded from %s: %d documents, model %s, version %s",
+                    files_dir, len(self.ids), self.model, self.version)
+
+    def search(self, query_embeddings: np.ndarray, limit: int = 5) -> list[list[tuple[str, str, float]]]:
+        """ top-k (id, document, distance) for each row of query_embeddings, closest first """
+
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        queries = queries / norms
+
+        similarities = queries @ self.embeddings.T
+        limit = min(limit, similarities.shape[1])
+        if limit == 0:
+            return [[] for _ in range(len(queries))]
+
+        # partial sort for the top-k, then order only those k
+        top_k = np.argpartition(-similarities, limit - 1, axis=1)[:, :limit]
+        results = []
+        for row, candidates in enumerate(top_k):
+            ordered = candidates[np.argsort(-similarities[row, candidates])]
+            results.append([(self.ids[i], self.documents[i], float(1.0 - similarities[row, i]))
+                            for i in ordered])
+        return results
+
+    def search_texts(self, queries: list[str], limit: int = 5) -> list[list[tuple[str, str, float]]]:
+        """ embed the queries in one batch and search """
+        if self.embed is None:
+            raise ValueError("no embedding function configured for the local vector index")
+        return self.search(self.embed(queries), limit=limit)
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, Iterable, Optional, Tuple
+import mcp.types
+from fastmcp import Client
+from fastmcp.client.messages import MessageHandler
+from fastmcp.client.transports import SSETransport
+from mcp.types import Tool
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ToolCatalog:
+    """ snapshot of the tools of the connected mcp servers. a refresh builds a new catalog instead of changing
+    this one, so a turn never sees the tool list of one refresh and the server map of another """
+    # openai tool schemas, sorted by name - they are part of the cached prompt prefix
+    tools: list = field(default_factory=list)
+    toolname_servername_map: Dict[str, str] = field(default_factory=dict)
+    # (server name, tool name) of the tools annotated as read-only
+    read_only_tools: FrozenSet[Tuple[str, str]] = frozenset()
+    # server name -> openai tool schemas of the server
+    tools_map: Dict[str, list] = field(default_factory=dict)
+
+
+class ToolListChangedHandler(MessageHandler):
+    """ marks the server stale when it sends a tools/list_changed notification """
+
+    def __init__(self, server_name: str, on_change: Callable[[str], None]):
+        super().__init__()
+        self.server_name = server_name
+        self.on_change = on_change
+
+    async def on_tool_list_changed(self, message: mcp.types.ToolListChangedNotification):
+        logger.info("tool list of mcp server %s changed", self.server_name)
+        self.on_change(self.server_name)
+
+
+class McpServerPool:
+    """ clients of the configured mcp servers and the catalog of their tools.
+
+    the servers are connected concurrently, each within connect_timeout, and the app starts with whichever servers
+    are up. a background task refreshes the tool lists - right away for a server that sent tools/list_changed,
+    and all servers every refresh_ttl seconds (0 disables the periodic refresh). servers that were down or whose
+    connection broke are reconnected on the next refresh. on_catalog is called with every new catalog.
+    """
+
+    def __init__(self, servers: Dict[str, str], api_key: str, on_catalog: Callable[[ToolCatalog], None],
+                 connect_timeout: float = 10, refresh_ttl: float = 300):
+        self.servers = servers
+        self.api_key = api_key
+        self.on_catalog = on_catalog
+        self.connect_timeout = connect_timeout
+        self.refresh_ttl = refresh_ttl
+        # the dict is shared with the request path (mcp_client_map), clients are replaced in place on reconnect
+        self.clients: Dict[str, Client] = {}
+        self.catalog = ToolCatalog()
+        self.refreshed_at: Optional[float] = None
+        self.refresh_errors = 0
+        self.__server_tools: Dict[str, list[Tool]] = {}
+        self.__client_stacks: Dict[str, AsyncExitStack] = {}
+        self.__stale: set[str] = set()
+        self.__stale_event = asyncio.Event()
+        self.__refresh_task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        """ connect to all servers concurrently and build the first catalog """
+        await self.refresh(self.servers)
+        if not self.clients:
+            logger.error("none of the mcp servers %s is reachable, serving without tools", list(self.servers))
+
+    def start(self):
+        self.__refresh_task = asyncio.create_task(self.__refresh_forever())
+
+    async def close(self):
+        if self.__refresh_task is not None:
+            self.__refresh_task.cancel()
+            await asyncio.gather(self.__refresh_task, return_exceptions=True)
+        for name in list(self.__client_stacks):
+            await self.__disconnect(name)
+
+    def mark_stale(self, server_name: str):
+        """ refresh the tools of the server on the next iteration of the refresh task """
+        self.__stale.add(server_name)
+        self.__stale_event.set()
+
+    async def refresh(self, server_names: Iterable[str]):
+        """ reload the tools of the servers (reconnecting them when needed) and publish a new catalog.
+        a server whose client is still connected keeps its client and the tools of its last successful refresh when
+        the tool list can not be loaded (e.g. a list_tools timeout). a server that can not be reached is
+        disconnected and its tools are removed from the catalog until it is reconnected """
+        names = list(server_names)
+        results = await asyncio.gather(*[self.__load_server_tools(name) for name in names], return_exceptions=True)
+        for name, result in zip(names, results):
+            if not isinstance(result, BaseException):
+                self.__server_tools[name] = result
+                continue
+            self.refresh_errors += 1
+            client = self.clients.get(name)
+            if client is not None and client.is_connected():
+                logger.warning("unable to refresh the tools of mcp server %s, keeping the previous tools: %r",
+                               name, result)
+                continue
+            logger.warning("mcp server %s is unreachable, its tools are removed from the catalog: %r", name, result)
+            await self.__disconnect(name)
+            self.__server_tools.pop(name, None)
+        self.refreshed_at = time.time()
+        self.__publish()
+
+    def stats(self) -> dict:
+        return {
+            "connected_servers": sorted(self.clients),
+            "disconnected_servers": sorted(set(self.servers) - set(self.clients)),
+            "tools": len(self.catalog.tools),
+            "refreshed_at": self.refreshed_at,
+            "refresh_errors": self.refresh_errors,
+        }
+
+    async def __load_server_tools(self, name: str) -> list[Tool]:
+        async with asyncio.timeout(self.connect_timeout):
+            client = self.clients.get(name)
+            if client is None or not client.is_connected():
+                client = await self.__connect(name)
+            tools = await client.list_tools()
+        logger.info("tools loaded from %s: %s", name, [tool.name for tool in tools])
+        return tools
+
+    async def __connect(self, name: str) -> Client:
+        await self.__disconnect(name)
+        url = self.servers[name]
+        logger.info("connecting to mcp server %s at %s...", name, url)
+        stack = AsyncExitStack()
+        client = Client(transport=SSETransport(url=url, headers={"x-api-key": self.api_key}),
+                        message_handler=ToolListChangedHandler(name, self.mark_stale))
+        try:
+            await stack.enter_async_context(client)
+        except BaseException:
+            await stack.aclose()
+            raise
+        self.__client_stacks[name] = stack
+        self.clients[name] = client
+        logger.info("MCP client initialized: %s at %s", name, url)
+        return client
+
+    async def __disconnect(self, name: str):
+        self.clients.pop(name, None)
+        stack = self.__client_stacks.pop(name, None)
+        if stack is not None:
+            try:
+                await stack.aclose()
+            except Exception as e:
+                logger.warning("error closing the client of mcp server %s: %s", name, e)
+
+    def __publish(self):
+        tools_map: Dict[str, list] = {}
+        toolname_servername_map: Dict[str, str] = {}
+        read_only_tools = set()
+        for server_name, tools in self.__server_tools.items():
+            tools_map[server_name] = []
+            for tool in tools:
+                toolname_servername_map[tool.name] = server_name
+                if tool.annotations and tool.annotations.readOnlyHint:
+                    read_only_tools.add((server_name, tool.name))
+                tools_map[server_name].append({
+                    "type": "function",
+                    "function": {
+                        "name": tool.name,
+                        "description": tool.description,
+                        "parameters": tool.inputSchema
+                    }
+                })
+        all_tools = sorted((tool for tools in tools_map.values() for tool in tools),
+                           key=lambda tool: tool["function"]["name"])
+        self.catalog = ToolCatalog(tools=all_tools, toolname_servername_map=toolname_servername_map,
+                                   read_only_tools=frozenset(read_only_tools), tools_map=tools_map)
+        self.on_catalog(self.catalog)
+
+    async def __refresh_forever(self):
+        while True:
+            try:
+                async with asyncio.timeout(self.refresh_ttl or None):
+                    await self.__stale_event.wait()
+                names = set(self.__stale)
+            except TimeoutError:
+                names = set(self.servers)
+            # servers that were down at startup or lost their connection
+            names |= set(self.servers) - set(self.clients)
+            self.__stale.clear()
+            self.__stale_event.clear()
+            try:
+                await self.refresh(names)
+            except Exception as e:
+                logger.error("tool catalog refresh failed: %s", e)
@@ -0,0 +1,103 @@
+import os
+from typing import Dict, Tuple
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+# prometheus metrics of the agent server and the worker, exported on /metrics.
+# children of fixed label values are bound once at import, the children of dynamic label values (model, tool)
+# are bound on first use and cached, so the hot path does no label lookups
+
+CHAT_DURATION = Histogram(
+    "rm_agent_chat_duration_seconds", "Duration of chat requests", ["endpoint"],
+    buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120))
+CHAT_DURATION_CHAT = CHAT_DURATION.labels(endpoint="chat")
+CHAT_DURATION_STREAM = CHAT_DURATION.labels(endpoint="chat_stream")
+
+THREAD_LOCK_CONFLICTS = Counter(
+    "rm_agent_thread_lock_conflicts_total", "Chat requests rejected because the thread queue is full or the wait timed out", ["endpoint"])
+THREAD_LOCK_CONFLICTS_CHAT = THREAD_LOCK_CONFLICTS.labels(endpoint="chat")
+THREAD_LOCK_CONFLICTS_STREAM = THREAD_LOCK_CONFLICTS.labels(endpoint="chat_stream")
+
+LLM_ROUNDS = Histogram(
+    "rm_agent_llm_rounds_per_turn", "LLM rounds of an orchestrated turn", buckets=(1, 2, 3, 4, 5, 6, 8, 10))
+ROUND_LIMIT_EXHAUSTED = Counter(
+    "rm_agent_round_limit_exhausted_total", "Turns that hit MAX_ORCHESTRATION_ROUNDS")
+
+LLM_CALL_DURATION = Histogram(
+    "rm_agent_llm_call_duration_seconds", "Duration of LLM calls", ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 60))
+LLM_TOKENS = Counter(
+    "rm_agent_llm_tokens_total", "Tokens reported by the LLM provider", ["model", "type"])
+
+TOOL_CALLS = Counter(
+    "rm_agent_tool_calls_total", "MCP tool calls by outcome (ok, cached, timeout, error)", ["server", "tool", "outcome"])
+TOOL_CALL_DURATION = Histogram(
+    "rm_agent_tool_call_duration_seconds", "Duration of MCP tool calls, including the wait for a slot", ["server", "tool"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "rm_agent_response_cache_lookups_total", "Semantic response cache lookups by outcome", ["outcome"])
+RESPONSE_CACHE_HIT = RESPONSE_CACHE_LOOKUPS.labels(outcome="hit")
+RESPONSE_CACHE_MISS = RESPONSE_CACHE_LOOKUPS.labels(outcome="miss")
+
+SUMMARIZATION_RUNS = Counter(
+    "rm_agent_summarization_runs_total", "Summarization attempts by outcome", ["outcome"])
+SUMMARIZATION_SUMMARIZED = SUMMARIZATION_RUNS.labels(outcome="summarized")
+SUMMARIZATION_LOCK_BUSY = SUMMARIZATION_RUNS.labels(outcome="lock_busy")
+SUMMARIZATION_FAILED = SUMMARIZATION_RUNS.labels(outcome="error")
+
+
+class LLMMetrics:
+    """ pre-bound children of the LLM metrics of one model """
+
+    def __init__(self, model: str):
+        self.duration = LLM_CALL_DURATION.labels(model=model)
+        self.prompt_tokens = LLM_TOKENS.labels(model=model, type="prompt")
+        self.completion_tokens = LLM_TOKENS.labels(model=model, type="completion")
+        self.cache_hit_tokens = LLM_TOKENS.labels(model=model, type="prompt_cache_hit")
+
+    def observe(self, latency: float, prompt_tokens: int, completion_tokens: int, cache_hit_tokens: int):
+        self.duration.observe(latency)
+        self.prompt_tokens.inc(prompt_tokens)
+        self.completion_tokens.inc(completion_tokens)
+        self.cache_hit_tokens.inc(cache_hit_tokens)
+
+
+class ToolMetrics:
+    """ pre-bound children of the tool call metrics of one tool """
+
+    def __init__(self, server: str, tool: str):
+        self.duration = TOOL_CALL_DURATION.labels(server=server, tool=tool)
+        self.ok = TOOL_CALLS.labels(server=server, tool=tool, outcome="ok")
+        self.cached = TOOL_CALLS.labels(server=server, tool=tool, outcome="cached")
+        self.timeout = TOOL_CALLS.labels(server=server, tool=tool, outcome="timeout")
+        self.error = TOOL_CALLS.labels(server=server, tool=tool, outcome="error")
+        self.unavailable = TOOL_CALLS.labels(server=server, tool=tool, outcome="unavailable")
+
+
+__llm_metrics: Dict[str, LLMMetrics] = {}
+__tool_metrics: Dict[Tuple[str, str], ToolMetrics] = {}
+
+
+def llm_metrics(model: str) -> LLMMetrics:
+    metrics = __llm_metrics.get(model)
+    if metrics is None:
+        metrics = __llm_metrics[model] = LLMMetrics(model)
+    return metrics
+
+
+def tool_metrics(server: str, tool: str) -> ToolMetrics:
+    metrics = __tool_metrics.get((server, tool))
+    if metrics is None:
+        metrics = __tool_metrics[(server, tool)] = ToolMetrics(server, tool)
+    return metrics
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """ the metrics in the prometheus text format. with several gunicorn workers set PROMETHEUS_MULTIPROC_DIR,
+    the metrics of all workers are then aggregated """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -42,4 +42,15 @@ class AppState(BaseModel):
     user_message: str = ""
     messages: list[ConversationModel] = []
     current_agent_name: str = ""
+    # number of messages already saved, the messages after them are new in this turn
     messages_count: int = 0
+
+    @property
+    def new_messages(self) -> list[ConversationModel]:
+        """ the messages added since the state was loaded - what is appended to redis and persisted """
+        return self.messages[self.messages_count:]
+
+    def start_turn(self) -> "AppState":
+        """ working state of a turn. messages are append-only, so the loaded messages are shared with this state
+        instead of deep-copied - only the list is copied, and the turn's messages are appended to it """
+        return self.model_copy(update={"messages": list(self.messages)})
@@ -0,0 +1,78 @@
+import time
+import logging
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (ms) of the wait time histogram buckets
+WAIT_TIME_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class WaitTimeHistogram:
+    """ distribution of the time spent waiting for a pooled connection """
+
+    def __init__(self, buckets_ms: tuple = WAIT_TIME_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        # one counter per bucket and one for waits above the last bucket
+        self.counts = [0] * (len(buckets_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, wait: float):
+        wait_ms = wait * 1000
+        index = next((i for i, bound in enumerate(self.buckets_ms) if wait_ms <= bound), len(self.buckets_ms))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def to_dict(self) -> dict:
+        buckets = {f"le_{bound}ms": count for bound, count in zip(self.buckets_ms, self.counts)}
+        buckets["gt_{}ms".format(self.buckets_ms[-1])] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "buckets": buckets,
+        }
+
+
+class InstrumentedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """ the default pool of the async engine, counting the callers waiting for a connection and how long they wait.
+    the wait includes opening a new connection when the pool is below its size """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = 0
+        self.wait_histogram = WaitTimeHistogram()
+
+    def _do_get(self):
+        self.waiters += 1
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.waiters -= 1
+            self.wait_histogram.record(time.perf_counter() - started_at)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": self.overflow(),
+            "waiters": self.waiters,
+            "wait_time": self.wait_histogram.to_dict(),
+        }
+
+
+def redis_pool_stats(pool) -> dict:
+    """ connections of a redis.asyncio connection pool. works for ConnectionPool and BlockingConnectionPool """
+    in_use = len(getattr(pool, "_in_use_connections", ()))
+    available = len(getattr(pool, "_available_connections", ()))
+    return {
+        "max_connections": pool.max_connections,
+        "in_use": in_use,
+        "idle": available,
+    }
@@ -1,25 +1,36 @@
 from contextlib import AsyncExitStack
 from mcp import ClientSession
 from mcp.client.sse import sse_client
-from typing import Dict
-from openai import OpenAI
+from typing import Awaitable, Callable, Dict, FrozenSet, Optional, Tuple
+from openai import OpenAI, AsyncOpenAI
+from sqlalchemy import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-import redis
+from redis.asyncio import Redis, ConnectionPool, BlockingConnectionPool
 import logging
 from agents.summarization_agent import SummarizationAgent
 from agents.supervisor import SupervisorAgent
 from fastmcp import Client
-from fastmcp.client.transports import SSETransport
-from mcp.types import Tool
+from utils.tool_call_limiter import ToolCallLimiter
+from utils.tool_result_cache import ToolResultCache
+from utils.job_queue import JobHandler, LocalJobQueue, RedisStreamJobQueue
+from datastore.bulk_writer import ConversationBulkWriter
+from utils.context_builder import ContextBuilder, TokenCounter
+from utils.llm_usage import LLMUsageStats
+from utils.thread_turns import ThreadTurnQueue
+from utils.pool_stats import InstrumentedAsyncAdaptedQueuePool, redis_pool_stats
+from utils.mcp_catalog import McpServerPool, ToolCatalog
+from utils.rolling_summary import RollingSummaryPolicy
+from utils.summarization_scheduler import SummarizationScheduler
 
 logger = logging.getLogger(__name__)
 
 
 class ResourceRegistry():
     """ Registry for all resources. Registry will be stored in the FastAPI app state """
-    redis_client: redis.Redis
+    redis_client: Redis
     async_session: async_sessionmaker[AsyncSession]
     openai_client: OpenAI
+    async_openai_client: AsyncOpenAI
 
     def __init__(self):
         # AsyncExitStack - a dynamic, asynchronous version of Try-with- in Java.
@@ -27,88 +38,214 @@ class ResourceRegistry():
         # self.mcp_sessions: Dict[str, ClientSession] = {}
         self.mcp_clients: Dict[str, Client] = {}
         self.ai_clients: Dict[str, any] = {}
+        self.mcp_server_pool: Optional[McpServerPool] = None
+        # tools of the connected mcp servers, replaced as a whole when the catalog is refreshed
+        self.tool_catalog = ToolCatalog()
         self.tools_map: Dict[str, list] = {}
         self.toolname_servername_map: Dict[str, str] = {}
-
-    def setup_redis_client(self, host='localhost', port=6379, db=0, max_connections=10):
-        """ setup redis client and add to registry """
-        pool = redis.ConnectionPool(
-            host=host, port=port, db=db, max_connections=max_connections)
-        self.redis_client = redis.Redis(connection_pool=pool)
-
-    def create_database_engine(self, database_url):
-        """ create database engine and add to registry """
+        self.tool_call_limiter = ToolCallLimiter()
+        # (server name, tool name) of the tools annotated as read-only
+        self.read_only_tools: FrozenSet[Tuple[str, str]] = frozenset()
+        # agents that get the refreshed tool catalog
+        self.__tool_agents: list = []
+        self.tool_result_cache: Optional[ToolResultCache] = None
+        self.job_queue: LocalJobQueue | RedisStreamJobQueue = None
+        self.bulk_writer: Optional[ConversationBulkWriter] = None
+        self.context_builder: Optional[ContextBuilder] = None
+        self.thread_turn_queue: Optional[ThreadTurnQueue] = None
+        self.rolling_summary_policy = RollingSummaryPolicy()
+        self.summarization_scheduler: Optional[SummarizationScheduler] = None
+        # summarization backend, the supervisor's LLM provider unless setup_summarization_backend is called
+        self.summarization_client: Optional[OpenAI] = None
+        self.summarization_async_client: Optional[AsyncOpenAI] = None
+        self.summarization_temperature: Optional[float] = None
+        # token usage and prompt cache hits of all agents
+        self.llm_usage_stats = LLMUsageStats()
+        self.state_codec = "json"
+
+    def setup_redis_client(self, host='localhost', port=6379, db=0, max_connections=10, pool_timeout: float = None,
+                           state_codec: str = "json"):
+        """ setup async redis client (shared connection pool) and add to registry.
+        with a pool timeout callers wait for a free connection, otherwise an error is raised when the pool is exhausted.
+        state_codec is how the app state of a thread is stored, see datastore.database.STATE_CODECS """
+        self.state_codec = state_codec
+        if pool_timeout is None:
+            pool = ConnectionPool(
+                host=host, port=port, db=db, max_connections=max_connections)
+        else:
+            pool = BlockingConnectionPool(
+                host=host, port=port, db=db, max_connections=max_connections, timeout=pool_timeout)
+        self.redis_client = Redis(connection_pool=pool)
+        # close the client and disconnect the pool on shutdown
+        self._stack.push_async_callback(self.redis_client.aclose, close_connection_pool=True)
+
+    def create_database_engine(self, database_url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800,
+                               pool_pre_ping=True, statement_cache_size=100):
+        """ create database engine and add to registry. the pool settings apply to postgres only """
         logger.info("creating database engine with url: %s", database_url)
-        engine = create_async_engine(url=database_url, echo=False)
+        if make_url(database_url).get_backend_name() == "postgresql":
+            engine = create_async_engine(
+                url=database_url, echo=False, poolclass=InstrumentedAsyncAdaptedQueuePool,
+                pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping,
+                # asyncpg statement cache and the sqlalchemy prepared statement cache of the asyncpg adapter
+                connect_args={"statement_cache_size": statement_cache_size,
+                              "prepared_statement_cache_size": statement_cache_size})
+        else:
+            engine = create_async_engine(url=database_url, echo=False)
         async_session = async_sessionmaker(engine, expire_on_commit=False)
         self.async_session = async_session
         logger.info("database connection ...%s...", async_session)
 
+    def setup_bulk_writer(self, max_rows: int, flush_interval: float):
+        """ setup the COPY based writer for conversation history. requires the database engine """
+        engine = self.async_session.kw["bind"]
+        self.bulk_writer = ConversationBulkWriter(engine, max_rows=max_rows, flush_interval=flush_interval)
+        # write the buffered rows on shutdown
+        self._stack.push_async_callback(self.bulk_writer.close)
+
+    def pool_stats(self) -> dict:
+        """ usage of the database and redis connection pools """
+        stats = {"redis": redis_pool_stats(self.redis_client.connection_pool)}
+        pool = self.async_session.kw["bind"].pool
+        if isinstance(pool, InstrumentedAsyncAdaptedQueuePool):
+            stats["database"] = pool.stats()
+        else:
+            stats["database"] = {"status": pool.status()}
+        return stats
+
     async def dispose_database_engine(self):
         """ dispose database engine """
         if self.async_session:
             engine = self.async_session.kw["bind"]
             await engine.dispose()
 
-    async def setup_mcp_client(self, name, url, api_key):
-        """ setup mcp client and add to registry """
-        # logger.info(f"Setting up MCP client: {name} at {url}")
-
-        sse = SSETransport(url=url, headers={"x-api-key": api_key})
-        client = Client(transport=sse)
-        await self._stack.enter_async_context(client)
-        # await client.ping()
-
-        tools = await self.__load_tools(name, client)
-        logger.info("Tools loaded from %s: %s", name, tools)
-        self.tools_map[name] = tools
-        self.mcp_clients[name] = client
-
-        # read, write = await self._stack.enter_async_context(sse_client(url=url, headers={"x-api-key": api_key}))
-        # session = await self._stack.enter_async_context(ClientSession(read, write))
-        # await session.initialize()
-        # self.mcp_sessions[name] = session
-
-        logger.info("MCP client and sessions initialized: %s at %s", name, url)
-        # load tools
-        # tools = await self.__load_tools(name, session)
-        # self.tools_map[name] = tools
-        # logger.info("tools map %s", self.tools_map)
-
-    async def __load_tools(self, server_name, client: Client):
-        """ load tools from mcp session """
-
-        tools: list[Tool] = await client.list_tools()
-
-        all_tools = []
-
-        for tool in tools:
-
-            self.toolname_servername_map[tool.name] = server_name
-            all_tools.append({
-                "type": "function",
-                        "function": {
-                            "name": tool.name,
-                            "description": tool.description,
-                            "parameters": tool.inputSchema
-                        }
-            })
-
-        return all_tools
+    async def setup_mcp_servers(self, servers: Dict[str, str], api_key: str, connect_timeout: float = 10,
+                                refresh_ttl: float = 300):
+        """ connect to the mcp servers concurrently, load their tools and keep the tool catalog fresh in the background.
+        servers that are down at startup are skipped and connected by a later refresh """
+        self.mcp_server_pool = McpServerPool(servers, api_key, on_catalog=self.__apply_tool_catalog,
+                                             connect_timeout=connect_timeout, refresh_ttl=refresh_ttl)
+        self.mcp_clients = self.mcp_server_pool.clients
+        # close the clients and stop the refresh on shutdown
+        self._stack.push_async_callback(self.mcp_server_pool.close)
+        await self.mcp_server_pool.connect()
+        self.mcp_server_pool.start()
+        logger.info("MCP clients initialized: %s", list(self.mcp_clients))
+
+    def __apply_tool_catalog(self, catalog: ToolCatalog):
+        """ swap in a new tool catalog. runs without awaiting, so no request sees a half applied catalog """
+        self.tool_catalog = catalog
+        self.tools_map = catalog.tools_map
+        self.toolname_servername_map = catalog.toolname_servername_map
+        self.read_only_tools = catalog.read_only_tools
+        if self.tool_result_cache is not None:
+            self.tool_result_cache.read_only_tools = catalog.read_only_tools
+        for agent in self.__tool_agents:
+            agent.tools = catalog.tools
+            agent.toolname_servername_map = catalog.toolname_servername_map
+        logger.info("tool catalog updated: %s", list(catalog.toolname_servername_map))
+
+    def setup_tool_call_limiter(self, max_concurrent_calls_per_server: int, timeout: float):
+        """ setup the per mcp server concurrency limit and the per call deadline shared by all agents """
+        self.tool_call_limiter = ToolCallLimiter(
+            max_concurrent_calls_per_server=max_concurrent_calls_per_server, timeout=timeout)
+
+    def setup_tool_result_cache(self, default_ttl: int, ttl_overrides: Dict[str, int]):
+        """ setup the redis backed result cache for read-only tools. requires the redis client and the mcp tools """
+        self.tool_result_cache = ToolResultCache(self.redis_client, self.read_only_tools,
+                                                 default_ttl=default_ttl, ttl_overrides=ttl_overrides)
+        logger.info("tool result cache initialized for read-only tools: %s", self.read_only_tools)
+
+    def setup_thread_turn_queue(self, lease_ttl: int, renew_interval: float, max_queue_depth: int,
+                                acquire_timeout: float, max_turn_duration: float):
+        """ setup the per thread turn queue and lease. requires the redis client """
+        self.thread_turn_queue = ThreadTurnQueue(
+            self.redis_client, lease_ttl=lease_ttl, renew_interval=renew_interval, max_queue_depth=max_queue_depth,
+            acquire_timeout=acquire_timeout, max_turn_duration=max_turn_duration)
+
+    def setup_job_queue(self, backend: str, handler: JobHandler, stream: str, group: str, batch_size: int, max_retries: int,
+                        retry_backoff: float = 1, max_retry_backoff: float = 60):
+        """ setup the background job queue. requires the redis client for the "redis" backend.
+        the local queue processes jobs in this process, it is also the fallback when redis is not reachable """
+        local_queue = LocalJobQueue(handler, batch_size=batch_size, max_retries=max_retries,
+                                    retry_backoff=retry_backoff, max_retry_backoff=max_retry_backoff)
+        local_queue.start()
+        # process the queued jobs on shutdown
+        self._stack.push_async_callback(local_queue.stop)
+
+        if backend == "local":
+            self.job_queue = local_queue
+        else:
+            self.job_queue = RedisStreamJobQueue(self.redis_client, handler, stream=stream, group=group,
+                                                 batch_size=batch_size, max_retries=max_retries,
+                                                 retry_backoff=retry_backoff, max_retry_backoff=max_retry_backoff,
+                                                 fallback=local_queue)
+        logger.info("background job queue initialized: %s", backend)
+
+    def setup_context_builder(self, max_prompt_tokens: int, max_context_tokens: int, max_tool_output_tokens: int,
+                              tokenizer: str = None):
+        """ setup the prompt token budget of the supervisor agent. must be called before setup_ai_client """
+        self.context_builder = ContextBuilder(
+            max_prompt_tokens=max_prompt_tokens, max_context_tokens=max_context_tokens,
+            max_tool_output_tokens=max_tool_output_tokens, token_counter=TokenCounter(tokenizer))
+        logger.info("context builder initialized with a budget of %d prompt tokens", max_prompt_tokens)
+
+    def setup_rolling_summary(self, trigger_tokens: int, keep_recent_tokens: int, max_window_tokens: int,
+                              tokenizer: str = None):
+        """ setup when and how much of a thread is folded into its running summary """
+        token_counter = self.context_builder.token_counter if self.context_builder else TokenCounter(tokenizer)
+        self.rolling_summary_policy = RollingSummaryPolicy(
+            token_counter, trigger_tokens=trigger_tokens, keep_recent_tokens=keep_recent_tokens,
+            max_window_tokens=max_window_tokens)
+
+    def setup_summarization_backend(self, url: Optional[str], api_key: str, temperature: Optional[float] = None):
+        """ setup the LLM endpoint of the summarization agent - any OpenAI compatible endpoint, e.g. a local Ollama
+        (http://localhost:11434/v1). without a url the summarization agent uses the supervisor's client.
+        must be called before setup_ai_client """
+        self.summarization_temperature = temperature
+        if not url:
+            return
+        self.summarization_client = OpenAI(base_url=url, api_key=api_key)
+        self.summarization_async_client = AsyncOpenAI(base_url=url, api_key=api_key)
+        self._stack.push_async_callback(self.summarization_async_client.close)
+        logger.info("summarization backend at %s", url)
+
+    def setup_summarization_scheduler(self, summarize: Callable[[str], Awaitable[None]], interval: float,
+                                      max_concurrency: int):
+        """ summarize the threads of many job batches together in scheduled passes """
+        self.summarization_scheduler = SummarizationScheduler(summarize, interval=interval,
+                                                              max_concurrency=max_concurrency)
+        self.summarization_scheduler.start()
+        # summarize the pending threads on shutdown
+        self._stack.push_async_callback(self.summarization_scheduler.close)
 
     def setup_openai_client(self, url, api_key):
+        """ setup sync and async openai clients. agents use the async client from the request path """
         client = OpenAI(base_url=url, api_key=api_key)
         self.openai_client = client
 
-    def setup_ai_client(self, name, client, model, tools: list = []):
+        async_client = AsyncOpenAI(base_url=url, api_key=api_key)
+        self.async_openai_client = async_client
+        # close the underlying http connection pool on shutdown
+        self._stack.push_async_callback(async_client.close)
+
+    def setup_ai_client(self, name, client, model, tools: list = [], async_client: AsyncOpenAI = None):
         """ setup generic ai client and add to registry """
         if "supervisor_agent" == name:
             rm_agent = SupervisorAgent(
-                client=client, model=model, tools=tools, toolname_servername_map=self.toolname_servername_map)
+                client=client, model=model, tools=tools, toolname_servername_map=self.toolname_servername_map,
+                async_client=async_client, tool_call_limiter=self.tool_call_limiter,
+                tool_result_cache=self.tool_result_cache, context_builder=self.context_builder,
+                usage_stats=self.llm_usage_stats)
             self.ai_clients[name] = rm_agent
+            self.__tool_agents.append(rm_agent)
         elif "summarization_agent" == name:
+            temperature = {} if self.summarization_temperature is None else {"temperature": self.summarization_temperature}
             summarization_agent = SummarizationAgent(
-                client=client, model=model, toolname_servername_map={})
+                client=self.summarization_client or client, model=model, toolname_servername_map={},
+                async_client=self.summarization_async_client or async_client, usage_stats=self.llm_usage_stats,
+                **temperature)
             self.ai_clients[name] = summarization_agent
 
         logger.info("AI clients initialized with tools: %s", tools)
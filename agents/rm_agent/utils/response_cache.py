@@ -0,0 +1,96 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import numpy as np
+from utils.metrics import RESPONSE_CACHE_HIT, RESPONSE_CACHE_MISS
+from utils.semantic_cache import CacheCounters, VersionWatcher, normalized_embedding
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ResponseEntry:
+    question: str
+    answer: str
+    embedding: np.ndarray
+    expires_at: float
+
+
+class ResponseCache:
+    """ semantic cache of supervisor answers, in front of the LLM.
+
+    the user message is embedded and the answer of the most similar cached question is returned when the cosine
+    similarity is above the similarity threshold. the key is the question alone, so SupervisorAgent only uses the
+    cache for the first turn of a thread (a follow-up depends on the conversation) and only caches answers of
+    tool-free turns (an answer that needed a tool depends on live data).
+
+    - every entry has its own TTL, the default ttl unless another is given to put
+    - the whole cache is invalidated when the knowledge base version stamp changes (re-ingestion)
+    - LRU eviction above max_size
+    """
+
+    def __init__(self, embed: Callable[[str], list[float]], max_size: int = 1024, ttl: float = 86400,
+                 similarity_threshold: float = 0.95,
+                 version_stamp: Callable[[], Any] = None, version_check_interval: float = 60):
+        self.embed = embed
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+
+        self.__entries: OrderedDict[int, ResponseEntry] = OrderedDict()
+        self.__next_key = 0
+        self.__lock = threading.Lock()
+        self.__version = VersionWatcher(version_stamp, self.clear, version_check_interval, name="response cache")
+        self.counters = CacheCounters()
+
+    def lookup(self, question: str) -> tuple[Optional[str], np.ndarray]:
+        """ (cached answer or None, embedding of the question for put). embeds the question and may read the
+        knowledge base version, run it in a worker thread """
+        self.__version.check()
+
+        embedding = normalized_embedding(self.embed, question)
+        now = time.monotonic()
+        with self.__lock:
+            best_key, best_score = None, self.similarity_threshold
+            for key, entry in list(self.__entries.items()):
+                if now > entry.expires_at:
+                    del self.__entries[key]
+                    continue
+                score = float(np.dot(embedding, entry.embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                self.counters.misses += 1
+                RESPONSE_CACHE_MISS.inc()
+                return None, embedding
+
+            self.__entries.move_to_end(best_key)
+            self.counters.hits += 1
+            entry = self.__entries[best_key]
+        RESPONSE_CACHE_HIT.inc()
+        logger.debug("response cache hit: '%s' ~ '%s' (%.3f)", question, entry.question, best_score)
+        return entry.answer, embedding
+
+    def put(self, question: str, embedding: np.ndarray, answer: str, ttl: float = None):
+        with self.__lock:
+            self.__entries[self.__next_key] = ResponseEntry(
+                question=question, answer=answer, embedding=embedding,
+                expires_at=time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.__next_key += 1
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.counters.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.counters.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"size": len(self.__entries), "max_size": self.max_size, **self.counters.as_dict(),
+                    "similarity_threshold": self.similarity_threshold, "version": self.__version.version}
@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import logging
+import numpy as np
+from utils.semantic_cache import CacheCounters, VersionWatcher, normalized_embedding
+
+logger = logging.getLogger(__name__)
+
+# misses whose embedding is kept for the put that follows them
+MAX_MISS_EMBEDDINGS = 64
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    created_at: float
+    embedding: Optional[np.ndarray] = None
+
+
+class RetrievalCache:
+    """ LRU + TTL cache for vector store retrieval results, keyed by the normalized query.
+
+    - near-duplicate queries are served from the cache when an embedding function is configured and
+      the cosine similarity with a cached query is above the similarity threshold
+    - the whole cache is invalidated when the collection version stamp changes (re-ingestion)
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600,
+                 embed: Callable[[str], list[float]] = None, similarity_threshold: float = 0.95,
+                 version_stamp: Callable[[], Any] = None, version_check_interval: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+
+        self.__entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # embeddings of the keys that missed, put reuses them instead of embedding the key again
+        self.__miss_embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__version = VersionWatcher(version_stamp, self.clear, version_check_interval, name="retrieval cache")
+        self.counters = CacheCounters()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """ lower case, drop punctuation and collapse whitespace """
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+    def get(self, query: str) -> tuple[bool, Any]:
+        """ returns (found, value) """
+        self.__version.check()
+
+        key = self.normalize(query)
+        now = time.monotonic()
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if now - entry.created_at <= self.ttl:
+                    self.__entries.move_to_end(key)
+                    self.counters.hits += 1
+                    return True, entry.value
+                del self.__entries[key]
+
+        if self.embed is not None:
+            embedding = normalized_embedding(self.embed, key)
+            with self.__lock:
+                near_key = self.__find_near_duplicate(embedding, now)
+                if near_key is not None:
+                    self.__entries.move_to_end(near_key)
+                    self.counters.near_hits += 1
+                    logger.debug("near duplicate retrieval cache hit: '%s' ~ '%s'", key, near_key)
+                    return True, self.__entries[near_key].value
+                self.__remember_miss(key, embedding)
+
+        with self.__lock:
+            self.counters.misses += 1
+        return False, None
+
+    def put(self, query: str, value: Any):
+        key = self.normalize(query)
+        with self.__lock:
+            embedding = self.__miss_embeddings.pop(key, None)
+        if embedding is None and self.embed is not None:
+            embedding = normalized_embedding(self.embed, key)
+
+        with self.__lock:
+            self.__entries[key] = CacheEntry(value=value, created_at=time.monotonic(), embedding=embedding)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.counters.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__miss_embeddings.clear()
+            self.counters.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"size": len(self.__entries), "max_size": self.max_size, **self.counters.as_dict(),
+                    "version": self.__version.version}
+
+    def __remember_miss(self, key: str, embedding: np.ndarray):
+        """ called with the lock held. bounded, a miss that is never put is dropped eventually """
+        self.__miss_embeddings[key] = embedding
+        self.__miss_embeddings.move_to_end(key)
+        while len(self.__miss_embeddings) > MAX_MISS_EMBEDDINGS:
+            self.__miss_embeddings.popitem(last=False)
+
+    def __find_near_duplicate(self, embedding: np.ndarray, now: float) -> Optional[str]:
+        """ best cached query with cosine similarity above the threshold. expired entries are skipped """
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self.__entries.items():
+            if entry.embedding is None or now - entry.created_at > self.ttl:
+                continue
+            score = float(np.dot(embedding, entry.embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
@@ -0,0 +1,85 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Optional
+from utils.context_builder import TokenCounter
+from utils.models import ConversationModel
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SummaryWindow:
+    """ the messages to fold into the running summary of a thread """
+    # text of the running summary, None before the first summary of the thread
+    previous_summary: Optional[str]
+    # number of leading messages replaced by the new summary - the running summary (if any) and the window
+    replace_count: int
+    window: list[ConversationModel]
+
+    def summary_message(self, thread_id, summary_text: str) -> ConversationModel:
+        """ the new running summary. it is dated at the last message of the window - the messages it covers end
+        there, the kept turns after it were created later (see load_appstate_from_pg) """
+        return ConversationModel(thread_id=thread_id, role="system", content=summary_text, summary=summary_text,
+                                 created_at=self.window[-1].created_at)
+
+
+class RollingSummaryPolicy:
+    """ decides when and what to fold into the running summary of a thread.
+
+    a thread keeps one running summary as its first message. once the messages after it exceed trigger_tokens,
+    the oldest turns are evicted until keep_recent_tokens are left, at most max_window_tokens per run. only the
+    evicted window and the previous summary are sent to the summarizer, so the cost of a run is bounded and no
+    summary is ever summarized together with the messages it already covers. the window always ends before a user
+    message, so a tool call is never separated from its result, and the current turn is never evicted.
+    """
+
+    def __init__(self, token_counter: TokenCounter = None, trigger_tokens: int = 2000, keep_recent_tokens: int = 800,
+                 max_window_tokens: int = 4000):
+        self.token_counter = token_counter or TokenCounter()
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self.max_window_tokens = max_window_tokens
+
+    def select(self, messages: list[ConversationModel]) -> Optional[SummaryWindow]:
+        """ the window to summarize, None when the thread is still below the trigger """
+
+        # older threads can have several summaries from the prefix summarizer, they are folded into one
+        summary_count = 0
+        while summary_count < len(messages) and self.is_summary(messages[summary_count]):
+            summary_count += 1
+        previous_summary = "\n\n".join(message.summary for message in messages[:summary_count]) or None
+        rest = messages[summary_count:]
+
+        counts = [self.count_message(message) for message in rest]
+        total = sum(counts)
+        if total < self.trigger_tokens:
+            return None
+
+        window_size = 0
+        evicted = 0
+        for index in range(1, len(rest)):
+            evicted += counts[index - 1]
+            if rest[index].role != "user":
+                continue
+            if evicted > self.max_window_tokens and window_size:
+                break
+            window_size = index
+            if total - evicted <= self.keep_recent_tokens:
+                break
+
+        if not window_size:
+            logger.debug("no turn boundary to summarize up to, %d tokens in the current turn", total)
+            return None
+        return SummaryWindow(previous_summary=previous_summary, replace_count=summary_count + window_size,
+                             window=rest[:window_size])
+
+    def count_message(self, message: ConversationModel) -> int:
+        tokens = self.token_counter.count(message.content or "")
+        if message.tool_calls:
+            tokens += self.token_counter.count(json.dumps([call.model_dump() for call in message.tool_calls]))
+        return tokens
+
+    @staticmethod
+    def is_summary(message: ConversationModel) -> bool:
+        return message.role == "system" and message.summary is not None
@@ -0,0 +1,60 @@
+import time
+import logging
+from dataclasses import asdict, dataclass
+from typing import Any, Callable
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# building blocks shared by the in-process embedding caches (RetrievalCache, ResponseCache)
+
+
+def normalized_embedding(embed: Callable[[str], list[float]], text: str) -> np.ndarray:
+    """ unit length embedding of the text, the dot product of two of them is the cosine similarity """
+    vector = np.asarray(embed(text), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass
+class CacheCounters:
+    hits: int = 0
+    near_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.near_hits + self.misses
+        return {**asdict(self), "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0}
+
+
+class VersionWatcher:
+    """ reads the knowledge base version stamp at most once per interval and calls on_change when it changed,
+    the caches are cleared on re-ingestion """
+
+    def __init__(self, version_stamp: Callable[[], Any], on_change: Callable[[], None], interval: float = 60,
+                 name: str = "cache"):
+        self.version_stamp = version_stamp
+        self.on_change = on_change
+        self.interval = interval
+        self.name = name
+        self.version = None
+        self.__checked_at = 0.0
+
+    def check(self):
+        if self.version_stamp is None:
+            return
+        now = time.monotonic()
+        if now - self.__checked_at < self.interval:
+            return
+        self.__checked_at = now
+        try:
+            version = self.version_stamp()
+        except Exception as e:
+            logger.warning("unable to read knowledge base version stamp: %s", e)
+            return
+        if self.version is not None and version != self.version:
+            logger.info("knowledge base version changed from %s to %s, clearing %s", self.version, version, self.name)
+            self.on_change()
+        self.version = version
@@ -0,0 +1,86 @@
+import uuid
+from typing import Callable, Dict
+import msgpack
+from utils.models import AppState, ConversationModel
+
+# binary encoding of the app state of a thread, an alternative to the RedisJSON document (STATE_CODEC=msgpack).
+#
+# the state is a msgpack array [schema version, thread_id, user_message, current_agent_name, messages_count, messages]
+# and every message a positional array [id, thread_id (16 bytes), role, content, summary, tool_calls, tool_call_id,
+# created_at (msgpack timestamp)], tool calls are [id, type, function name, arguments]. no field names are stored.
+#
+# a change of the layout gets a new schema version and a decoder of its own. the decoders of older versions are kept
+# until no saved state uses them, so states written before a deploy can still be read after it
+
+SCHEMA_VERSION = 1
+
+
+class StateCodecError(ValueError):
+    """ the saved state can not be decoded, e.g. it was written with an unknown schema version """
+
+
+def encode_appstate(appstate: AppState) -> bytes:
+    return msgpack.packb([
+        SCHEMA_VERSION,
+        appstate.thread_id,
+        appstate.user_message,
+        appstate.current_agent_name,
+        appstate.messages_count,
+        [encode_message(message) for message in appstate.messages],
+    ], datetime=True)
+
+
+def decode_appstate(data: bytes) -> AppState:
+    try:
+        state = msgpack.unpackb(data, timestamp=3)
+        return __DECODERS[state[0]](state)
+    except (KeyError, IndexError, TypeError, ValueError, msgpack.UnpackException) as e:
+        raise StateCodecError(f"unable to decode the saved state: {e!r}") from e
+
+
+def encode_message(message: ConversationModel) -> list:
+    return [
+        message.id,
+        # a message may carry the thread id as a str, e.g. when it was assigned after construction
+        uuid.UUID(str(message.thread_id)).bytes if message.thread_id else None,
+        message.role,
+        message.content,
+        message.summary,
+        [[call.id, call.type, call.function.name, call.function.arguments] for call in message.tool_calls]
+        if message.tool_calls else None,
+        message.tool_call_id,
+        message.created_at,
+    ]
+
+
+def __decode_message_v1(message: list) -> dict:
+    message_id, thread_id, role, content, summary, tool_calls, tool_call_id, created_at = message
+    return {
+        "id": message_id,
+        # pydantic takes the 16 bytes of the UUID
+        "thread_id": thread_id,
+        "role": role,
+        "content": content,
+        "summary": summary,
+        "tool_calls": [{"id": call_id, "type": call_type, "function": {"name": name, "arguments": arguments}}
+                       for call_id, call_type, name, arguments in tool_calls] if tool_calls else None,
+        "tool_call_id": tool_call_id,
+        "created_at": created_at,
+    }
+
+
+def __decode_appstate_v1(state: list) -> AppState:
+    # one model_validate of the whole state runs in the pydantic core, faster than constructing the models in python
+    _, thread_id, user_message, current_agent_name, messages_count, messages = state
+    return AppState.model_validate({
+        "thread_id": thread_id,
+        "user_message": user_message,
+        "current_agent_name": current_agent_name,
+        "messages_count": messages_count,
+        "messages": [__decode_message_v1(message) for message in messages],
+    })
+
+
+__DECODERS: Dict[int, Callable[[list], AppState]] = {
+    1: __decode_appstate_v1,
+}
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class SummarizationScheduler:
+    """ collects the threads to summarize from the job batches and summarizes them in one pass every interval seconds,
+    at most max_concurrency threads at a time. a thread is summarized once per pass however many turns it had, and
+    summarization runs off the request path at a bounded rate, so it does not compete with interactive calls.
+
+    the pending threads are kept in memory. threads pending at a crash are summarized after their next turn, the
+    rolling summary policy works on the current state of the thread, not on the jobs.
+    """
+
+    def __init__(self, summarize: Callable[[str], Awaitable[None]], interval: float = 5, max_concurrency: int = 4):
+        self.summarize = summarize
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        # insertion ordered set of thread ids
+        self.__pending: Dict[str, None] = {}
+        self.__closing = asyncio.Event()
+        self.__task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.summarized = 0
+        self.errors = 0
+        self.last_pass_seconds = 0.0
+
+    def schedule(self, thread_ids: Iterable[str]):
+        for thread_id in thread_ids:
+            self.__pending[thread_id] = None
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        """ stop scheduling, the threads still pending are summarized first """
+        self.__closing.set()
+        if self.__task is not None:
+            await self.__task
+
+    async def run_pass(self):
+        """ summarize the pending threads """
+        thread_ids = list(self.__pending)
+        self.__pending.clear()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def summarize_one(thread_id: str):
+            async with semaphore:
+                try:
+                    with span("summarize", thread_id=thread_id):
+                        await self.summarize(thread_id)
+                    self.summarized += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.error("unable to summarize thread %s: %s", thread_id, e)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*[summarize_one(thread_id) for thread_id in thread_ids])
+        self.passes += 1
+        self.last_pass_seconds = time.perf_counter() - started_at
+        logger.info("summarization pass over %d thread(s) took %.2f s", len(thread_ids), self.last_pass_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "pending_threads": len(self.__pending),
+            "passes": self.passes,
+            "summarized": self.summarized,
+            "errors": self.errors,
+            "last_pass_ms": self.last_pass_seconds * 1000,
+            "interval_seconds": self.interval,
+            "max_concurrency": self.max_concurrency,
+        }
+
+    async def __run(self):
+        while not self.__closing.is_set():
+            try:
+                async with asyncio.timeout(self.interval):
+                    await self.__closing.wait()
+            except TimeoutError:
+                pass
+            if self.__pending:
+                try:
+                    await self.run_pass()
+                except Exception as e:
+                    logger.error("summarization pass failed: %s", e)
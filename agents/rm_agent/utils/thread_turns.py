@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# extend the lease only while it is still held with our token
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# release the lease only while it is still held with our token
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class QueueFullError(Exception):
+    """ too many turns are waiting for the thread """
+
+
+@dataclass
+class ThreadLease:
+    """ the right to run a turn on a thread. token is the fencing token, writes are only accepted while
+    the lease in redis still holds it (see save_appstate_and_release_lock) """
+    thread_id: str
+    lock_key: str
+    token: int
+    released: bool = False
+    lost: bool = False
+    # the turn left the local queue
+    finished: bool = False
+    renewal_task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+
+class ThreadTurnQueue:
+    """ serializes the turns of a thread instead of rejecting concurrent messages.
+
+    turns of the same thread wait in FIFO order in this process (asyncio.Lock wakes waiters in order), at most
+    max_queue_depth per thread. the turn at the head then takes the distributed lease in redis - a SET NX of the lock key
+    with a fencing token from INCR - and retries until the lease is free when another process holds it.
+    the lease is renewed every renew_interval seconds while the turn runs, so a long orchestration does not lose it.
+    a turn that is never released (e.g. a stream that was never started) stops renewing after max_turn_duration
+    and leaves the queue, so it can not block the thread forever.
+    """
+
+    def __init__(self, redis_client: Redis, lease_ttl: int = 30, renew_interval: float = 10, max_queue_depth: int = 8,
+                 acquire_timeout: float = 120, max_turn_duration: float = 600, poll_interval: float = 0.05,
+                 max_poll_interval: float = 0.5):
+        self.redis_client = redis_client
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.max_turn_duration = max_turn_duration
+        self.max_queue_depth = max_queue_depth
+        self.acquire_timeout = acquire_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        # per thread - FIFO lock and number of turns waiting or running in this process
+        self.__locks: Dict[str, asyncio.Lock] = {}
+        self.__depth: Dict[str, int] = {}
+        self.__renew = redis_client.register_script(RENEW_SCRIPT)
+        self.__release = redis_client.register_script(RELEASE_SCRIPT)
+
+    async def acquire(self, thread_id: str, lock_key: str,
+                      try_acquire: Callable[..., Awaitable[Tuple[bool, T]]]) -> Tuple[ThreadLease, T]:
+        """ wait for the turn. try_acquire(lock_value=, ex=) sets the lock key if it is free and loads the state,
+        see acquire_lock_and_load_appstate. raises QueueFullError when max_queue_depth turns are already queued
+        and TimeoutError when the lease is not acquired within acquire_timeout """
+
+        depth = self.__depth.get(thread_id, 0)
+        if depth >= self.max_queue_depth:
+            raise QueueFullError(f"{depth} turns are already queued for thread {thread_id}")
+        self.__depth[thread_id] = depth + 1
+        lock = self.__locks.setdefault(thread_id, asyncio.Lock())
+
+        local_lock_acquired = False
+        try:
+            async with asyncio.timeout(self.acquire_timeout):
+                await lock.acquire()
+                local_lock_acquired = True
+                if depth:
+                    logger.info("turn of thread %s waited behind %d queued turn(s)", thread_id, depth)
+                token, state = await self.__acquire_lease(lock_key, try_acquire)
+        except BaseException:
+            self.__leave(thread_id, lock if local_lock_acquired else None)
+            raise
+
+        lease = ThreadLease(thread_id=thread_id, lock_key=lock_key, token=token)
+        lease.renewal_task = asyncio.create_task(self.__renew_until_released(lease))
+        return lease, state
+
+    async def release(self, lease: ThreadLease):
+        """ stop renewing the lease, delete it unless the state save already did, and let the next turn run """
+        if lease.renewal_task is not None:
+            lease.renewal_task.cancel()
+        try:
+            if not lease.released:
+                await self.__release(keys=[lease.lock_key], args=[lease.token])
+                lease.released = True
+        finally:
+            self.__finish(lease)
+
+    def stats(self) -> dict:
+        return {
+            "threads": len(self.__depth),
+            "queued_turns": sum(self.__depth.values()),
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+    async def __acquire_lease(self, lock_key: str, try_acquire) -> Tuple[int, T]:
+        # the fencing token increases with every turn of the thread
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.incr(f"{lock_key}:fence")
+            pipe.expire(f"{lock_key}:fence", 86400)
+            token, _ = await pipe.execute()
+
+        poll_interval = self.poll_interval
+        while True:
+            acquired, state = await try_acquire(lock_value=token, ex=self.lease_ttl)
+            if acquired:
+                return token, state
+            # held by a turn in another process
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, self.max_poll_interval)
+
+    async def __renew_until_released(self, lease: ThreadLease):
+        deadline = asyncio.get_running_loop().time() + self.max_turn_duration
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            if asyncio.get_running_loop().time() > deadline:
+                # let the lease expire and the next turn run
+                lease.lost = True
+                logger.warning("turn of thread %s was not released within %s seconds",
+                               lease.thread_id, self.max_turn_duration)
+                self.__finish(lease)
+                return
+            try:
+                renewed = await self.__renew(keys=[lease.lock_key], args=[lease.token, self.lease_ttl * 1000])
+            except Exception as e:
+                # try again on the next interval, the lease is still valid for lease_ttl
+                logger.warning("unable to renew the lease of thread %s: %s", lease.thread_id, e)
+                continue
+            if not renewed:
+                lease.lost = True
+                logger.warning("lost the lease of thread %s (token %s)", lease.thread_id, lease.token)
+                return
+
+    def __finish(self, lease: ThreadLease):
+        if not lease.finished:
+            lease.finished = True
+            self.__leave(lease.thread_id, self.__locks.get(lease.thread_id))
+
+    def __leave(self, thread_id: str, lock: Optional[asyncio.Lock]):
+        if lock is not None and lock.locked():
+            lock.release()
+        depth = self.__depth.get(thread_id, 1) - 1
+        if depth <= 0:
+            self.__depth.pop(thread_id, None)
+            self.__locks.pop(thread_id, None)
+        else:
+            self.__depth[thread_id] = depth
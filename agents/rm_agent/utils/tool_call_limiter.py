@@ -0,0 +1,99 @@
+import asyncio
+import time
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ToolCallStats:
+    """ queue wait and execution time of the calls to a single tool """
+
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.execution_total = 0.0
+        self.execution_max = 0.0
+
+    def record(self, queue_wait: float, execution: float, timed_out: bool, failed: bool):
+        self.calls += 1
+        self.timeouts += int(timed_out)
+        self.errors += int(failed)
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.execution_total += execution
+        self.execution_max = max(self.execution_max, execution)
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "queue_wait_avg_ms": self.queue_wait_total / self.calls * 1000 if self.calls else 0.0,
+            "queue_wait_max_ms": self.queue_wait_max * 1000,
+            "execution_avg_ms": self.execution_total / self.calls * 1000 if self.calls else 0.0,
+            "execution_max_ms": self.execution_max * 1000,
+        }
+
+
+class ToolCallLimiter:
+    """ bounds the number of concurrent tool calls per MCP server and applies a deadline to each call.
+
+    the deadline covers the time spent waiting for a slot and the call itself, so one hung call can not stall the turn.
+    shared by all requests of the worker process.
+    """
+
+    def __init__(self, max_concurrent_calls_per_server: int = 4, timeout: float = 30):
+        self.max_concurrent_calls_per_server = max_concurrent_calls_per_server
+        self.timeout = timeout
+        self.__semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.__stats: Dict[str, Dict[str, ToolCallStats]] = defaultdict(dict)
+
+    def __semaphore(self, server_name: str) -> asyncio.Semaphore:
+        if server_name not in self.__semaphores:
+            self.__semaphores[server_name] = asyncio.Semaphore(self.max_concurrent_calls_per_server)
+        return self.__semaphores[server_name]
+
+    async def run(self, server_name: str, tool_name: str, call: Callable[[], Awaitable[T]]) -> T:
+        """ run the tool call once a slot is available on the server. raises TimeoutError when the deadline is exceeded """
+
+        queued_at = time.perf_counter()
+        started_at = None
+        timed_out = False
+        failed = False
+        try:
+            async with asyncio.timeout(self.timeout):
+                async with self.__semaphore(server_name):
+                    started_at = time.perf_counter()
+                    return await call()
+        except TimeoutError:
+            timed_out = True
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            finished_at = time.perf_counter()
+            queue_wait = (started_at or finished_at) - queued_at
+            execution = finished_at - started_at if started_at else 0.0
+            stats = self.__stats[server_name].setdefault(tool_name, ToolCallStats())
+            stats.record(queue_wait, execution, timed_out, failed)
+            logger.debug("tool call %s on %s: queue wait %.1f ms, execution %.1f ms, timed out %s",
+                         tool_name, server_name, queue_wait * 1000, execution * 1000, timed_out)
+
+    def stats(self) -> dict:
+        """ per server, per tool call metrics and the current number of calls in flight """
+        return {
+            server_name: {
+                "in_flight": self.max_concurrent_calls_per_server - self.__semaphores[server_name]._value
+                if server_name in self.__semaphores else 0,
+                "tools": {tool_name: stats.to_dict() for tool_name, stats in tools.items()},
+            }
+            for server_name, tools in self.__stats.items()
+        }
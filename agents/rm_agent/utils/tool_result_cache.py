@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+from typing import Dict, Optional, Set, Tuple
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+
+class ToolResultCache:
+    """ redis backed cache of tool results, shared by all threads and worker processes.
+
+    only tools the mcp server marks as read-only (readOnlyHint annotation) are cached. the key is
+    (server, tool name, canonical JSON arguments), so the same lookup with differently ordered arguments is a hit.
+    """
+
+    KEY_PREFIX = "tool_cache"
+
+    def __init__(self, redis_client: Redis, read_only_tools: Set[Tuple[str, str]], default_ttl: int = 300,
+                 ttl_overrides: Dict[str, int] = None):
+        self.redis_client = redis_client
+        # (server name, tool name) pairs annotated as read-only by the mcp servers
+        self.read_only_tools = read_only_tools
+        self.default_ttl = default_ttl
+        # per tool TTL in seconds. 0 disables caching for the tool
+        self.ttl_overrides = ttl_overrides or {}
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, server_name: str, tool_name: str) -> Optional[int]:
+        """ TTL for the tool, None when the tool is not cacheable """
+        if (server_name, tool_name) not in self.read_only_tools:
+            return None
+        ttl = self.ttl_overrides.get(tool_name, self.default_ttl)
+        return ttl if ttl > 0 else None
+
+    def key(self, server_name: str, tool_name: str, arguments: str) -> str:
+        canonical_arguments = json.dumps(json.loads(arguments or "{}"), sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha256(canonical_arguments.encode()).hexdigest()
+        return f"{self.KEY_PREFIX}:{server_name}:{tool_name}:{digest}"
+
+    async def get(self, server_name: str, tool_name: str, arguments: str) -> Optional[str]:
+        if self.ttl_for(server_name, tool_name) is None:
+            return None
+        cached = await self.redis_client.get(self.key(server_name, tool_name, arguments))
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.debug("tool result cache hit for %s on %s", tool_name, server_name)
+        return cached.decode() if isinstance(cached, bytes) else cached
+
+    async def put(self, server_name: str, tool_name: str, arguments: str, content: str):
+        ttl = self.ttl_for(server_name, tool_name)
+        if ttl is None:
+            return
+        await self.redis_client.set(self.key(server_name, tool_name, arguments), content, ex=ttl)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cacheable_tools": sorted(f"{server}:{tool}" for server, tool in self.read_only_tools
+                                      if self.ttl_for(server, tool) is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
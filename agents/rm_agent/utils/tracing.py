@@ -0,0 +1,92 @@
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+logger = logging.getLogger(__name__)
+
+# spans are no-ops until setup_tracing installs a tracer provider
+tracer = trace.get_tracer("rm_agent")
+
+# (stage name, seconds) of the spans finished while handling the current request, see server_timing
+__timings: ContextVar[Optional[list[tuple[str, float]]]] = ContextVar("server_timings", default=None)
+
+
+def setup_tracing(exporter: Optional[str], service_name: str = "rm-agent") -> Optional[InMemorySpanExporter]:
+    """ install the tracer provider. exporter is "otlp" (OTEL_EXPORTER_OTLP_* env vars), "console" or "memory".
+    the in-memory exporter is returned so that tests and benchmarks can read the finished spans """
+    if not exporter:
+        return None
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    memory_exporter = None
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    elif exporter == "console":
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    elif exporter == "memory":
+        memory_exporter = InMemorySpanExporter()
+        provider.add_span_processor(SimpleSpanProcessor(memory_exporter))
+    else:
+        raise ValueError(f"unknown tracing exporter {exporter}")
+
+    trace.set_tracer_provider(provider)
+    logger.info("tracing initialized with the %s exporter", exporter)
+    return memory_exporter
+
+
+@contextmanager
+def span(name: str, current: bool = True, **attributes) -> Iterator[trace.Span]:
+    """ trace a stage of the request and add its duration to the Server-Timing of the current request.
+    use current=False inside async generators, the span is then not made the current span, so no context is
+    attached across a yield """
+    started_at = time.perf_counter()
+    try:
+        if current:
+            with tracer.start_as_current_span(name, attributes=attributes) as otel_span:
+                yield otel_span
+        else:
+            otel_span = tracer.start_span(name, attributes=attributes)
+            try:
+                yield otel_span
+            except Exception as e:
+                otel_span.record_exception(e)
+                otel_span.set_status(trace.StatusCode.ERROR)
+                raise
+            finally:
+                otel_span.end()
+    finally:
+        timings = __timings.get()
+        if timings is not None:
+            timings.append((name, time.perf_counter() - started_at))
+
+
+@contextmanager
+def server_timing() -> Iterator[list[tuple[str, float]]]:
+    """ collect the stage timings of the spans finished in this context (and the tasks started from it) """
+    timings: list[tuple[str, float]] = []
+    token = __timings.set(timings)
+    try:
+        yield timings
+    finally:
+        __timings.reset(token)
+
+
+def format_server_timing(timings: list[tuple[str, float]]) -> str:
+    """ Server-Timing header value, the durations of stages that ran more than once (LLM rounds, tool calls) are summed """
+    totals: dict[str, list] = {}
+    for name, seconds in timings:
+        total = totals.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+    return ", ".join(
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="{count}x"' if count > 1 else "")
+        for name, (seconds, count) in totals.items())
@@ -0,0 +1,102 @@
+# background job worker - persists messages to PG and summarizes threads, so the API pods only serve chats
+# uv run python worker.py
+
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+from functools import partial
+from utils.env_settings import EnvSettings
+from utils.resource_registry import ResourceRegistry
+from utils.background_task import process_background_jobs, summarize_thread
+from utils.job_queue import RedisStreamJobQueue
+from datastore.schema import maintain_partitions
+from utils.tracing import setup_tracing
+from prometheus_client import start_http_server
+
+load_dotenv()
+
+settings = EnvSettings()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] [%(filename)s %(lineno)d] [Thread-%(thread)d] %(message)s",
+    handlers=[
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+setup_tracing(settings.tracing_exporter, service_name="rm-agent-worker")
+
+AGENT_NAME = "summarization_agent"
+
+
+async def main():
+    logger.info("worker startup initiated...")
+
+    if settings.worker_metrics_port:
+        # summarization and persistence metrics of the worker
+        start_http_server(settings.worker_metrics_port)
+
+    resource_registry = ResourceRegistry()
+    partition_task = None
+    try:
+        resource_registry.setup_openai_client(
+            url=settings.llm_base_url, api_key=os.getenv("DEEPSEEK_API_KEY"))
+
+        # fold old turns of a thread into its running summary
+        resource_registry.setup_rolling_summary(
+            trigger_tokens=settings.summary_trigger_tokens, keep_recent_tokens=settings.summary_keep_recent_tokens,
+            max_window_tokens=settings.summary_max_window_tokens, tokenizer=settings.context_tokenizer)
+
+        # summarization can run on a cheaper (local) model than the supervisor
+        resource_registry.setup_summarization_backend(
+            settings.summarization_base_url, settings.summarization_api_key, settings.summarization_temperature)
+
+        # the worker only needs the summarization agent
+        resource_registry.setup_ai_client(
+            AGENT_NAME, resource_registry.openai_client, settings.agents[AGENT_NAME],
+            async_client=resource_registry.async_openai_client)
+
+        resource_registry.create_database_engine(
+            settings.database_url, pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout, pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=settings.db_pool_pre_ping, statement_cache_size=settings.db_statement_cache_size)
+        # roll the monthly partitions of the conversation table forward, now and then daily
+        partition_task = asyncio.create_task(maintain_partitions(
+            resource_registry.async_session.kw["bind"], interval=settings.partition_maintenance_interval))
+        resource_registry.setup_bulk_writer(
+            max_rows=settings.pg_bulk_writer_max_rows, flush_interval=settings.pg_bulk_writer_flush_interval)
+
+        resource_registry.setup_redis_client(
+            host=settings.redis_host, port=settings.redis_port, db=settings.redis_db,
+            max_connections=settings.redis_max_connections, pool_timeout=settings.redis_pool_timeout,
+            state_codec=settings.state_codec)
+
+        # threads of many job batches are summarized together in scheduled passes
+        resource_registry.setup_summarization_scheduler(
+            partial(summarize_thread, resource_registry), interval=settings.summarization_interval,
+            max_concurrency=settings.summarization_max_concurrency)
+
+        job_queue = RedisStreamJobQueue(resource_registry.redis_client,
+                                        partial(process_background_jobs, resource_registry),
+                                        stream=settings.job_queue_stream, group=settings.job_queue_group,
+                                        batch_size=settings.job_queue_batch_size,
+                                        max_retries=settings.job_queue_max_retries,
+                                        retry_backoff=settings.job_queue_retry_backoff,
+                                        max_retry_backoff=settings.job_queue_max_retry_backoff,
+                                        dedup_ttl=settings.job_queue_dedup_ttl)
+        logger.info("worker startup completed...")
+        await job_queue.consume_forever()
+    finally:
+        logger.info("worker shutdown initiated...")
+        if partition_task is not None:
+            partition_task.cancel()
+        await resource_registry.dispose_database_engine()
+        await resource_registry.cleanup()
+        logger.info("worker shutdown completed...")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
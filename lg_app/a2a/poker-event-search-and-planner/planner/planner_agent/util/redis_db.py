@@ -1,28 +1,55 @@
+import os
 import redis
+import msgpack
 from planner_agent.util.app_state import AppState
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
+# "json" (RedisJSON document) or "msgpack" (versioned msgpack blob in a plain string key, see encode_appstate)
+APP_STATE_CODEC = os.getenv("APP_STATE_CODEC", "json")
+# version of the msgpack layout, bump it (and keep a decoder for the old version) when AppState changes incompatibly
+APP_STATE_SCHEMA_VERSION = 1
+
+
+def encode_appstate(appstate: AppState) -> bytes:
+    """[schema version, state]. the messages are dumped in json mode, so any message content can be packed"""
+    return msgpack.packb([APP_STATE_SCHEMA_VERSION, appstate.model_dump(mode="json")])
+
+
+def decode_appstate(data: bytes) -> AppState:
+    version, state = msgpack.unpackb(data)
+    if version != APP_STATE_SCHEMA_VERSION:
+        raise ValueError(f"unsupported app state schema version {version}")
+    return AppState.model_validate(state)
+
 
 def get_appstate(email, thread_id, r: redis.Redis):
     """retrieve app state for the given email and thread_id or create one if does not exist"""
-    app_state = r.json().get(f"planner:{email}:{thread_id}")
+    if APP_STATE_CODEC == "msgpack":
+        app_state = r.get(f"planner:state:{email}:{thread_id}")
+    else:
+        app_state = r.json().get(f"planner:{email}:{thread_id}")
 
     logger.info(
         "retrieved app state %s, thread %s email %s", app_state, thread_id, email
     )
 
-    if app_state:
-        return AppState.model_validate_json(app_state)
-    else:
+    if not app_state:
         return AppState(thread_id=thread_id, email=email)
+    if APP_STATE_CODEC == "msgpack":
+        return decode_appstate(app_state)
+    return AppState.model_validate_json(app_state)
 
 
 def save_appstate(state: dict, r):
     appstate = AppState(**state)
 
+    if APP_STATE_CODEC == "msgpack":
+        r.set(f"planner:state:{appstate.email}:{appstate.thread_id}", encode_appstate(appstate))
+        return
+
     r.json().set(
         f"planner:{appstate.email}:{appstate.thread_id}", "$", appstate.model_dump_json()
     )
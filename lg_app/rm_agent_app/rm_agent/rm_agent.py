@@ -14,6 +14,7 @@ from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+from rm_agent.utils.local_index import load_local_index_retriever
 
 print("hello rm agent..")
 
@@ -24,6 +25,8 @@ THREAD_ID = os.getenv("THREAD_ID", f"thread_{random.randint(1000, 9999)}")
 
 CHROMA_CLOUD_API_KEY = os.getenv("CHROMA_CLOUD_API_KEY")
 CHROMA_TENANT = os.getenv("CHROMA_TENANT")
+# local vector index written by the ingestion pipeline. replaces the chroma cloud retriever when set
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR")
 
 MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://localhost:8000/sse")
 print(f"MCP_SERVER_URL: {MCP_SERVER_URL}")
@@ -66,15 +69,19 @@ mcp_client = MultiServerMCPClient({
     }
 })
 
-# initialize chromadb (cloud store)
-embedding_function = HuggingFaceEmbeddings(model_name="BAAI/bge-large-en-v1.5")
-vector_store = Chroma(collection_name="rm_knowledge_collection",
-                      database="tracks_ai",
-                      tenant=CHROMA_TENANT,
-                      chroma_cloud_api_key=CHROMA_CLOUD_API_KEY,
-                      embedding_function=embedding_function)
-retriever = vector_store.as_retriever(
-    search_type="similarity_score_threshold", search_kwargs={"score_threshold": 0.5})
+if LOCAL_INDEX_DIR:
+    # local memory-mapped index - no network round-trip, works offline
+    retriever = load_local_index_retriever(LOCAL_INDEX_DIR, score_threshold=0.5)
+else:
+    # initialize chromadb (cloud store)
+    embedding_function = HuggingFaceEmbeddings(model_name="BAAI/bge-large-en-v1.5")
+    vector_store = Chroma(collection_name="rm_knowledge_collection",
+                          database="tracks_ai",
+                          tenant=CHROMA_TENANT,
+                          chroma_cloud_api_key=CHROMA_CLOUD_API_KEY,
+                          embedding_function=embedding_function)
+    retriever = vector_store.as_retriever(
+        search_type="similarity_score_threshold", search_kwargs={"score_threshold": 0.5})
 
 
 async def get_resources() -> str:
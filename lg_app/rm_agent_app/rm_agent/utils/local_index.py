@@ -0,0 +1,61 @@
+import json
+import os
+from typing import Any
+import numpy as np
+from pydantic import ConfigDict
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+
+"""
+Offline replacement for the Chroma cloud retriever.
+Reads the local vector index written by the ingestion pipeline (lg_app_util/rm_agent_util/ingestion/local_index.py):
+embeddings.npy (L2 normalized, memory-mapped) + index.json (model, ids, documents)
+"""
+
+
+class LocalIndexRetriever(BaseRetriever):
+    """ top-k cosine similarity search over the local vector index with a single matrix product """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    embedding_function: Embeddings
+    embeddings: Any
+    ids: list[str]
+    documents: list[str]
+    k: int = 4
+    score_threshold: float = 0.5
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        query_embedding = np.asarray(self.embedding_function.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(query_embedding)
+        if norm:
+            query_embedding = query_embedding / norm
+
+        similarities = self.embeddings @ query_embedding
+        k = min(self.k, len(similarities))
+        if k == 0:
+            return []
+        top_k = np.argpartition(-similarities, k - 1)[:k]
+        top_k = top_k[np.argsort(-similarities[top_k])]
+
+        return [Document(id=self.ids[i], page_content=self.documents[i], metadata={"score": float(similarities[i])})
+                for i in top_k if similarities[i] >= self.score_threshold]
+
+
+def load_local_index_retriever(index_dir: str, k: int = 4, score_threshold: float = 0.5) -> LocalIndexRetriever:
+    with open(os.path.join(index_dir, "index.json")) as f:
+        sidecar = json.load(f)
+
+    print(f"loading local index from {index_dir}, version {sidecar['version']}, documents {len(sidecar['ids'])}")
+
+    return LocalIndexRetriever(
+        # queries must be embedded with the model the index was built with
+        embedding_function=HuggingFaceEmbeddings(model_name=sidecar["model"]),
+        embeddings=np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode="r"),
+        ids=sidecar["ids"],
+        documents=sidecar["documents"],
+        k=k,
+        score_threshold=score_threshold)
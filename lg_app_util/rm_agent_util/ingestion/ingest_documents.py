@@ -1,18 +1,23 @@
 import os
+import time
 from dotenv import load_dotenv
 from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from local_index import build_local_index
 import os
 
 load_dotenv()
 
 CHROMA_CLOUD_API_KEY = os.getenv("CHROMA_CLOUD_API_KEY")
 CHROMA_TENANT = os.getenv("CHROMA_TENANT")
+# directory of the local (offline) vector index, see local_index.py
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "../knowledge/local_index")
 
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 # embedding = HuggingFaceEmbeddings(model_name="BAAI/bge-large-en-v1.5")
-embedding = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+embedding = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
 
 print(f"embedding model initialized {embedding}")
 
@@ -56,6 +61,19 @@ for pdf_path in pdf_files:
 vector_store.add_documents(documents=all_docs)
 print(f"documents ingested successfully.. Total pages: {len(all_docs)}")
 
+# stamp the collection version so that agents caching search results can invalidate their caches
+vector_store._collection.modify(metadata={"version": str(int(time.time()))})
+print("collection version stamped")
+
+# build the local vector index from the same chunks
+texts = [doc.page_content for doc in all_docs]
+local_index_version = build_local_index(LOCAL_INDEX_DIR,
+                                        ids=[doc.id for doc in all_docs],
+                                        documents=texts,
+                                        embeddings=embedding.embed_documents(texts),
+                                        model_name=EMBEDDING_MODEL)
+print(f"local index written to {LOCAL_INDEX_DIR}, version {local_index_version}")
+
 results = vector_store.similarity_search_with_score(
     query="what are the key measurement guidelines?")
 
@@ -0,0 +1,72 @@
+""" writes the local vector index used by the agents as an offline replacement for Chroma Cloud retrieval.
+
+layout of the index directory:
+    CURRENT                         - version of the index in use, replaced atomically once a version is complete
+    versions/<version>/embeddings.npy - float32 matrix (num_documents x dimension) of L2 normalized embeddings,
+                                        loaded memory-mapped
+    versions/<version>/index.json     - sidecar with the embedding model, version and the ids/documents in matrix
+                                        row order
+
+a new version is written to its own directory and published by swapping the CURRENT pointer, so a running agent
+always reads the two files of one version. agents re-read CURRENT and reload the index when it changes.
+"""
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+EMBEDDINGS_FILE = "embeddings.npy"
+SIDECAR_FILE = "index.json"
+POINTER_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+# versions kept on disk besides the current one, an agent may still be reloading from the previous version
+KEEP_PREVIOUS_VERSIONS = 1
+
+
+def build_local_index(output_dir: str, ids: list[str], documents: list[str], embeddings: list[list[float]], model_name: str) -> str:
+    """ normalize the embeddings and write the index to output_dir. returns the index version """
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix = matrix / norms
+
+    versions_dir = os.path.join(output_dir, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+    version = int(time.time())
+    while os.path.exists(os.path.join(versions_dir, str(version))):
+        version += 1
+    version = str(version)
+
+    version_dir = os.path.join(versions_dir, version)
+    os.makedirs(version_dir)
+    with open(os.path.join(version_dir, EMBEDDINGS_FILE), "wb") as f:
+        np.save(f, matrix)
+    with open(os.path.join(version_dir, SIDECAR_FILE), "w") as f:
+        json.dump({
+            "version": version,
+            "model": model_name,
+            "dimension": int(matrix.shape[1]),
+            "ids": ids,
+            "documents": documents,
+        }, f)
+
+    # publish the complete version with a single rename
+    pointer_tmp = os.path.join(output_dir, f"{POINTER_FILE}.tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_tmp, os.path.join(output_dir, POINTER_FILE))
+
+    _remove_old_versions(versions_dir, version)
+    return version
+
+
+def _remove_old_versions(versions_dir: str, current: str):
+    old_versions = sorted((name for name in os.listdir(versions_dir) if name.isdigit() and name != current),
+                          key=int)
+    for name in old_versions[:len(old_versions) - KEEP_PREVIOUS_VERSIONS]:
+        shutil.rmtree(os.path.join(versions_dir, name), ignore_errors=True)
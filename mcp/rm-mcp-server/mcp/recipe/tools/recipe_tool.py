@@ -2,6 +2,7 @@ from fastmcp.tools import tool
 from fastmcp.dependencies import CurrentRequest
 from fastmcp import Context
 from starlette.requests import Request
+from mcp.types import ToolAnnotations
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,7 +24,8 @@ mock_recipes = [
 
 # Note the @tool decorator from factmcp.tools.tool instead of @mcp.tool - this is to avoid the circular dependency
 # when mcp server instance is imported from server.py. FileSystemProvider is smart to identify the tool usign @tool annotation
-@tool(name="search")
+# readOnlyHint - pure lookup, clients may cache the result
+@tool(name="search", annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
 async def recipe_search(query: str, context: Context, request: Request = CurrentRequest()) -> list[dict]:
     """
     Search for recipes by title or ingredients. 
@@ -54,7 +56,7 @@ async def recipe_search(query: str, context: Context, request: Request = Current
     return recipes
 
 
-@tool("recipes")
+@tool("recipes", annotations=ToolAnnotations(readOnlyHint=True, idempotentHint=True))
 def get_recipe_details(recipe_id: int) -> dict:
     """
     Get the full details of a recipe by its ID.